@@ -1,9 +1,16 @@
 # pylint: disable=missing-module-docstring
 # pylint: disable=missing-function-docstring
+from array import array
+import functools
+import glob
 import gzip
+import hashlib
+import json
 import os
 import re
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
+from struct import error as struct_error
+import sys
 import time
 try:
     import importlib.resources as pkg_resources
@@ -33,10 +40,489 @@ def get_error_file_name(domain):
 def get_error_file_path(domain):
     return get_path(get_error_file_name(domain))
 
+PEERS_FORMATS = ['files', 'segments']
+PEERS_INDEX_FILE_NAME = 'masnet.peers.index'
+PEERS_PREVIOUS_INDEX_FILE_NAME = 'masnet.peers.index.previous'
+PEERS_SEGMENT_FILE_NAME = 'masnet.peers.%06d.segment'
+PEERS_SEGMENT_SIZE = 64 * 1024 * 1024
+PEERS_COMPRESS_LEVEL = 6
+# length of the compressed record, 4 bytes big endian
+PEERS_RECORD_HEADER = '>I'
+PEERS_RECORD_HEADER_SIZE = 4
+# the store is flushed after this many records
+PEERS_INDEX_FLUSH_SIZE = 1024
+
+
+# peers of all domains in a few append-only segment files instead of a
+# <domain>.peers.json file per domain
+# a record is the gzip compressed content of the peers.json file prefixed by
+# its length, and masnet.peers.index has a "domain segment offset" line for
+# each record, written after the record
+# a new segment is started every time the store is opened for writing and
+# when the current one is larger than PEERS_SEGMENT_SIZE, so a segment is
+# never appended to after a crash, and a record without an index line is
+# ignored
+# if a domain is written more than once, the last record is used
+# with masnet.download --workers, each shard writes its own index, which is
+# appended to masnet.peers.index at the end, and the segments of shard k are
+# the ones with number % num_shards == k
+# with masnet.download --recrawl, the index of the previous crawls is kept as
+# masnet.peers.index.previous, and the index lines of the domains not changed
+# point to their records in the previous segments
+# pylint: disable=too-many-instance-attributes
+class PeersStore:
+
+    def __init__(self, shard=None, num_shards=1):
+        self.shard = 0 if shard is None else shard
+        self.num_shards = num_shards
+        self.index_file_name = PEERS_INDEX_FILE_NAME
+        if shard is not None:
+            self.index_file_name = '%s.%d' % (PEERS_INDEX_FILE_NAME, shard)
+        # domain -> (segment, offset)
+        self.index = {}
+        self.segment = None
+        self.offset = 0
+        self.segment_file = None
+        self.index_file = None
+        # index lines of the records not flushed yet
+        self.index_lines = []
+        self.index = PeersStore.load_index(self.index_file_name)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, domain):
+        return domain in self.index
+
+    # domain -> (segment, offset), of the domains accepted if it is given
+    @staticmethod
+    def load_index(file_name, accept=None):
+        index = {}
+        index_path = get_path(file_name)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 3:
+                        # a line cut by a crash
+                        continue
+                    if accept is not None and not accept(parts[0]):
+                        continue
+                    index[parts[0]] = (int(parts[1]), int(parts[2]))
+        return index
+
+    @staticmethod
+    def get_segments():
+        segments = []
+        for file_path in glob.glob(get_path('masnet.peers.*.segment')):
+            segments.append(int(os.path.basename(file_path).split('.')[2]))
+        return sorted(segments)
+
+    @staticmethod
+    def remove():
+        for segment in PeersStore.get_segments():
+            os.remove(get_path(PEERS_SEGMENT_FILE_NAME % segment))
+        for file_path in glob.glob(get_path('%s*' % PEERS_INDEX_FILE_NAME)):
+            os.remove(file_path)
+
+    @staticmethod
+    def remove_unused(index):
+        used = set(segment for segment, _ in index.values())
+        for segment in PeersStore.get_segments():
+            if segment not in used:
+                os.remove(get_path(PEERS_SEGMENT_FILE_NAME % segment))
+
+    # starts a new crawl keeping the records of the previous ones, the last
+    # record of each domain in the index and the previous index becomes the
+    # previous index
+    @staticmethod
+    def retire():
+        index = PeersStore.load_index(PEERS_PREVIOUS_INDEX_FILE_NAME)
+        index.update(PeersStore.load_index(PEERS_INDEX_FILE_NAME))
+        file_path = get_path(PEERS_PREVIOUS_INDEX_FILE_NAME)
+        with open('%s.tmp' % file_path, 'w') as f:
+            for domain, (segment, offset) in index.items():
+                f.write('%s %d %d\n' % (domain, segment, offset))
+        os.replace('%s.tmp' % file_path, file_path)
+        for file_path in glob.glob(get_path('%s*' % PEERS_INDEX_FILE_NAME)):
+            if os.path.basename(file_path) != PEERS_PREVIOUS_INDEX_FILE_NAME:
+                os.remove(file_path)
+        PeersStore.remove_unused(index)
+
+    # after a complete crawl, the records of the domains not in it are
+    # removed
+    @staticmethod
+    def remove_previous():
+        file_path = get_path(PEERS_PREVIOUS_INDEX_FILE_NAME)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            PeersStore.remove_unused(PeersStore.load_index(PEERS_INDEX_FILE_NAME))
+
+    # appends the indexes of the shards to masnet.peers.index
+    @staticmethod
+    def merge(num_shards):
+        with open(get_path(PEERS_INDEX_FILE_NAME), 'a') as f:
+            for shard in range(0, num_shards):
+                file_path = get_path('%s.%d' % (PEERS_INDEX_FILE_NAME, shard))
+                if os.path.exists(file_path):
+                    with open(file_path, 'r') as shard_file:
+                        f.write(shard_file.read())
+                    os.remove(file_path)
+
+    def open(self):
+        segments = PeersStore.get_segments()
+        # the first segment of this shard after all existing segments
+        last = segments[-1] if len(segments) > 0 else -1
+        self.segment = ((last // self.num_shards + 1) * self.num_shards +
+                        self.shard - self.num_shards)
+        self.index_file = open(get_path(self.index_file_name), 'a')
+        self.next_segment()
+
+    def next_segment(self):
+        if self.segment_file is not None:
+            self.flush()
+            self.segment_file.close()
+        self.segment = self.segment + self.num_shards
+        self.offset = 0
+        self.segment_file = open(get_path(PEERS_SEGMENT_FILE_NAME % self.segment),
+                                 'wb')
+
+    # text is the content of the peers.json file of the domain
+    def append(self, domain, text):
+        if self.offset >= PEERS_SEGMENT_SIZE:
+            self.next_segment()
+        data = gzip.compress(text.encode('utf-8'),
+                             compresslevel=PEERS_COMPRESS_LEVEL)
+        self.segment_file.write(pack(PEERS_RECORD_HEADER, len(data)))
+        self.segment_file.write(data)
+        self.index_lines.append('%s %d %d\n' % (domain, self.segment, self.offset))
+        self.index[domain] = (self.segment, self.offset)
+        self.offset = self.offset + PEERS_RECORD_HEADER_SIZE + len(data)
+        if len(self.index_lines) >= PEERS_INDEX_FLUSH_SIZE:
+            self.flush()
+
+    # a record of a previous crawl, (segment, offset), is used again
+    def keep(self, domain, location):
+        self.index_lines.append('%s %d %d\n' % (domain, location[0], location[1]))
+        self.index[domain] = location
+        if len(self.index_lines) >= PEERS_INDEX_FLUSH_SIZE:
+            self.flush()
+
+    # records are flushed before their index lines are written
+    def flush(self):
+        if self.segment_file is not None:
+            self.segment_file.flush()
+            self.index_file.write(''.join(self.index_lines))
+            self.index_file.flush()
+            self.index_lines.clear()
+
+    def close(self):
+        if self.segment_file is not None:
+            self.flush()
+            self.segment_file.close()
+            self.index_file.close()
+            self.segment_file = None
+            self.index_file = None
+
+    # the compressed record
+    @staticmethod
+    def read_raw_record(f):
+        length = unpack(PEERS_RECORD_HEADER, f.read(PEERS_RECORD_HEADER_SIZE))[0]
+        return f.read(length)
+
+    @staticmethod
+    def read_record(f):
+        return gzip.decompress(PeersStore.read_raw_record(f)).decode('utf-8')
+
+    @staticmethod
+    def read_location(location):
+        segment, offset = location
+        with open(get_path(PEERS_SEGMENT_FILE_NAME % segment), 'rb') as f:
+            f.seek(offset)
+            return PeersStore.read_record(f)
+
+    # content of the peers.json file of the domain, None if it is not found
+    def read(self, domain):
+        if domain not in self.index:
+            return None
+        return PeersStore.read_location(self.index[domain])
+
+    # yields (domain, content of the peers.json file) of all domains
+    # reads the segments one by one, in the order the records are written
+    def __iter__(self):
+        records = sorted((location, domain)
+                         for domain, location in self.index.items())
+        f = None
+        segment = None
+        try:
+            for (record_segment, offset), domain in records:
+                if record_segment != segment:
+                    if f is not None:
+                        f.close()
+                    segment = record_segment
+                    f = open(get_path(PEERS_SEGMENT_FILE_NAME % segment), 'rb')
+                if f.tell() != offset:
+                    f.seek(offset)
+                yield domain, PeersStore.read_record(f)
+        finally:
+            if f is not None:
+                f.close()
+
+
+DOMAINS_INITIAL_SLOTS = 1 << 16
+# length of a name in the domains file, 2 bytes big endian
+DOMAIN_RECORD_HEADER = '>H'
+DOMAIN_RECORD_HEADER_SIZE = 2
+
+
+# assigns an id (0, 1, 2...) to each distinct domain, in the order they are
+# seen first, without keeping a str object for each domain
+# the names are kept utf-8 encoded in a single bytearray, and the ids are
+# found with an open addressing hash table, at most half full, of ids
+# (-1 for an empty slot) and the hashes of the names
+class DomainDictionary:
+
+    def __init__(self):
+        self.names = bytearray()
+        # name of id i is names[offsets[i]:offsets[i+1]]
+        self.offsets = array('Q', [0])
+        self.hashes = array('q')
+        self.slots = array('i', [-1]) * DOMAINS_INITIAL_SLOTS
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, domain):
+        return self.find(domain) is not None
+
+    def __iter__(self):
+        for domain_id in range(0, len(self)):
+            yield self.name(domain_id)
+
+    @staticmethod
+    def encode(domain):
+        # json can decode lone surrogates
+        return domain.encode('utf-8', 'surrogatepass')
+
+    def name(self, domain_id):
+        return self.names[self.offsets[domain_id]:
+                          self.offsets[domain_id+1]].decode('utf-8',
+                                                            'surrogatepass')
+
+    # returns the slot of the domain, or the empty slot it would be put into
+    def lookup(self, domain, domain_hash, encoded):
+        mask = len(self.slots) - 1
+        slot = domain_hash & mask
+        while True:
+            domain_id = self.slots[slot]
+            if domain_id == -1:
+                return slot
+            if self.hashes[domain_id] == domain_hash:
+                if encoded is None:
+                    encoded = DomainDictionary.encode(domain)
+                if self.names[self.offsets[domain_id]:self.offsets[domain_id+1]] == encoded:
+                    return slot
+            slot = (slot + 1) & mask
+
+    def find(self, domain):
+        domain_id = self.slots[self.lookup(domain, hash(domain), None)]
+        return None if domain_id == -1 else domain_id
+
+    # returns (id, True if it is seen first)
+    def intern(self, domain):
+        domain_hash = hash(domain)
+        slot = self.lookup(domain, domain_hash, None)
+        if self.slots[slot] != -1:
+            return self.slots[slot], False
+        domain_id = len(self.hashes)
+        self.names.extend(DomainDictionary.encode(domain))
+        self.offsets.append(len(self.names))
+        self.hashes.append(domain_hash)
+        self.slots[slot] = domain_id
+        if 2 * len(self.hashes) > len(self.slots):
+            self.grow()
+        return domain_id, True
+
+    def grow(self):
+        self.slots = array('i', [-1]) * (2 * len(self.slots))
+        mask = len(self.slots) - 1
+        for domain_id, domain_hash in enumerate(self.hashes):
+            slot = domain_hash & mask
+            while self.slots[slot] != -1:
+                slot = (slot + 1) & mask
+            self.slots[slot] = domain_id
+
+    # appends the names from the id specified to the end, each prefixed by
+    # its length
+    def save(self, file_path, start=0):
+        with open(file_path, 'ab') as f:
+            for domain_id in range(start, len(self)):
+                encoded = self.names[self.offsets[domain_id]:self.offsets[domain_id+1]]
+                f.write(pack(DOMAIN_RECORD_HEADER, len(encoded)))
+                f.write(encoded)
+
+    # yields the names saved in the order of their ids
+    @staticmethod
+    def read(file_path):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + DOMAIN_RECORD_HEADER_SIZE <= len(data):
+            length = unpack_from(DOMAIN_RECORD_HEADER, data, pos)[0]
+            pos = pos + DOMAIN_RECORD_HEADER_SIZE
+            if pos + length > len(data):
+                # a name cut by a crash
+                return
+            yield data[pos:pos+length].decode('utf-8', 'surrogatepass')
+            pos = pos + length
+
+    # loads the first count names, or all of them if count is None
+    @staticmethod
+    def load(file_path, count=None):
+        domains = DomainDictionary()
+        for domain in DomainDictionary.read(file_path):
+            if count is not None and len(domains) >= count:
+                break
+            domains.intern(domain)
+        return domains
+
+
+# peers of a domain as domain ids: the id of the domain and the number of
+# peers, 4 bytes each, followed by the ids of the peers, all little endian
+LINKS_RECORD_HEADER = '<II'
+LINKS_RECORD_HEADER_SIZE = 8
+
+
+def pack_links(domain_id, peer_ids):
+    if sys.byteorder == 'big':
+        peer_ids = array('I', peer_ids)
+        peer_ids.byteswap()
+    return pack(LINKS_RECORD_HEADER, domain_id, len(peer_ids)) + peer_ids.tobytes()
+
+
+# domain id -> array of peer ids, the last record of a domain is used
+def load_links(file_path):
+    links = {}
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + LINKS_RECORD_HEADER_SIZE <= len(data):
+        domain_id, count = unpack_from(LINKS_RECORD_HEADER, data, pos)
+        pos = pos + LINKS_RECORD_HEADER_SIZE
+        end = pos + count * 4
+        if end > len(data):
+            # a record cut by a crash
+            break
+        peer_ids = array('I')
+        peer_ids.frombytes(data[pos:end])
+        if sys.byteorder == 'big':
+            peer_ids.byteswap()
+        links[domain_id] = peer_ids
+        pos = end
+    return links
+
+
+# yields the peers.json documents of all domains, in either format
+def iter_peers(peers_format='files'):
+    if peers_format == 'segments':
+        for _, text in PeersStore():
+            yield json.loads(text)
+    else:
+        for file_name in glob.glob(get_path('*.peers.json')):
+            with open(file_name, 'r') as f:
+                yield json.load(f)
+
 EXCLUDED_PATTERNS = list()
+EXCLUSION_MATCHER = None
+EXCLUSION_CACHE_SIZE = 1 << 18
+
+# a pattern made only of these (after removing ^ and $) is a plain string
+LITERAL_PATTERN = re.compile(r'^(?:[a-zA-Z0-9_\-/:]|\\\.)+$')
+
+
+# matches a domain against all exclusion patterns at once
+# patterns that are plain strings are looked up in hashes, a suffix pattern
+# starting with an escaped dot (like the malicious domains) is looked up label
+# by label, and the remaining patterns are combined into a single regex
+# matching ignores case
+# pylint: disable=too-many-instance-attributes
+class ExclusionMatcher:
+
+    def __init__(self, patterns):
+        # value -> pattern, patterns are kept only for debug output
+        self.exact = {}
+        self.label_suffixes = {}
+        self.suffixes = {}
+        self.prefixes = {}
+        self.substrings = {}
+        self.others = []
+        # patterns in the combined regex, in the order of their groups
+        self.combined_patterns = []
+        for pattern in patterns:
+            source = pattern.pattern
+            starts = source.startswith('^')
+            ends = source.endswith('$') and not source.endswith('\\$')
+            body = source[1 if starts else 0:-1 if ends else len(source)]
+            if LITERAL_PATTERN.match(body) is None:
+                if pattern.groups > 0:
+                    # group numbers would change in the combined regex
+                    self.others.append(re.compile(source, re.IGNORECASE))
+                else:
+                    self.combined_patterns.append(pattern)
+                continue
+            literal = body.replace('\\.', '.').lower()
+            if starts and ends:
+                self.exact.setdefault(literal, pattern)
+            elif ends and literal.startswith('.'):
+                self.label_suffixes.setdefault(literal[1:], pattern)
+            elif ends:
+                self.suffixes.setdefault(literal, pattern)
+            elif starts:
+                self.prefixes.setdefault(literal, pattern)
+            else:
+                self.substrings.setdefault(literal, pattern)
+        self.combined = None
+        if len(self.combined_patterns) > 0:
+            groups = []
+            for i, pattern in enumerate(self.combined_patterns):
+                groups.append('(?P<p%d>%s)' % (i, pattern.pattern))
+            self.combined = re.compile('|'.join(groups), re.IGNORECASE)
+        self.prefix_tuple = tuple(self.prefixes)
+        self.suffix_tuple = tuple(self.suffixes)
+        self.match = functools.lru_cache(maxsize=EXCLUSION_CACHE_SIZE)(self.find)
+
+    # pylint: disable=too-many-return-statements
+    # returns the pattern excluding the domain or None
+    def find(self, domain):
+        domain = domain.lower()
+        if domain in self.exact:
+            return self.exact[domain]
+        if len(self.label_suffixes) > 0:
+            i = domain.find('.')
+            while i != -1:
+                pattern = self.label_suffixes.get(domain[i+1:])
+                if pattern is not None:
+                    return pattern
+                i = domain.find('.', i+1)
+        if domain.endswith(self.suffix_tuple):
+            return next(p for s, p in self.suffixes.items() if domain.endswith(s))
+        if domain.startswith(self.prefix_tuple):
+            return next(p for s, p in self.prefixes.items() if domain.startswith(s))
+        for substring, pattern in self.substrings.items():
+            if substring in domain:
+                return pattern
+        if self.combined is not None:
+            m = self.combined.search(domain)
+            if m is not None:
+                return self.combined_patterns[int(m.lastgroup[1:])]
+        for pattern in self.others:
+            if pattern.search(domain) is not None:
+                return pattern
+        return None
+
 
 def load_exclusion(exclude_file):
-    global EXCLUDED_PATTERNS
+    global EXCLUDED_PATTERNS, EXCLUSION_MATCHER
     def load_exclusion_file(f):
         for line in f:
             line = line.strip()
@@ -58,12 +544,13 @@ def load_exclusion(exclude_file):
         with open(exclude_file, 'r') as file:
             load_exclusion_file(file)
     verbose('--- end of exclusion patterns ---')
+    EXCLUSION_MATCHER = ExclusionMatcher(EXCLUDED_PATTERNS)
 
 def is_excluded(domain):
-    for pattern in EXCLUDED_PATTERNS:
-        if pattern.search(domain, re.IGNORECASE) is not None:
-            debug('%s excluded due to: %s' % (domain, pattern))
-            return True
+    pattern = EXCLUSION_MATCHER.match(domain)
+    if pattern is not None:
+        debug('%s excluded due to: %s' % (domain, pattern))
+        return True
     return False
 
 def get_excluded_patterns():
@@ -118,51 +605,435 @@ def percent_progress(x):
         percent_progress.last = time.time()
 
 
-def save_graph(adjlists,
-               create_directed,
-               file_path,
-               progressfn=None):
-    if progressfn:
-        progressfn(-1)
+# links is the graph in CSR form, (offsets, targets), the targets of node i
+# are targets[offsets[i]:offsets[i+1]], sorted and without duplicates
+# returns the links as source and target arrays in this order, int64 as
+# Graph.addEdges needs (it crashes with int32)
+def get_link_arrays(links):
+    import numpy
+    offsets, targets = links
+    num_nodes = len(offsets) - 1
+    sources = numpy.repeat(numpy.arange(num_nodes, dtype=numpy.int64),
+                           numpy.diff(offsets))
+    return num_nodes, sources, targets.astype(numpy.int64)
+
+
+# returns the links of the undirected graph, u->v and v->u is a single link
+# it is added where the first of them is in the sorted links, as adding the
+# links one by one with a hasEdge check does, so v->u is dropped (u < v)
+# if u->v exists, thus the graph and the saved file are the same
+def get_undirected_link_arrays(num_nodes, sources, targets):
+    import numpy
+    # only a link with u > v can be dropped, if its reverse exists
+    backward = sources > targets
+    keep = ~backward
+    # the keys of the reversed forward links, sorted, and the keys of the
+    # backward links, which are sorted as the links are, so the binary
+    # searches go in order (searching unsorted keys is many times slower)
+    reverse_keys = targets[keep] * num_nodes + sources[keep]
+    reverse_keys.sort()
+    keys = sources[backward] * num_nodes + targets[backward]
+    if len(reverse_keys) > 0:
+        positions = numpy.searchsorted(reverse_keys, keys)
+        numpy.minimum(positions, len(reverse_keys) - 1, out=positions)
+        keep[backward] = reverse_keys[positions] != keys
+    else:
+        keep[backward] = True
+    return sources[keep], targets[keep]
+
+
+def build_graph(num_nodes, sources, targets, create_directed):
     import networkit as nk
-    g = nk.Graph(n=len(adjlists),
+    g = nk.Graph(n=num_nodes,
                  directed=create_directed)
-    # pylint: disable=consider-using-enumerate
-    # not enumerating to preserve the order 0...n
-    for i in range(0, len(adjlists)):
-        if progressfn:
-            progressfn(i/len(adjlists))
-        adjlist = adjlists[i]
-        for adj_vertex_id in sorted(adjlist):
-            if create_directed:
-                g.addEdge(i, adj_vertex_id)
-            # prevent adding both u->v and v->u if undirected
-            elif not g.hasEdge(i, adj_vertex_id):
-                g.addEdge(i, adj_vertex_id)
-
-    # save graph
+    # links are added in the order of the arrays
+    g.addEdges((sources, targets))
+    return g
+
+
+def write_graph(g, file_path):
+    import networkit as nk
     nk.writeGraph(g,
                   file_path,
                   nk.Format.NetworkitBinary,
                   chunks=32,
                   NetworkitBinaryWeights=0) # 0=no weight
+
+
+# saves both graphs from the same links, the directed graph is written
+# (networkit releases the GIL while writing) while the undirected graph is
+# built, and then both are written concurrently
+def save_graphs(links,
+                directed_file_path,
+                undirected_file_path,
+                progressfn=None):
+    from concurrent.futures import ThreadPoolExecutor
+    if progressfn:
+        progressfn(-1)
+    num_nodes, sources, targets = get_link_arrays(links)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        g = build_graph(num_nodes, sources, targets, True)
+        directed_future = executor.submit(write_graph, g, directed_file_path)
+        del g
+        if progressfn:
+            progressfn(1/3)
+        sources, targets = get_undirected_link_arrays(num_nodes,
+                                                      sources,
+                                                      targets)
+        g = build_graph(num_nodes, sources, targets, False)
+        del sources
+        del targets
+        if progressfn:
+            progressfn(2/3)
+        write_graph(g, undirected_file_path)
+        del g
+        directed_future.result()
     if progressfn:
         progressfn(2)
 
 
+# mastodon.links is saved with the graphs, it has the links in CSR form as
+# they are in memory, so they are read back (memory-mapped) without reading
+# the graphs, all little endian:
+# - magic, the number of nodes n and the number of links m (8 bytes each)
+# - n+1 offsets (8 bytes each)
+# - m targets (4 bytes each)
+LINKS_CSR_MAGIC = b'MASNETC1'
+LINKS_CSR_HEADER = '<8sQQ'
+LINKS_CSR_HEADER_SIZE = 24
+
+
+def save_links_csr(links, file_path):
+    offsets, targets = links
+    with open('%s.tmp' % file_path, 'wb') as file:
+        file.write(pack(LINKS_CSR_HEADER, LINKS_CSR_MAGIC,
+                        len(offsets) - 1, len(targets)))
+        offsets.astype('<i8', copy=False).tofile(file)
+        targets.astype('<i4', copy=False).tofile(file)
+    os.replace('%s.tmp' % file_path, file_path)
+
+
+# returns the links (offsets, targets) of save_links_csr as read-only
+# arrays over the mapped file
+def load_links_csr(file_path):
+    import mmap
+    import numpy
+    with open(file_path, 'rb') as f:
+        # the map stays when the file is closed
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, num_nodes, num_links = unpack_from(LINKS_CSR_HEADER, buffer, 0)
+    if magic != LINKS_CSR_MAGIC:
+        raise ValueError('not a links file')
+    offsets = numpy.frombuffer(buffer, dtype='<i8', count=num_nodes + 1,
+                               offset=LINKS_CSR_HEADER_SIZE)
+    targets = numpy.frombuffer(buffer, dtype='<i4', count=num_links,
+                               offset=LINKS_CSR_HEADER_SIZE + 8 * (num_nodes + 1))
+    return offsets, targets
+
+
+# <labels file>.index is saved with the labels, it has the labels in a
+# binary form that is memory-mapped by load_labels, all little endian:
+# - magic and the number of labels n (8 bytes)
+# - n+1 offsets (8 bytes each) of the labels, in the order of the ids
+# - n ids (4 bytes each), in the order of the labels
+# - the labels, utf-8
+# so the label of an id is found in O(1), and the id of a label with a
+# binary search, and nothing is read until it is used
+LABELS_INDEX_MAGIC = b'MASNETL1'
+LABELS_INDEX_HEADER = '<8sQ'
+LABELS_INDEX_HEADER_SIZE = 16
+
+
+def get_labels_index_path(file_path):
+    return '%s.index' % get_path(file_path)
+
+
+def pack_labels_index(id2labels):
+    # the same labels as reading the labels file
+    encoded = [id2labels[i].strip().encode('utf-8', 'surrogatepass')
+               for i in range(0, len(id2labels))]
+    offsets = array('Q', [0])
+    for label in encoded:
+        offsets.append(offsets[-1] + len(label))
+    ids = array('I', sorted(range(0, len(encoded)), key=encoded.__getitem__))
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+        ids.byteswap()
+    return b''.join([pack(LABELS_INDEX_HEADER, LABELS_INDEX_MAGIC, len(encoded)),
+                     offsets.tobytes(),
+                     ids.tobytes()] + encoded)
+
+
+# the labels of the nodes, returned by load_labels, it can be used as the
+# dict of node_id -> label, and find returns the node_id of a label
+class LabelIndex:
+
+    def __init__(self, buffer):
+        magic, self.size = unpack_from(LABELS_INDEX_HEADER, buffer, 0)
+        if magic != LABELS_INDEX_MAGIC:
+            raise ValueError('not a labels index')
+        self.buffer = buffer
+        self.ids_start = LABELS_INDEX_HEADER_SIZE + 8 * (self.size + 1)
+        self.labels_start = self.ids_start + 4 * self.size
+
+    @staticmethod
+    def open(file_path):
+        import mmap
+        with open(file_path, 'rb') as f:
+            # the map stays when the file is closed
+            return LabelIndex(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, node_id):
+        return 0 <= node_id < self.size
+
+    def __iter__(self):
+        return iter(range(0, self.size))
+
+    def encoded(self, node_id):
+        start, end = unpack_from('<QQ', self.buffer,
+                                 LABELS_INDEX_HEADER_SIZE + 8 * node_id)
+        return self.buffer[self.labels_start+start:self.labels_start+end]
+
+    def __getitem__(self, node_id):
+        if node_id not in self:
+            raise KeyError(node_id)
+        return self.encoded(node_id).decode('utf-8', 'surrogatepass')
+
+    def get(self, node_id, default=None):
+        return self[node_id] if node_id in self else default
+
+    def keys(self):
+        return range(0, self.size)
+
+    def values(self):
+        for node_id in range(0, self.size):
+            yield self[node_id]
+
+    def items(self):
+        for node_id in range(0, self.size):
+            yield node_id, self[node_id]
+
+    # node_id of the label, None if it is not found
+    def find(self, label):
+        encoded = label.encode('utf-8', 'surrogatepass')
+        low = 0
+        high = self.size
+        while low < high:
+            middle = (low + high) // 2
+            node_id = unpack_from('<I', self.buffer,
+                                  self.ids_start + 4 * middle)[0]
+            if self.encoded(node_id) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.size:
+            node_id = unpack_from('<I', self.buffer, self.ids_start + 4 * low)[0]
+            if self.encoded(node_id) == encoded:
+                return node_id
+        return None
+
+
 def save_labels(id2labels, file_path):
     with open(get_path(file_path), 'w') as file:
         # pylint: disable=consider-using-enumerate
         # not enumerating to preserve the order 0...n
         for i in range(0, len(id2labels)):
             file.write('%s\n' % id2labels[i])
+    index_path = get_labels_index_path(file_path)
+    # replaced, as it can be mapped by another process
+    with open('%s.tmp' % index_path, 'wb') as file:
+        file.write(pack_labels_index(id2labels))
+    os.replace('%s.tmp' % index_path, index_path)
 
 
+# returns a LabelIndex, mapping the index of the labels file if it is not
+# older than the labels file, otherwise reading the labels file
 def load_labels(file_path):
-    id2labels = {}
-    i = 0
+    index_path = get_labels_index_path(file_path)
+    if (os.path.exists(index_path) and
+            os.path.getmtime(index_path) >= os.path.getmtime(get_path(file_path))):
+        return LabelIndex.open(index_path)
+    id2labels = []
     with open(get_path(file_path), 'r') as file:
         for line in file:
-            id2labels[i] = line.strip()
-            i = i + 1
-    return id2labels
+            id2labels.append(line.strip())
+    return LabelIndex(pack_labels_index(id2labels))
+
+
+# the results of masnet.analyze are cached in masnet.analyze.cache, an
+# entry is keyed by the file name and the content digest of the graph file,
+# the name of the analysis and its parameters, its file name is
+# <graph file name>.<name>.<parameters digest>.<graph digest>.result, and
+# it has the arrays of the result in a binary form that is memory-mapped,
+# all little endian:
+# - magic and the number of arrays n (8 bytes)
+# - n array headers, the name (16 bytes, utf-8 padded with zeros), the
+#   dtype (8 bytes, like <f8, padded with zeros) and the number of items
+#   (8 bytes)
+# - the items of the arrays, each starting at a multiple of 8 bytes
+# the entries of the same graph file, analysis and parameters but of another
+# content are removed when an entry is saved, and then the least recently
+# used entries are removed until all are smaller than max_size
+RESULT_CACHE_DIR_NAME = 'masnet.analyze.cache'
+RESULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+RESULT_MAGIC = b'MASNETR1'
+RESULT_HEADER = '<8sQ'
+RESULT_HEADER_SIZE = 16
+RESULT_ARRAY_HEADER = '<16s8sQ'
+RESULT_ARRAY_HEADER_SIZE = 32
+
+
+def pack_result(arrays):
+    import numpy
+    headers = []
+    items = []
+    offset = RESULT_HEADER_SIZE + RESULT_ARRAY_HEADER_SIZE * len(arrays)
+    for name, values in arrays.items():
+        values = numpy.asarray(values)
+        values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+        headers.append(pack(RESULT_ARRAY_HEADER,
+                            name.encode('utf-8'),
+                            values.dtype.str.encode('ascii'),
+                            values.size))
+        data = values.tobytes()
+        padding = -(offset + len(data)) % 8
+        items.append(data + b'\0' * padding)
+        offset = offset + len(data) + padding
+    return b''.join([pack(RESULT_HEADER, RESULT_MAGIC, len(arrays))] +
+                    headers + items)
+
+
+# returns the arrays of pack_result as read-only arrays over the buffer
+def unpack_result(buffer):
+    import numpy
+    magic, num_arrays = unpack_from(RESULT_HEADER, buffer, 0)
+    if magic != RESULT_MAGIC:
+        raise ValueError('not a result')
+    arrays = {}
+    offset = RESULT_HEADER_SIZE + RESULT_ARRAY_HEADER_SIZE * num_arrays
+    for i in range(0, num_arrays):
+        name, dtype, count = unpack_from(RESULT_ARRAY_HEADER, buffer,
+                                         RESULT_HEADER_SIZE +
+                                         RESULT_ARRAY_HEADER_SIZE * i)
+        dtype = numpy.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        arrays[name.rstrip(b'\0').decode('utf-8')] = numpy.frombuffer(
+            buffer, dtype=dtype, count=count, offset=offset)
+        offset = offset + dtype.itemsize * count
+        offset = offset + (-offset % 8)
+    return arrays
+
+
+class ResultCache:
+
+    def __init__(self, dir_path, graph_path, max_size=RESULT_CACHE_MAX_SIZE):
+        self.dir_path = dir_path
+        self.max_size = max_size
+        # the directed and the undirected graphs are cached separately
+        self.graph_name = os.path.basename(graph_path)
+        os.makedirs(dir_path, exist_ok=True)
+        self.graph_digest = self.get_digest(graph_path)
+
+    # the digest of the graph file is saved with its size and modification
+    # time to <file name>.digest, so the file is hashed again only when it
+    # is changed
+    def get_digest(self, graph_path):
+        st = os.stat(graph_path)
+        stamp = '%d %d' % (st.st_size, st.st_mtime_ns)
+        digest_path = os.path.join(self.dir_path,
+                                   '%s.digest' % os.path.basename(graph_path))
+        try:
+            with open(digest_path, 'r') as f:
+                saved_stamp, digest = f.read().strip().rsplit(' ', 1)
+            if saved_stamp == stamp:
+                return digest
+        except (FileNotFoundError, ValueError):
+            pass
+        h = hashlib.sha256()
+        with open(graph_path, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if len(chunk) == 0:
+                    break
+                h.update(chunk)
+        digest = h.hexdigest()
+        with open('%s.tmp' % digest_path, 'w') as f:
+            f.write('%s %s\n' % (stamp, digest))
+        os.replace('%s.tmp' % digest_path, digest_path)
+        return digest
+
+    def get_entry_prefix(self, name, params):
+        params_digest = hashlib.sha256(json.dumps(params, sort_keys=True)
+                                       .encode('utf-8')).hexdigest()
+        return '%s.%s.%s.' % (self.graph_name, name, params_digest[:16])
+
+    def get_entry_path(self, name, params):
+        return os.path.join(self.dir_path,
+                            '%s%s.result' % (self.get_entry_prefix(name, params),
+                                             self.graph_digest[:32]))
+
+    # returns the arrays of the result, None if it is not cached
+    def get(self, name, params):
+        import mmap
+        entry_path = self.get_entry_path(name, params)
+        try:
+            with open(entry_path, 'rb') as f:
+                # the map stays when the file is closed
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            arrays = unpack_result(buffer)
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError, struct_error):
+            debug('invalid cache entry: %s' % entry_path)
+            os.remove(entry_path)
+            return None
+        # the modification time is the last use, for the eviction
+        os.utime(entry_path)
+        return arrays
+
+    def put(self, name, params, arrays):
+        entry_path = self.get_entry_path(name, params)
+        # replaced, as it can be mapped by another process
+        with open('%s.tmp' % entry_path, 'wb') as f:
+            f.write(pack_result(arrays))
+        os.replace('%s.tmp' % entry_path, entry_path)
+        prefix = self.get_entry_prefix(name, params)
+        for file_name in os.listdir(self.dir_path):
+            file_path = os.path.join(self.dir_path, file_name)
+            if (file_name.startswith(prefix) and
+                    file_name.endswith('.result') and
+                    file_path != entry_path):
+                debug('removing cache entry of an older graph: %s' % file_name)
+                os.remove(file_path)
+        self.evict(entry_path)
+
+    # removes the least recently used entries until the entries are smaller
+    # than max_size, keeping the entry just saved
+    def evict(self, kept_path):
+        entries = []
+        total_size = 0
+        for file_path in glob.glob(os.path.join(self.dir_path, '*.result')):
+            st = os.stat(file_path)
+            entries.append((st.st_mtime_ns, st.st_size, file_path))
+            total_size = total_size + st.st_size
+        for _, size, file_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if file_path == kept_path:
+                continue
+            debug('evicting cache entry: %s' % os.path.basename(file_path))
+            os.remove(file_path)
+            total_size = total_size - size
+
+    # returns the cached result, or the result of compute (a dict of name
+    # -> array) after caching it
+    def get_or_compute(self, name, params, compute):
+        arrays = self.get(name, params)
+        if arrays is not None:
+            verbose('%s read from the cache.' % name)
+            return arrays
+        arrays = compute()
+        self.put(name, params, arrays)
+        return self.get(name, params)
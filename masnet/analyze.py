@@ -4,6 +4,7 @@
 # pylint: disable=global-statement
 # pylint: disable=bare-except,broad-except
 import argparse
+import sys
 import time
 import matplotlib.pyplot as plt
 import networkit as nk
@@ -12,6 +13,81 @@ import numpy
 from tabulate import tabulate, SEPARATING_LINE
 from masnet import get_version, set_verbose, set_debug, debug, set_working_dir
 from masnet import load_labels, get_path, pltpause
+from masnet import ResultCache, RESULT_CACHE_DIR_NAME
+
+
+def read_graph(directed):
+    start = time.time()
+    if directed:
+        print('reading directed graph into networkit...')
+        g = nk.readGraph(get_path('mastodon.networkit.directed'),
+                         nk.graphio.Format.NetworkitBinary)
+        if not g.isDirected():
+            print('mastodon.networkit.directed is undirected ?!')
+            sys.exit(-1)
+    else:
+        print('reading undirected graph into networkit...')
+        g = nk.readGraph(get_path('mastodon.networkit.undirected'),
+                        nk.graphio.Format.NetworkitBinary)
+        if g.isDirected():
+            print('mastodon.networkit.undirected is directed ?!')
+            sys.exit(-1)
+    print('graph read in %.1f seconds.' % (time.time() - start))
+    return g
+
+
+# the results of the analyses below are dicts of name -> array, so they can
+# be cached by ResultCache, a single value is an array of one item
+
+def get_degrees(g):
+    degrees = numpy.zeros(g.numberOfNodes(), dtype=numpy.int64)
+    for node_id in g.iterNodes():
+        degrees[node_id] = g.degree(node_id)
+    return {'degrees': degrees,
+            'links': [g.numberOfEdges()],
+            'directed': [int(g.isDirected())],
+            'weighted': [int(g.isWeighted())]}
+
+
+# kind is connected, strongly or weakly
+def get_component_sizes(g, kind):
+    if kind == 'strongly':
+        components_run = nk.components.StronglyConnectedComponents(g)
+    elif kind == 'weakly':
+        components_run = nk.components.WeaklyConnectedComponents(g)
+    else:
+        components_run = nk.components.ConnectedComponents(g)
+    components_run.run()
+    component_sizes = components_run.getComponentSizes()
+    return {'sizes': numpy.array([component_sizes[c]
+                                  for c in sorted(component_sizes)],
+                                 dtype=numpy.int64)}
+
+
+def get_local_clustering_coefficients(g):
+    lcc_run = nk.centrality.LocalClusteringCoefficient(g,
+                                                       turbo=True)
+    lcc_run.run()
+    return {'scores': numpy.array(lcc_run.scores(), dtype=numpy.float64)}
+
+
+# exact diameter of the (largest component of the) undirected graph
+def get_diameter(g):
+    components_run = nk.components.ConnectedComponents(g)
+    components_run.run()
+    if components_run.numberOfComponents() > 1:
+        g = components_run.extractLargestConnectedComponent(g, False)
+    diameter_run = nk.distance.Diameter(g,
+                                        algo=nk.distance.DiameterAlgo.Exact)
+    diameter_run.run()
+    return {'diameter': [diameter_run.getDiameter()[0]]}
+
+
+def get_core_numbers(g):
+    cd = nk.centrality.CoreDecomposition(g)
+    cd.run()
+    return {'scores': numpy.array(cd.scores(), dtype=numpy.float64)}
+
 
 # pylint: disable=too-many-statements
 # pylint: disable=too-many-locals
@@ -105,6 +181,20 @@ def main():
                         required=False,
                         default=False)
 
+    parser.add_argument('--no-cache',
+                        help='do not read or save the results in ' \
+                             'masnet.analyze.cache',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--cache-size',
+                        help='max size of masnet.analyze.cache in MB ' \
+                             '(default: 1024)',
+                        type=int,
+                        required=False,
+                        default=1024)
+
     args = parser.parse_args()
     set_debug(args.debug)
     set_verbose(args.verbose)
@@ -113,70 +203,70 @@ def main():
 
     id2label = load_labels(get_path('mastodon.labels'))
     print('node labels loaded.')
-    start = time.time()
-    g = None
-    if args.directed:
-        print('reading directed graph into networkit...')
-        g = nk.readGraph(get_path('mastodon.networkit.directed'),
-                         nk.graphio.Format.NetworkitBinary)
-        if not g.isDirected():
-            print('mastodon.networkit.directed is undirected ?!')
-            sys.exit(-1)
-    else:
-        print('reading undirected graph into networkit...')
-        g = nk.readGraph(get_path('mastodon.networkit.undirected'),
-                        nk.graphio.Format.NetworkitBinary)
-        if g.isDirected():
-            print('mastodon.networkit.undirected is directed ?!')
-            sys.exit(-1)
-    print('graph read in %.1f seconds.' % (time.time() - start))
+    graph_file_name = ('mastodon.networkit.directed' if args.directed
+                       else 'mastodon.networkit.undirected')
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(get_path(RESULT_CACHE_DIR_NAME),
+                            get_path(graph_file_name),
+                            args.cache_size * 1024 * 1024)
+
+    # the graph is read only if it is needed, not if all results are cached
+    graph = []
+    def get_graph():
+        if len(graph) == 0:
+            graph.append(read_graph(args.directed))
+        return graph[0]
+
+    def cached(name, params, compute):
+        if cache is None:
+            return compute()
+        return cache.get_or_compute(name, params, compute)
 
     if args.card is not None:
 
         print('generating the network card...')
 
-        N = g.numberOfNodes()
-        L = g.numberOfEdges()
+        graph_result = cached('graph', {},
+                              lambda: get_degrees(get_graph()))
+        degrees = graph_result['degrees']
+        directed = bool(graph_result['directed'][0])
+        weighted = bool(graph_result['weighted'][0])
 
-        k_avg = 0
-        k_min = N-1
-        k_max = 0
-        for node_id in g.iterNodes():
-            k = g.degree(node_id)
-            if k < k_min:
-                k_min = k
-            if k > k_max:
-                k_max = k
-            k_avg = k_avg + k
-        k_avg = k_avg / N
+        N = len(degrees)
+        L = int(graph_result['links'][0])
+
+        k_avg = degrees.sum() / N
+        k_min = degrees.min()
+        k_max = degrees.max()
 
         component_sizes = None
         strongly_connected = False
         weakly_connected = False
 
-        if g.isDirected():
-            components_run = nk.components.StronglyConnectedComponents(g)
-            components_run.run()
-            component_sizes = components_run.getComponentSizes()
+        if directed:
+            component_sizes = cached('strongly-connected-components', {},
+                                     lambda: get_component_sizes(get_graph(),
+                                                                 'strongly'))['sizes']
             if len(component_sizes) == 1:
                 strongly_connected = True
             else:
-                components_run = nk.components.WeaklyConnectedComponents(g)
-                components_run.run()
-                component_sizes = components_run.getComponentSizes()
+                component_sizes = cached('weakly-connected-components', {},
+                                         lambda: get_component_sizes(get_graph(),
+                                                                     'weakly'))['sizes']
                 if len(component_sizes) == 1:
                     weakly_connected = True
         else:
-            components_run = nk.components.ConnectedComponents(g)
-            components_run.run()
-            component_sizes = components_run.getComponentSizes()
+            component_sizes = cached('connected-components', {},
+                                     lambda: get_component_sizes(get_graph(),
+                                                                 'connected'))['sizes']
 
         card = []
         card.append(['Name', 'Mastodon peers network'])
-        card.append(['Kind', '%s, %s' % ('directed' if g.isDirected() else 'undirected',
-                                         'weighted' if g.isWeighted() else 'unweighted')])
+        card.append(['Kind', '%s, %s' % ('directed' if directed else 'undirected',
+                                         'weighted' if weighted else 'unweighted')])
         card.append(['Nodes are', 'Mastodon instances'])
-        if g.isDirected():
+        if directed:
             card.append(['Links are', 'Peer relationship'])
         else:
             card.append(['Links are', 'Peer relationship (direction removed)'])
@@ -187,20 +277,21 @@ def main():
                                                    k_min,
                                                    k_max)])
 
-        if g.isDirected():
+        if directed:
             card.append(['Clustering', 'n/a'])
         else:
-            lcc_run = nk.centrality.LocalClusteringCoefficient(g,
-                                                               turbo=True)
-            lcc_run.run()
-            avg_clustering = sum(lcc_run.scores()) / N
+            lcc_scores = cached('local-clustering-coefficients',
+                                {'turbo': True},
+                                lambda: get_local_clustering_coefficients(get_graph()))['scores']
+            avg_clustering = lcc_scores.sum() / N
             card.append(['Clustering', '%.3f' % avg_clustering])
 
         if len(component_sizes) == 1:
 
-            if g.isDirected():
+            if directed:
                 if strongly_connected:
                     card.append(['Connected', 'Strongly connected'])
+                    g = get_graph()
                     apsp = nk.distance.APSP(g)
                     apsp.run()
                     diameter = 0
@@ -217,19 +308,17 @@ def main():
                     raise Exception('This should be unreachable !!!')
             else:
                 card.append(['Connected', 'Yes'])
-                diameter_run = nk.distance.Diameter(g,
-                                                    algo=nk.distance.DiameterAlgo.Exact)
-                diameter_run.run()
-                diameter = diameter_run.getDiameter()[0]
+                diameter = cached('diameter', {'algo': 'exact'},
+                                  lambda: get_diameter(get_graph()))['diameter'][0]
                 card.append(['Diameter', '%d' % diameter])
 
         else:
 
-            if g.isDirected():
+            if directed:
                 card.append(['Connected', 'Disconnected'])
                 card.append(['Diameter', 'n/a'])
             else:
-                comp_sizes = component_sizes.values()
+                comp_sizes = component_sizes
                 Nmaxcomp = max(comp_sizes)
                 card.append(['Connected',
                              '%d components [%.1f%% in largest]' % (len(component_sizes),
@@ -241,12 +330,8 @@ def main():
                                                                    Nmaxcomp)])
                 card.append(['Diameter', 'n/a'])
 
-                largest_component = components_run.extractLargestConnectedComponent(g,
-                                                                                    False)
-                diameter_run = nk.distance.Diameter(largest_component,
-                                                    algo=nk.distance.DiameterAlgo.Exact)
-                diameter_run.run()
-                diameter = diameter_run.getDiameter()[0]
+                diameter = cached('diameter', {'algo': 'exact'},
+                                  lambda: get_diameter(get_graph()))['diameter'][0]
                 card.append(['Largest component\'s diameter', '%d' % diameter])
 
         card.append(SEPARATING_LINE)
@@ -263,41 +348,44 @@ def main():
 
     elif args.strongly_connected_components:
 
-        scc = nk.components.StronglyConnectedComponents(g)
-        scc.run()
-        print('# of strongly connected components: %d' % scc.numberOfComponents())
-        print('component sizes: %s' % scc.getComponentSizes().values())
+        component_sizes = cached('strongly-connected-components', {},
+                                 lambda: get_component_sizes(get_graph(),
+                                                             'strongly'))['sizes']
+        print('# of strongly connected components: %d' % len(component_sizes))
+        print('component sizes: %s' % component_sizes.tolist())
 
     elif args.local_clustering_coefficients:
 
-        lcc = nk.centrality.LocalClusteringCoefficient(ug,
-                                                       turbo=True)
-        lcc.run()
-        ranks = lcc.ranking()[:100]
-        for rank in ranks:
-            domain = id2label[rank[0]]
-            local_clustering_coefficient = rank[1]
+        lcc_scores = cached('local-clustering-coefficients',
+                            {'turbo': True},
+                            lambda: get_local_clustering_coefficients(get_graph()))['scores']
+        # the highest first, as lcc.ranking()
+        ranks = numpy.argsort(-lcc_scores, kind='stable')[:100]
+        for node_id in ranks:
+            domain = id2label[int(node_id)]
+            local_clustering_coefficient = lcc_scores[node_id]
             print('%s %0.3f' % (domain, local_clustering_coefficient))
 
     elif args.cut_clusters:
 
+        g = get_graph()
         for alpha in [0, 0.25, 0.5, 0.75, 1]:
             cc = nk.community.CutClustering(g, alpha)
             cc.run()
 
     elif args.detect_communities:
 
+        g = get_graph()
         #cs = nk.community.detectCommunities(ug)
-        cs = nk.community.detectCommunities(ug,
-                                            algo=nk.community.PLM(ug, True))
+        cs = nk.community.detectCommunities(g,
+                                            algo=nk.community.PLM(g, True))
         print(cs.subsetSizes())
 
     elif args.degree_centrality:
 
-        dc = sorted(nk.centrality.DegreeCentrality(g,
-                                                   normalized=False,
-                                                   outDeg=True).run().scores(),
-                    reverse=True)
+        # the same as the scores of DegreeCentrality(g, normalized=False,
+        # outDeg=True)
+        dc = cached('graph', {}, lambda: get_degrees(get_graph()))['degrees']
 
         degrees, number_of_nodes = numpy.unique(dc, return_counts=True)
 
@@ -312,17 +400,13 @@ def main():
 
     elif args.core_decomposition:
 
-        cd = nk.centrality.CoreDecomposition(ug)
-        cd.run()
-        scores = cd.scores()
-        max_score = max(scores)
+        scores = cached('core-decomposition', {},
+                        lambda: get_core_numbers(get_graph()))['scores']
+        max_score = scores.max()
         print('max score: %s' % max_score)
-        snodes = list()
-        for node_id in g.iterNodes():
-            if scores[node_id] == max_score:
-                snodes.append(node_id)
+        snodes = numpy.flatnonzero(scores == max_score).tolist()
 
-        sg = nk.graphtools.subgraphFromNodes(ug, snodes)
+        sg = nk.graphtools.subgraphFromNodes(get_graph(), snodes)
         print(sg.numberOfNodes())
         print(sg.numberOfEdges())
         nk.writeGraph(sg,
@@ -330,6 +414,7 @@ def main():
                       nk.graphio.Format.GML)
 
     elif args.prune is not None:
+        g = get_graph()
         degrees = list()
         for node_id in g.iterNodes():
             kin = g.degreeIn(node_id)
@@ -0,0 +1,1100 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-function-docstring
+# pylint: disable=invalid-name
+# pylint: disable=global-statement
+# pylint: disable=bare-except,broad-except
+import argparse
+import asyncio
+import glob
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import aiohttp
+from aiohttp import web
+from tabulate import tabulate
+from masnet import get_version, set_verbose, set_debug, debug, set_working_dir
+from masnet import is_verbose
+from masnet import get_path, load_exclusion, get_excluded_patterns
+from masnet import ExclusionMatcher, get_peers_file_path
+from masnet import PeersStore, PEERS_FORMATS
+import masnet.convert
+import masnet.download
+import masnet.generate
+from masnet.download import ConcurrencyLimiter, adjust_concurrency
+
+
+def load_peers_corpus(limit):
+    corpus = []
+    for file_name in glob.glob(get_path('*.peers.json')):
+        with open(file_name, 'r') as f:
+            doc = json.load(f)
+        for peer in doc['peers']:
+            if peer is None:
+                continue
+            if len(peer.strip()) == 0:
+                continue
+            corpus.append(peer)
+        if limit is not None and len(corpus) >= limit:
+            return corpus[:limit]
+    return corpus
+
+
+def benchmark_exclusion(limit):
+    patterns = get_excluded_patterns()
+    corpus = load_peers_corpus(limit)
+    if len(corpus) == 0:
+        print('no peers found, run masnet.download first')
+        return
+    print('%d peers, %d distinct, %d patterns' % (len(corpus),
+                                                  len(set(corpus)),
+                                                  len(patterns)))
+
+    # the loop is_excluded used before ExclusionMatcher, as it shipped, it
+    # passes re.IGNORECASE as the start position of the search, so matching
+    # is case sensitive and the first two characters are skipped
+    start = time.process_time()
+    loop_verdicts = []
+    for peer in corpus:
+        excluded = False
+        for pattern in patterns:
+            if pattern.search(peer, re.IGNORECASE) is not None:
+                excluded = True
+                break
+        loop_verdicts.append(excluded)
+    loop_time = time.process_time() - start
+
+    start = time.process_time()
+    matcher = ExclusionMatcher(patterns)
+    build_time = time.process_time() - start
+    start = time.process_time()
+    matcher_verdicts = []
+    for peer in corpus:
+        matcher_verdicts.append(matcher.match(peer) is not None)
+    matcher_time = time.process_time() - start
+
+    start = time.process_time()
+    uncached_matcher = ExclusionMatcher(patterns)
+    for peer in corpus:
+        uncached_matcher.find(peer)
+    uncached_time = time.process_time() - start
+
+    # the loop without the bug, not timed, the matcher should be the same
+    fixed_patterns = [re.compile(p.pattern, re.IGNORECASE) for p in patterns]
+    mismatches = 0
+    for peer, verdict in zip(corpus, matcher_verdicts):
+        fixed_verdict = any(pattern.search(peer) is not None
+                            for pattern in fixed_patterns)
+        if fixed_verdict != verdict:
+            mismatches = mismatches + 1
+            debug('verdict mismatch: %s fixed loop:%s matcher:%s' % (peer,
+                                                                     fixed_verdict,
+                                                                     verdict))
+
+    # the domains excluded differently than before because of the bug fix
+    changed = {}
+    for peer, v1, v2 in zip(corpus, loop_verdicts, matcher_verdicts):
+        if v1 != v2:
+            changed[peer] = v2
+
+    rows = []
+    rows.append(['is_excluded loop', '%.3f' % loop_time,
+                 '%.0f' % (len(corpus) / loop_time), '1.0x'])
+    rows.append(['matcher (no cache)', '%.3f' % uncached_time,
+                 '%.0f' % (len(corpus) / uncached_time),
+                 '%.1fx' % (loop_time / uncached_time)])
+    rows.append(['matcher', '%.3f' % matcher_time,
+                 '%.0f' % (len(corpus) / matcher_time),
+                 '%.1fx' % (loop_time / matcher_time)])
+    print(tabulate(rows, headers=['', 'cpu (s)', 'lookups/s', 'speedup']))
+    print('matcher built in %.3f ms' % (build_time * 1000))
+    print('excluded: %d (before: %d), mismatches: %d' % (sum(matcher_verdicts),
+                                                         sum(loop_verdicts),
+                                                         mismatches))
+    print('%d distinct domains changed by the fix of is_excluded:' % len(changed))
+    rows = []
+    for peer, excluded in sorted(changed.items()):
+        rows.append([peer, 'excluded' if excluded else 'not excluded'])
+    if len(rows) > 0:
+        # all of them with -v
+        print(tabulate(rows if is_verbose() else rows[:20],
+                       headers=['domain', 'now']))
+
+
+# a server handling capacity requests at a time, each taking latency
+# seconds, the rest wait for their turn, so latency grows with concurrency
+# above capacity
+async def start_capacity_server(capacity, latency):
+    slots = asyncio.Semaphore(capacity)
+    async def handler(request):
+        async with slots:
+            await asyncio.sleep(latency)
+        return web.json_response([])
+    app = web.Application()
+    app.router.add_get('/api/v1/instance/peers', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    # pylint: disable=protected-access
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, port
+
+
+# pylint: disable=too-many-locals
+async def run_concurrency(capacity, duration, max_tasks):
+    latency = 0.05
+    timeout = aiohttp.ClientTimeout(total=20 * latency * max_tasks / capacity)
+    runner, port = await start_capacity_server(capacity, latency)
+    url = 'http://127.0.0.1:%d/api/v1/instance/peers' % port
+    limiter = ConcurrencyLimiter(10, 1, max_tasks)
+    samples = []
+    start = time.time()
+
+    async def client(session):
+        while True:
+            await limiter.acquire()
+            fetch_start = time.time()
+            timed_out = False
+            try:
+                async with session.get(url, timeout=timeout) as resp:
+                    await resp.read()
+            except asyncio.TimeoutError:
+                timed_out = True
+            limiter.release(time.time() - fetch_start, timed_out)
+
+    async def sample():
+        while True:
+            await asyncio.sleep(0.1)
+            samples.append((time.time() - start, limiter.limit))
+
+    conn = aiohttp.TCPConnector(limit=max_tasks)
+    async with aiohttp.ClientSession(connector=conn) as session:
+        tasks = [asyncio.create_task(client(session)) for _ in range(0, max_tasks)]
+        tasks.append(asyncio.create_task(adjust_concurrency(limiter, 0.2)))
+        tasks.append(asyncio.create_task(sample()))
+        await asyncio.sleep(duration)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await runner.cleanup()
+    return samples
+
+
+def benchmark_concurrency(capacity, duration, max_tasks):
+    print('server capacity: %d, max tasks: %d' % (capacity, max_tasks))
+    samples = asyncio.run(run_concurrency(capacity, duration, max_tasks))
+    rows = []
+    for i in range(0, len(samples), max(1, len(samples) // 10)):
+        rows.append(['%.1f' % samples[i][0], samples[i][1]])
+    print(tabulate(rows, headers=['t (s)', 'limit']))
+    # the second half is expected to oscillate around the capacity, up to
+    # where the queueing doubles the latency
+    limits = [limit for _, limit in samples[len(samples)//2:]]
+    mean = statistics.mean(limits)
+    print('second half limit: %.1f [%d, %d]' % (mean, min(limits), max(limits)))
+    if capacity / 2 <= mean <= 3 * capacity:
+        print('converged.')
+        return True
+    print('not converged !!!')
+    return False
+
+
+# a synthetic Mastodon network, host -> [kind, latency, peers]
+# kind is ok, timeout (never answers), error (HTTP 500) or malformed (invalid
+# JSON), out-degrees and the popularity of peers follow power laws, and the
+# peers also contain names that do not exist, half of them random
+# subdomains of swarm.example
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+def generate_fleet(num_nodes, degree, latency, timeouts, errors, malformed,
+                   dead, seed=0):
+    rnd = random.Random(seed)
+    hosts = ['n%d.example' % i for i in range(0, num_nodes)]
+    popularity = [rnd.paretovariate(1.2) for _ in hosts]
+    dead_names = []
+    for i in range(0, int(num_nodes * dead) + 1):
+        if i % 2 == 0:
+            dead_names.append('d%d.example' % i)
+        else:
+            dead_names.append('x%d.swarm.example' % i)
+    fleet = {}
+    for i, host in enumerate(hosts):
+        r = rnd.random()
+        if i == 0:
+            kind = 'ok'
+        elif r < timeouts:
+            kind = 'timeout'
+        elif r < timeouts + errors:
+            kind = 'error'
+        elif r < timeouts + errors + malformed:
+            kind = 'malformed'
+        else:
+            kind = 'ok'
+        k = min(num_nodes - 1, int(degree * rnd.paretovariate(1.5)))
+        peers = list(dict.fromkeys(rnd.choices(hosts, weights=popularity, k=k)))
+        peers.extend(rnd.sample(dead_names, min(len(dead_names),
+                                                int(len(peers) * dead))))
+        rnd.shuffle(peers)
+        fleet[host] = [kind, rnd.expovariate(1 / latency) if latency > 0 else 0,
+                       peers]
+    return fleet
+
+
+# the peers files download should save, the fleet crawled from start
+# peers are scheduled while they are parsed, so the peers of a malformed
+# response are crawled too, but it has no peers file
+def expected_peers(fleet, start):
+    expected = {}
+    visited = set([start])
+    frontier = [start]
+    while len(frontier) > 0:
+        host = frontier.pop()
+        kind, _, peers = fleet[host]
+        if kind not in ('ok', 'malformed'):
+            continue
+        if kind == 'ok':
+            expected[host] = peers
+        for peer in peers:
+            if peer in fleet and peer not in visited:
+                visited.add(peer)
+                frontier.append(peer)
+    return expected
+
+
+# answers A queries of the fleet with 127.0.0.1, everything else does not
+# exist
+class FleetDNS(asyncio.DatagramProtocol):
+
+    def __init__(self, names):
+        self.names = names
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        tid = struct.unpack('>H', data[:2])[0]
+        i = 12
+        labels = []
+        while data[i] != 0:
+            labels.append(data[i+1:i+1+data[i]].decode('ascii', 'replace'))
+            i = i + 1 + data[i]
+        qtype = struct.unpack('>H', data[i+1:i+3])[0]
+        question = data[12:i+5]
+        name = '.'.join(labels).lower()
+        if name not in self.names:
+            # NXDOMAIN
+            header = struct.pack('>HHHHHH', tid, 0x8183, 1, 0, 0, 0)
+            self.transport.sendto(header + question, addr)
+        elif qtype != 1:
+            # no AAAA etc.
+            header = struct.pack('>HHHHHH', tid, 0x8180, 1, 0, 0, 0)
+            self.transport.sendto(header + question, addr)
+        else:
+            header = struct.pack('>HHHHHH', tid, 0x8180, 1, 1, 0, 0)
+            answer = b'\xc0\x0c' + struct.pack('>HHIH', 1, 1, 300, 4) + bytes([127, 0, 0, 1])
+            self.transport.sendto(header + question + answer, addr)
+
+
+async def start_fleet(fleet):
+    async def handler(request):
+        host = request.host.split(':')[0]
+        if host not in fleet:
+            return web.Response(status=404)
+        kind, latency, peers = fleet[host]
+        await asyncio.sleep(latency)
+        if kind == 'timeout':
+            await asyncio.sleep(3600)
+        if kind == 'error':
+            return web.Response(status=500)
+        if kind == 'malformed':
+            return web.Response(text=json.dumps(peers)[:-1],
+                                content_type='application/json')
+        # half of the hosts answer conditional requests, the others are
+        # found unchanged by the hash of their peers
+        if zlib.crc32(host.encode('utf-8')) % 2 == 0:
+            text = json.dumps(peers)
+            etag = '"%08x"' % zlib.crc32(text.encode('utf-8'))
+            if request.headers.get('If-None-Match') == etag:
+                return web.Response(status=304, headers={'ETag': etag})
+            return web.Response(text=text,
+                                content_type='application/json',
+                                headers={'ETag': etag})
+        return web.json_response(peers)
+    app = web.Application()
+    app.router.add_get('/api/v1/instance/peers', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0, backlog=4096)
+    await site.start()
+    # pylint: disable=protected-access
+    http_port = site._server.sockets[0].getsockname()[1]
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: FleetDNS(set(fleet)), local_addr=('127.0.0.1', 0))
+    dns_port = transport.get_extra_info('sockname')[1]
+    return runner, http_port, dns_port
+
+
+# runs in a separate process, so its cpu time is not counted for download
+def serve_fleet(fleet, conn):
+    async def serve():
+        _, http_port, dns_port = await start_fleet(fleet)
+        conn.send((http_port, dns_port))
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+def check_peers_files(expected, peers_format='files'):
+    missing = 0
+    different = 0
+    store = PeersStore() if peers_format == 'segments' else None
+    for host, peers in expected.items():
+        if store is None:
+            try:
+                with open(get_peers_file_path(host), 'r') as f:
+                    doc = json.load(f)
+            except FileNotFoundError:
+                doc = None
+        else:
+            text = store.read(host)
+            doc = None if text is None else json.loads(text)
+        if doc is None:
+            missing = missing + 1
+            debug('missing: %s' % host)
+            continue
+        if doc['domain'] != host or doc['peers'] != peers:
+            different = different + 1
+            debug('different: %s' % host)
+    if store is None:
+        num_saved = len(glob.glob(get_path('*.peers.json')))
+    else:
+        num_saved = len(store)
+    unexpected = num_saved - len(expected) + missing
+    return missing, different, unexpected
+
+
+# seconds until the fractions of the reachable hosts are fetched, the number
+# of hosts fetched is polled while download runs
+CRAWL_PROGRESS_FRACTIONS = (0.5, 0.9)
+
+
+def watch_crawl(num_expected, start, progress, done):
+    while not done.wait(0.05):
+        for fraction in CRAWL_PROGRESS_FRACTIONS:
+            if (fraction not in progress and
+                    masnet.download.num_nodes >= fraction * num_expected):
+                progress[fraction] = time.time() - start
+
+
+def run_crawl(args, kwargs):
+    if args.workers is None:
+        asyncio.run(masnet.download.download(**kwargs))
+    else:
+        config = {'dir': get_path(None),
+                  'debug': args.debug,
+                  'verbose': args.verbose,
+                  'exclude_file': None,
+                  'peers_url': masnet.download.PEERS_URL}
+        masnet.download.download_workers(args.workers, config, kwargs)
+
+
+# pylint: disable=too-many-locals
+def benchmark_crawl(args):
+    fleet = generate_fleet(args.nodes, args.degree, args.latency,
+                           args.timeouts, args.errors, args.malformed,
+                           args.dead, seed=args.seed)
+    start_domain = 'n0.example'
+    expected = expected_peers(fleet, start_domain)
+    print('fleet: %d hosts, %d links, %d reachable' % (len(fleet),
+                                                        sum(len(v[2]) for v in fleet.values()),
+                                                        len(expected)))
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve_fleet,
+                                     args=(fleet, child_conn),
+                                     daemon=True)
+    server.start()
+    http_port, dns_port = parent_conn.recv()
+    masnet.download.PEERS_URL = 'http://%%s:%d/api/v1/instance/peers' % http_port
+    load_exclusion(None)
+    try:
+        kwargs = {'start_domain': start_domain,
+                  'timeout': args.timeout,
+                  'num_tasks': args.num_tasks,
+                  'resume': False,
+                  'max_tasks': args.max_tasks,
+                  'nameservers': ['127.0.0.1:%d' % dns_port],
+                  'max_attempts': args.max_attempts,
+                  'retry_delay': args.retry_delay,
+                  'peers_format': args.peers_format,
+                  'failed_timeout': args.failed_timeout}
+        if args.graph:
+            kwargs['graph'] = True
+        if args.prior is not None:
+            kwargs['prior'] = masnet.download.load_prior(args.prior)
+            kwargs['seed_prior'] = args.seed_prior
+        masnet.download.reset_files(False)
+        if args.recrawl:
+            # the peers and the validators saved by the first crawl are
+            # used by the second one, which is measured
+            print('first crawl...')
+            run_crawl(args, kwargs)
+            masnet.download.reset_files(True)
+            kwargs['recrawl'] = True
+            print('recrawl...')
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        start_children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        progress = {}
+        done = threading.Event()
+        watcher = threading.Thread(target=watch_crawl,
+                                   args=(len(expected), start, progress, done),
+                                   daemon=True)
+        watcher.start()
+        run_crawl(args, kwargs)
+        wall_time = time.time() - start
+        done.set()
+        watcher.join()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # the worker processes, the server is still running
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        server.terminate()
+    cpu_time = (usage.ru_utime - start_usage.ru_utime +
+                usage.ru_stime - start_usage.ru_stime +
+                children_usage.ru_utime - start_children_usage.ru_utime +
+                children_usage.ru_stime - start_children_usage.ru_stime)
+    missing, different, unexpected = check_peers_files(expected, args.peers_format)
+    results = {'nodes': masnet.download.num_nodes,
+               'wall_time': wall_time,
+               'cpu_time': cpu_time,
+               'domains_per_second': masnet.download.num_nodes / wall_time,
+               'unchanged': masnet.download.num_unchanged,
+               'time_to_50pct': progress.get(0.5),
+               'time_to_90pct': progress.get(0.9),
+               # ru_maxrss is in kilobytes on Linux
+               # with --workers, of the largest worker
+               'peak_rss_mb': max(usage.ru_maxrss, children_usage.ru_maxrss) / 1024,
+               'missing': missing,
+               'different': different,
+               'unexpected': unexpected}
+    graph_correct = True
+    if args.graph:
+        # the graph built while crawling, and the graph masnet.generate
+        # creates from the peers files after the crawl
+        graph_edges = read_graph_edges()
+        generate_result = run_generate(args)
+        graph_correct = (generate_result is not None and
+                         graph_edges == read_graph_edges())
+        results['generate_seconds'] = (None if generate_result is None
+                                       else generate_result['seconds'])
+        results['graph_correct'] = graph_correct
+    print(tabulate([[k, v] for k, v in results.items()]))
+    if args.results is not None:
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=2)
+    if missing + different + unexpected > 0:
+        print('peers files are not correct !!!')
+        return False
+    print('peers files are correct.')
+    if not graph_correct:
+        print('graph is not the same as masnet.generate creates !!!')
+        return False
+    return True
+
+
+# the links of the directed and the undirected graphs saved, as pairs of
+# labels, so the graphs can be compared when the node ids are different
+def read_graph_edges():
+    import networkit as nk
+    with open(get_path('mastodon.labels'), 'r') as f:
+        labels = f.read().splitlines()
+    edges = []
+    for kind in ['directed', 'undirected']:
+        g = nk.readGraph(get_path('mastodon.networkit.%s' % kind),
+                         nk.Format.NetworkitBinary)
+        if g.isDirected():
+            edges.append(set((labels[u], labels[v])
+                             for u, v in g.iterEdges()))
+        else:
+            edges.append(set(tuple(sorted((labels[u], labels[v])))
+                             for u, v in g.iterEdges()))
+    return edges
+
+
+# num_files peers.json files of hosts with power law distributed peers, also
+# with names without a file, None and empty names and self-loops like in
+# the real data
+def generate_corpus(num_files, degree, seed=0):
+    rnd = random.Random(seed)
+    hosts = ['n%d.example' % i for i in range(0, num_files)]
+    popularity = [rnd.paretovariate(1.2) for _ in hosts]
+    num_links = 0
+    for i, host in enumerate(hosts):
+        k = min(num_files - 1, int(degree * rnd.paretovariate(1.5)))
+        peers = rnd.choices(hosts, weights=popularity, k=k)
+        peers.extend('u%d.example' % rnd.randrange(0, num_files * 10)
+                     for _ in range(0, k // 2))
+        if i % 100 == 0:
+            peers.extend([None, '', ' ', host])
+        rnd.shuffle(peers)
+        num_links = num_links + len(peers)
+        with open(get_peers_file_path(host), 'w') as f:
+            json.dump({'domain': host, 'peers': peers}, f)
+    return num_links
+
+
+def benchmark_generate(args):
+    print('generating %d peers files...' % args.files)
+    num_peers = generate_corpus(args.files, args.degree, seed=args.seed)
+    print('%d peers' % num_peers)
+    if args.peers_format == 'segments':
+        masnet.convert.to_segments(True, force=True)
+    rows = []
+    first = None
+    correct = True
+    for num_jobs in sorted(set([1, args.jobs])):
+        start = time.time()
+        result = masnet.generate.read_peers(args.peers_format, num_jobs)
+        elapsed = time.time() - start
+        if first is None:
+            first = result
+        elif result != first:
+            correct = False
+        rows.append([num_jobs, len(result[0]), len(result[1]), elapsed])
+    print(tabulate(rows, headers=['jobs', 'nodes', 'links', 'seconds']))
+    print('running masnet.generate...')
+    generate_result = run_generate(args)
+    if generate_result is None:
+        print('masnet.generate failed !!!')
+        return False
+    print(tabulate([generate_result.values()],
+                   headers=generate_result.keys()))
+    if args.results is not None:
+        with open(args.results, 'w') as f:
+            json.dump({'read_peers': [dict(zip(['jobs', 'nodes', 'links',
+                                                'seconds'], row))
+                                      for row in rows],
+                       'generate': generate_result}, f, indent=2)
+    if not correct:
+        print('nodes or links are different !!!')
+        return False
+    print('nodes and links are the same.')
+    return True
+
+
+# runs a command in a new process, so its cpu time and peak memory are
+# measured alone, and returns the output, the exit code, the wall time, the
+# cpu time and the peak memory
+def run_measured(argv):
+    env = dict(os.environ)
+    # masnet.analyze imports matplotlib.pyplot, there is no display
+    env['MPLBACKEND'] = 'Agg'
+    start = time.time()
+    p = subprocess.Popen(argv,
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.PIPE,
+                         cwd=get_path(None),
+                         env=env,
+                         text=True)
+    output = p.stdout.read()
+    p.stdout.close()
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.time() - start
+    return output, p.returncode, {'seconds': elapsed,
+                                  'cpu_seconds': usage.ru_utime + usage.ru_stime,
+                                  # ru_maxrss is in kilobytes on Linux
+                                  'peak_rss_mb': usage.ru_maxrss / 1024}
+
+
+# runs masnet.generate with -j in a new process and returns the number of
+# links, the wall time and the peak memory
+def run_generate(args):
+    output, returncode, usage = run_measured([sys.executable, '-m', 'masnet.generate',
+                                              '-d', get_path(None),
+                                              '--peers-format', args.peers_format,
+                                              '-j', str(args.jobs)])
+    if returncode != 0:
+        return None
+    # the number of links from the last status line
+    links = int(re.findall(r'L:(\d+)', output)[-1])
+    return {'jobs': args.jobs,
+            'links': links,
+            'seconds': usage['seconds'],
+            'peak_rss_mb': usage['peak_rss_mb']}
+
+
+# the masnet.analyze modes run by --suite, the ones drawing plots or taking
+# hours on a large graph (--degree-centrality, --cut-clusters) are not
+SUITE_ANALYZE_MODES = {
+    'card': ['--card'],
+    'card-directed': ['--card', '--directed'],
+    'strongly-connected-components': ['--strongly-connected-components',
+                                      '--directed'],
+    'local-clustering-coefficients': ['--local-clustering-coefficients'],
+    'core-decomposition': ['--core-decomposition'],
+    'detect-communities': ['--detect-communities'],
+    'prune': ['--prune', 'out-degree', '--directed'],
+}
+
+# the differences smaller than these are not regressions, to ignore noise
+COMPARE_MIN_SECONDS = 0.5
+COMPARE_MIN_MB = 10
+
+
+# a scale is NODES:DEGREE, like 10000:100, the number of peers files and
+# the --degree of the corpus
+def scales_type(value):
+    scales = []
+    for scale in value.split(','):
+        try:
+            nodes, degree = scale.split(':')
+            scales.append((int(nodes), int(degree)))
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(
+                'invalid scale: %s (NODES:DEGREE)' % scale) from e
+    return scales
+
+
+def modes_type(value):
+    modes = value.split(',')
+    for mode in modes:
+        if mode not in SUITE_ANALYZE_MODES:
+            raise argparse.ArgumentTypeError('invalid mode: %s' % mode)
+    return modes
+
+
+# writes a synthetic corpus for each scale to a directory of its own, and
+# runs masnet.generate and each masnet.analyze mode on it, each in a new
+# process, recording the wall time, cpu time and peak memory of each phase
+# the directory of a scale is removed after it unless keep
+# pylint: disable=too-many-locals
+def benchmark_suite(args, keep):
+    base_dir = get_path(None)
+    results = {'version': get_version(),
+               'python': sys.version.split()[0],
+               'cpus': os.cpu_count(),
+               'jobs': args.jobs,
+               'seed': args.seed,
+               'scales': []}
+    ok = True
+    rows = []
+    for nodes, degree in args.scales:
+        name = '%d:%d' % (nodes, degree)
+        set_working_dir(os.path.join(base_dir, 'scale-%d-%d' % (nodes, degree)))
+        print('%s: generating %d peers files...' % (name, nodes))
+        start = time.time()
+        num_peers = generate_corpus(nodes, degree, seed=args.seed)
+        corpus_seconds = time.time() - start
+        if args.peers_format == 'segments':
+            masnet.convert.to_segments(True, force=True)
+        scale = {'nodes': nodes,
+                 'degree': degree,
+                 'peers': num_peers,
+                 'corpus_seconds': corpus_seconds,
+                 'phases': {}}
+        phases = [('generate', [sys.executable, '-m', 'masnet.generate',
+                                '-d', get_path(None),
+                                '--peers-format', args.peers_format,
+                                '-j', str(args.jobs)])]
+        # without the cache, otherwise the analyses after the first one
+        # would only read the results of the earlier ones
+        for mode in args.modes:
+            phases.append(('analyze:%s' % mode,
+                           [sys.executable, '-m', 'masnet.analyze',
+                            '-d', get_path(None), '--no-cache'] +
+                           SUITE_ANALYZE_MODES[mode]))
+        for phase, argv in phases:
+            print('%s: %s...' % (name, phase))
+            output, returncode, usage = run_measured(argv)
+            usage['failed'] = returncode != 0
+            if phase == 'generate' and returncode == 0:
+                usage['links'] = int(re.findall(r'L:(\d+)', output)[-1])
+            scale['phases'][phase] = usage
+            rows.append([name, phase, '%.2f' % usage['seconds'],
+                         '%.2f' % usage['cpu_seconds'],
+                         '%.1f' % usage['peak_rss_mb'],
+                         'FAILED' if usage['failed'] else ''])
+            if usage['failed']:
+                ok = False
+                # the analyses need the graph
+                if phase == 'generate':
+                    break
+        results['scales'].append(scale)
+        if not keep:
+            shutil.rmtree(get_path(None))
+    set_working_dir(base_dir)
+    print(tabulate(rows, headers=['scale', 'phase', 'wall (s)', 'cpu (s)',
+                                  'peak (MB)', '']))
+    if args.results is not None:
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not ok:
+        print('some phases failed !!!')
+    return ok
+
+
+def load_suite_results(file_name):
+    with open(file_name, 'r') as f:
+        results = json.load(f)
+    phases = {}
+    for scale in results['scales']:
+        for phase, usage in scale['phases'].items():
+            phases[('%d:%d' % (scale['nodes'], scale['degree']), phase)] = usage
+    return phases
+
+
+# compares two --suite results files, a phase is a regression if its wall
+# time, cpu time or peak memory is more than threshold (a fraction) higher,
+# or if it failed in the new one but not in the old one
+def compare_suite(old_file, new_file, threshold):
+    old = load_suite_results(old_file)
+    new = load_suite_results(new_file)
+    rows = []
+    regressions = 0
+    for key, new_usage in new.items():
+        old_usage = old.get(key)
+        if old_usage is None:
+            continue
+        flags = []
+        if new_usage['failed'] and not old_usage['failed']:
+            flags.append('failed')
+        for metric, min_diff in [('seconds', COMPARE_MIN_SECONDS),
+                                 ('cpu_seconds', COMPARE_MIN_SECONDS),
+                                 ('peak_rss_mb', COMPARE_MIN_MB)]:
+            diff = new_usage[metric] - old_usage[metric]
+            if diff > min_diff and diff > threshold * old_usage[metric]:
+                flags.append(metric)
+        if len(flags) > 0:
+            regressions = regressions + 1
+        row = [key[0], key[1]]
+        for metric in ['seconds', 'cpu_seconds', 'peak_rss_mb']:
+            row.append('%.2f -> %.2f' % (old_usage[metric], new_usage[metric]))
+        row.append(','.join(flags))
+        rows.append(row)
+    print(tabulate(rows, headers=['scale', 'phase', 'wall (s)', 'cpu (s)',
+                                  'peak (MB)', 'regression']))
+    missing = set(old) - set(new)
+    if len(missing) > 0:
+        print('not in %s: %s' % (new_file,
+                                 ', '.join('%s %s' % k for k in sorted(missing))))
+    if regressions > 0:
+        print('%d regressions !!!' % regressions)
+        return False
+    print('no regressions.')
+    return True
+
+
+def main():
+    print('masnet v%s' % get_version())
+    parser = argparse.ArgumentParser(prog='masnet.benchmark',
+                                     description='',
+                                     epilog='')
+
+    parser.add_argument('-d', '--dir',
+                        help='use specified directory for files ' \
+                             '(default: current directory)',
+                        required=False)
+
+    parser.add_argument('--debug',
+                        help='enables debug logging',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('-v', '--verbose',
+                        help='enable verbose logging, mostly for development',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('-e', '--exclude-file',
+                        help='use the exclusion patterns in the file specified',
+                        required=False)
+
+    parser.add_argument('--exclusion',
+                        help='benchmark is_excluded on the peers in ' \
+                             '<domain>.peers.json files',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--concurrency',
+                        help='run the -n auto concurrency limiter against a ' \
+                             'local server and check if it converges',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--capacity',
+                        help='number of requests the local server handles ' \
+                             'at a time (default: 50)',
+                        type=int,
+                        required=False,
+                        default=50)
+
+    parser.add_argument('--duration',
+                        help='duration in seconds (default: 30)',
+                        type=int,
+                        required=False,
+                        default=30)
+
+    parser.add_argument('--max-tasks',
+                        help='maximum number of tasks (default: 1000)',
+                        type=int,
+                        required=False,
+                        default=1000)
+
+    parser.add_argument('--crawl',
+                        help='run masnet.download against a local simulated ' \
+                             'network and check the peers files',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--generate',
+                        help='read a synthetic corpus of peers files with ' \
+                             'masnet.generate, with 1 and -j processes',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--suite',
+                        help='run masnet.generate and masnet.analyze on ' \
+                             'synthetic corpora of --scales, and record the ' \
+                             'wall time, cpu time and peak memory of each',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--scales',
+                        help='comma separated NODES:DEGREE of the --suite ' \
+                             'corpora (default: 1000:10,10000:100,50000:200)',
+                        type=scales_type,
+                        required=False,
+                        default=scales_type('1000:10,10000:100,50000:200'))
+
+    parser.add_argument('--modes',
+                        help='comma separated masnet.analyze modes of --suite ' \
+                             '(default: %s)' % ','.join(SUITE_ANALYZE_MODES),
+                        type=modes_type,
+                        required=False,
+                        default=list(SUITE_ANALYZE_MODES))
+
+    parser.add_argument('--compare',
+                        help='compare two --suite results files and exit ' \
+                             'with an error if there are regressions',
+                        nargs=2,
+                        metavar=('OLD', 'NEW'),
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--threshold',
+                        help='fraction a phase can be slower or use more ' \
+                             'memory in --compare (default: 0.1)',
+                        type=float,
+                        required=False,
+                        default=0.1)
+
+    parser.add_argument('--files',
+                        help='number of peers files of the synthetic corpus ' \
+                             '(default: 14000)',
+                        type=int,
+                        required=False,
+                        default=14000)
+
+    parser.add_argument('-j', '--jobs',
+                        help='number of processes for masnet.generate ' \
+                             '(default: number of CPUs)',
+                        type=int,
+                        required=False,
+                        default=os.cpu_count())
+
+    parser.add_argument('--nodes',
+                        help='number of hosts in the simulated network ' \
+                             '(default: 2000)',
+                        type=int,
+                        required=False,
+                        default=2000)
+
+    parser.add_argument('--degree',
+                        help='minimum number of peers of a host, the ' \
+                             'average is about 3 times (default: 10)',
+                        type=int,
+                        required=False,
+                        default=10)
+
+    parser.add_argument('--seed',
+                        help='random seed of the simulated network (default: 0)',
+                        type=int,
+                        required=False,
+                        default=0)
+
+    parser.add_argument('--latency',
+                        help='average latency of a host in seconds ' \
+                             '(default: 0.05)',
+                        type=float,
+                        required=False,
+                        default=0.05)
+
+    parser.add_argument('--timeouts',
+                        help='fraction of hosts never answering (default: 0.01)',
+                        type=float,
+                        required=False,
+                        default=0.01)
+
+    parser.add_argument('--errors',
+                        help='fraction of hosts answering with HTTP 500 ' \
+                             '(default: 0.05)',
+                        type=float,
+                        required=False,
+                        default=0.05)
+
+    parser.add_argument('--malformed',
+                        help='fraction of hosts answering with invalid JSON ' \
+                             '(default: 0.01)',
+                        type=float,
+                        required=False,
+                        default=0.01)
+
+    parser.add_argument('--dead',
+                        help='number of names that do not exist, relative to ' \
+                             'the number of hosts and the peers (default: 0.5)',
+                        type=float,
+                        required=False,
+                        default=0.5)
+
+    parser.add_argument('-n', '--num-tasks',
+                        help='number of tasks for download, or auto (default: 100)',
+                        type=masnet.download.num_tasks_type,
+                        required=False,
+                        default=100)
+
+    parser.add_argument('-t', '--timeout',
+                        help='timeout in seconds for download (default: 2)',
+                        type=int,
+                        required=False,
+                        default=2)
+
+    parser.add_argument('--max-attempts',
+                        help='max attempts for download (default: 3)',
+                        type=int,
+                        required=False,
+                        default=3)
+
+    parser.add_argument('--retry-delay',
+                        help='retry delay in seconds for download (default: 1)',
+                        type=int,
+                        required=False,
+                        default=1)
+
+    parser.add_argument('--workers',
+                        help='number of worker processes for download ' \
+                             '(default: a single process)',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--peers-format',
+                        help='peers format for download (default: files)',
+                        choices=PEERS_FORMATS,
+                        required=False,
+                        default='files')
+
+    parser.add_argument('--prior',
+                        help='directory of a previous crawl for download ' \
+                             '(default: none)',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--seed-prior',
+                        help='schedule the hosts visited by the --prior ' \
+                             'crawl at the start',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--failed-timeout',
+                        help='timeout in seconds for download of the hosts ' \
+                             'failed in the --prior crawl (default: same as -t)',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--graph',
+                        help='build the graph while crawling, and compare it ' \
+                             'with the graph masnet.generate creates after ' \
+                             'the crawl',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--recrawl',
+                        help='crawl twice, and measure the second crawl ' \
+                             'with --recrawl',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--results',
+                        help='save the results as JSON to the file specified',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--limit',
+                        help='use at most specified number of peers',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    args = parser.parse_args()
+    set_debug(args.debug)
+    set_verbose(args.verbose)
+    debug(str(args))
+    temp_dir = None
+    if (args.crawl or args.generate or args.suite) and args.dir is None:
+        temp_dir = tempfile.mkdtemp(prefix='masnet.benchmark.')
+        args.dir = temp_dir
+    set_working_dir(args.dir)
+
+    if args.compare is not None:
+        if not compare_suite(args.compare[0], args.compare[1], args.threshold):
+            sys.exit(1)
+    elif args.crawl or args.generate or args.suite:
+        try:
+            if args.crawl:
+                ok = benchmark_crawl(args)
+            elif args.suite:
+                ok = benchmark_suite(args, temp_dir is None)
+            else:
+                ok = benchmark_generate(args)
+            if not ok:
+                sys.exit(1)
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir)
+    elif args.exclusion:
+        load_exclusion(args.exclude_file)
+        benchmark_exclusion(args.limit)
+    elif args.concurrency:
+        if not benchmark_concurrency(args.capacity, args.duration,
+                                     args.max_tasks):
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
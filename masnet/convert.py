@@ -0,0 +1,170 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-function-docstring
+# pylint: disable=invalid-name
+# pylint: disable=global-statement
+# pylint: disable=bare-except,broad-except
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from masnet import get_version, set_verbose, set_debug, set_working_dir
+from masnet import debug, get_path, get_peers_file_path
+from masnet import PeersStore, PEERS_SEGMENT_FILE_NAME, PEERS_INDEX_FILE_NAME
+
+
+def print_status(num_files, num_bytes, start):
+    elapsed = time.time() - start
+    print('files:%08d bytes:%012d t:%.1f' % (num_files, num_bytes, elapsed),
+          flush=True)
+
+
+# <domain>.peers.json files -> masnet.peers.*.segment files
+# the existing segments are replaced only if force, returns False if nothing
+# is converted
+def to_segments(remove, force=False):
+    file_names = glob.glob(get_path('*.peers.json'))
+    if len(file_names) == 0:
+        print('no peers.json files found.')
+        return False
+    if not force and (len(PeersStore.get_segments()) > 0 or
+                      len(glob.glob(get_path('%s*' % PEERS_INDEX_FILE_NAME))) > 0):
+        print('segments already exist, use --force to replace them.')
+        return False
+    PeersStore.remove()
+    store = PeersStore()
+    store.open()
+    start = time.time()
+    last_status = start
+    num_files = 0
+    num_bytes = 0
+    try:
+        for file_name in file_names:
+            if (time.time() - last_status) > 1:
+                print_status(num_files, num_bytes, start)
+                last_status = time.time()
+            with open(file_name, 'r') as f:
+                text = f.read()
+            # the file name of a domain with / is not the domain
+            domain = json.loads(text)['domain']
+            store.append(domain, text)
+            num_files = num_files + 1
+            num_bytes = num_bytes + len(text)
+    finally:
+        store.close()
+    print_status(num_files, num_bytes, start)
+    segments = PeersStore.get_segments()
+    segments_size = 0
+    for segment in segments:
+        segments_size = segments_size + os.path.getsize(get_path(PEERS_SEGMENT_FILE_NAME % segment))
+    print('%d files converted to %d segments, %d bytes -> %d bytes.' % (num_files,
+                                                                        len(segments),
+                                                                        num_bytes,
+                                                                        segments_size))
+    if remove:
+        for file_name in file_names:
+            os.remove(file_name)
+        print('peers.json files removed.')
+    return True
+
+
+# masnet.peers.*.segment files -> <domain>.peers.json files
+# the existing peers.json files are overwritten only if force, returns False
+# if nothing is converted
+def to_files(remove, force=False):
+    store = PeersStore()
+    if len(store) == 0:
+        print('no segments found.')
+        return False
+    if not force:
+        existing = sum(1 for domain in store.index
+                       if os.path.exists(get_peers_file_path(domain)))
+        if existing > 0:
+            print('%d peers.json files already exist, use --force to ' \
+                  'overwrite them.' % existing)
+            return False
+    start = time.time()
+    last_status = start
+    num_files = 0
+    num_bytes = 0
+    for domain, text in store:
+        if (time.time() - last_status) > 1:
+            print_status(num_files, num_bytes, start)
+            last_status = time.time()
+        with open(get_peers_file_path(domain), 'w') as f:
+            f.write(text)
+        num_files = num_files + 1
+        num_bytes = num_bytes + len(text)
+    print_status(num_files, num_bytes, start)
+    print('%d files written.' % num_files)
+    if remove:
+        PeersStore.remove()
+        print('segments removed.')
+    return True
+
+
+def main():
+    print('masnet v%s' % get_version())
+    parser = argparse.ArgumentParser(prog='masnet.convert',
+                                     description='converts the peers saved by ' \
+                                                 'masnet.download between ' \
+                                                 '--peers-format files and segments',
+                                     epilog='')
+
+    parser.add_argument('-d', '--dir',
+                        help='use specified directory for files ' \
+                             '(default: current directory)',
+                        required=False)
+
+    parser.add_argument('--debug',
+                        help='enables debug logging',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('-v', '--verbose',
+                        help='enable verbose logging, mostly for development',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--to-files',
+                        help='convert masnet.peers.*.segment files to ' \
+                             '<domain>.peers.json files (default: the opposite)',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--remove',
+                        help='remove the converted files',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--force',
+                        help='replace the existing segments, or overwrite ' \
+                             'the existing <domain>.peers.json files with ' \
+                             '--to-files',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    args = parser.parse_args()
+    set_debug(args.debug)
+    set_verbose(args.verbose)
+    debug(str(args))
+    set_working_dir(args.dir)
+
+    if args.to_files:
+        converted = to_files(args.remove, args.force)
+    else:
+        converted = to_segments(args.remove, args.force)
+    if not converted:
+        sys.exit(1)
+
+    print('bye.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-function-docstring
+# pylint: disable=invalid-name
+import argparse
+import itertools
+import json
+import os
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+import numpy
+from tabulate import tabulate
+from masnet import get_version, set_verbose, set_debug, set_working_dir
+from masnet import debug, get_path, percent_progress
+from masnet import save_labels, load_labels, load_links_csr
+
+
+DIFF_SUMMARY_FILE_NAME = 'masnet.diff.json'
+DIFF_LABELS_FILE_NAME = 'masnet.diff.labels'
+DIFF_ADDED_NODES_FILE_NAME = 'masnet.diff.nodes.added'
+DIFF_REMOVED_NODES_FILE_NAME = 'masnet.diff.nodes.removed'
+DIFF_ADDED_LINKS_FILE_NAME = 'masnet.diff.links.added'
+DIFF_REMOVED_LINKS_FILE_NAME = 'masnet.diff.links.removed'
+# the links of the old and the new snapshots compared at a time
+DIFF_BLOCK_LINKS = 1 << 22
+DIFF_TOP_NODES = 10
+
+
+# returns the links (offsets, targets) of the snapshot in the directory
+# from mastodon.links, or, for the snapshots without it (or with an older
+# one), from the directed graph
+def load_snapshot_links(snapshot_dir):
+    links_path = os.path.join(snapshot_dir, 'mastodon.links')
+    graph_path = os.path.join(snapshot_dir, 'mastodon.networkit.directed')
+    if (os.path.exists(links_path) and
+            (not os.path.exists(graph_path) or
+             os.path.getmtime(links_path) >= os.path.getmtime(graph_path))):
+        return load_links_csr(links_path)
+    # pylint: disable=import-outside-toplevel
+    import networkit as nk
+    from masnet.generate import build_csr
+    print('mastodon.links not found in %s, reading the graph...' % snapshot_dir)
+    g = nk.readGraph(graph_path, nk.Format.NetworkitBinary)
+    edges = numpy.fromiter(itertools.chain.from_iterable(g.iterEdges()),
+                           dtype=numpy.int32,
+                           count=2 * g.numberOfEdges())
+    num_nodes = g.numberOfNodes()
+    del g
+    return build_csr(num_nodes,
+                     numpy.ascontiguousarray(edges[0::2]),
+                     numpy.ascontiguousarray(edges[1::2]))
+
+
+# the labels of both snapshots are joined, a node of the new snapshot has
+# the id of the same label in the old snapshot, and the labels only in the
+# new snapshot are added after the old labels in the order of their ids
+# returns the number of nodes of the diff, the diff id of each new node and
+# whether each old node is in the new snapshot
+def align_labels(old_labels, new_labels):
+    old_ids = {old_labels.encoded(node_id): node_id
+               for node_id in range(0, len(old_labels))}
+    new2diff = numpy.empty(len(new_labels), dtype=numpy.int64)
+    kept = numpy.zeros(len(old_labels), dtype=bool)
+    num_nodes = len(old_labels)
+    for node_id in range(0, len(new_labels)):
+        old_id = old_ids.get(new_labels.encoded(node_id))
+        if old_id is None:
+            new2diff[node_id] = num_nodes
+            num_nodes = num_nodes + 1
+        else:
+            new2diff[node_id] = old_id
+            kept[old_id] = True
+    return num_nodes, new2diff, kept
+
+
+# whether each of the sorted keys is in the sorted haystack
+def find_sorted(keys, haystack):
+    if len(haystack) == 0:
+        return numpy.zeros(len(keys), dtype=bool)
+    positions = numpy.searchsorted(haystack, keys)
+    numpy.minimum(positions, len(haystack) - 1, out=positions)
+    return haystack[positions] == keys
+
+
+# the positions of the targets of the given nodes in the CSR targets
+def get_row_positions(offsets, nodes):
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    shifts = numpy.cumsum(counts) - counts - starts
+    return (numpy.arange(counts.sum(), dtype=numpy.int64) -
+            numpy.repeat(shifts, counts)), counts
+
+
+def write_links(f, keys, num_nodes):
+    pairs = numpy.empty((len(keys), 2), dtype='<u4')
+    pairs[:, 0] = keys // num_nodes
+    pairs[:, 1] = keys % num_nodes
+    pairs.tofile(f)
+
+
+# compares the links of the two snapshots in blocks of consecutive diff
+# ids of the sources, each link is a single key source * num_nodes + target
+# in the diff ids, and the keys of both snapshots are sorted, so the links
+# added and removed are found with binary searches
+# the links are written as (source, target) diff id pairs, and the number
+# of links added and removed of each node is returned
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+def diff_links(old_links, new_links, num_nodes, new2diff,
+               added_file, removed_file, block_links, progressfn=None):
+    old_offsets, old_targets = old_links
+    new_offsets, new_targets = new_links
+    num_old_nodes = len(old_offsets) - 1
+    # the new nodes in the order of their diff ids
+    order = numpy.argsort(new2diff, kind='stable')
+    diff_ids = new2diff[order]
+    # the number of links of the diff ids in both snapshots, summed
+    degrees = numpy.zeros(num_nodes, dtype=numpy.int64)
+    degrees[:num_old_nodes] = numpy.diff(old_offsets)
+    degrees[diff_ids] += numpy.diff(new_offsets)[order]
+    cumulative = numpy.zeros(num_nodes + 1, dtype=numpy.int64)
+    numpy.cumsum(degrees, out=cumulative[1:])
+    del degrees
+    added = numpy.zeros(num_nodes, dtype=numpy.int64)
+    removed = numpy.zeros(num_nodes, dtype=numpy.int64)
+    if progressfn:
+        progressfn(-1)
+    start = 0
+    while start < num_nodes:
+        end = int(numpy.searchsorted(cumulative,
+                                     cumulative[start] + block_links,
+                                     side='right')) - 1
+        end = min(max(end, start + 1), num_nodes)
+        # the old links, already sorted
+        old_start = min(start, num_old_nodes)
+        old_end = min(end, num_old_nodes)
+        old_keys = numpy.repeat(
+            numpy.arange(old_start, old_end, dtype=numpy.int64),
+            numpy.diff(old_offsets[old_start:old_end+1]))
+        old_keys *= num_nodes
+        old_keys += old_targets[old_offsets[old_start]:old_offsets[old_end]]
+        # the new links, in the diff ids
+        first, last = numpy.searchsorted(diff_ids, [start, end])
+        positions, counts = get_row_positions(new_offsets, order[first:last])
+        new_keys = numpy.repeat(diff_ids[first:last], counts)
+        new_keys *= num_nodes
+        new_keys += new2diff[new_targets[positions]]
+        del positions
+        new_keys.sort()
+        added_keys = new_keys[~find_sorted(new_keys, old_keys)]
+        removed_keys = old_keys[~find_sorted(old_keys, new_keys)]
+        del old_keys
+        del new_keys
+        write_links(added_file, added_keys, num_nodes)
+        write_links(removed_file, removed_keys, num_nodes)
+        added += numpy.bincount(added_keys // num_nodes, minlength=num_nodes)
+        added += numpy.bincount(added_keys % num_nodes, minlength=num_nodes)
+        removed += numpy.bincount(removed_keys // num_nodes, minlength=num_nodes)
+        removed += numpy.bincount(removed_keys % num_nodes, minlength=num_nodes)
+        start = end
+        if progressfn:
+            progressfn(start / num_nodes)
+    if progressfn:
+        progressfn(2)
+    return added, removed
+
+
+# pylint: disable=too-many-statements
+def main():
+    print('masnet v%s' % get_version())
+    parser = argparse.ArgumentParser(prog='masnet.diff',
+                                     description='',
+                                     epilog='')
+
+    parser.add_argument('old',
+                        help='the directory of the old snapshot')
+
+    parser.add_argument('new',
+                        help='the directory of the new snapshot')
+
+    parser.add_argument('-d', '--dir',
+                        help='use specified directory for files',
+                        required=False)
+
+    parser.add_argument('--debug',
+                        help='enables debug logging',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('-v', '--verbose',
+                        help='enable verbose logging, mostly for development',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--block-links',
+                        help='compare specified number of links at a time, ' \
+                             'a smaller number uses less memory ' \
+                             '(default: %d)' % DIFF_BLOCK_LINKS,
+                        type=int,
+                        required=False,
+                        default=DIFF_BLOCK_LINKS)
+
+    args = parser.parse_args()
+    set_debug(args.debug)
+    set_verbose(args.verbose)
+    debug(str(args))
+    # the snapshots are not in the working directory
+    args.old = os.path.abspath(args.old)
+    args.new = os.path.abspath(args.new)
+    set_working_dir(args.dir)
+
+    start = time.time()
+
+    old_labels = load_labels(os.path.join(args.old, 'mastodon.labels'))
+    new_labels = load_labels(os.path.join(args.new, 'mastodon.labels'))
+    old_links = load_snapshot_links(args.old)
+    new_links = load_snapshot_links(args.new)
+    if (len(old_links[0]) - 1 != len(old_labels) or
+            len(new_links[0]) - 1 != len(new_labels)):
+        parser.error('the labels and the links of a snapshot do not match')
+    print('snapshots loaded.')
+
+    num_nodes, new2diff, kept = align_labels(old_labels, new_labels)
+    added_nodes = list(range(len(old_labels), num_nodes))
+    removed_nodes = numpy.flatnonzero(~kept)
+    id2label = list(old_labels.values())
+    id2label.extend(new_labels[node_id]
+                    for node_id in numpy.flatnonzero(new2diff >= len(old_labels)))
+    save_labels(id2label, get_path(DIFF_LABELS_FILE_NAME))
+    with open(get_path(DIFF_ADDED_NODES_FILE_NAME), 'w') as f:
+        for node_id in added_nodes:
+            f.write('%s\n' % id2label[node_id])
+    with open(get_path(DIFF_REMOVED_NODES_FILE_NAME), 'w') as f:
+        for node_id in removed_nodes:
+            f.write('%s\n' % id2label[node_id])
+    print('labels aligned: %d nodes added, %d removed.' %
+          (len(added_nodes), len(removed_nodes)))
+
+    print('comparing links...')
+    with open(get_path(DIFF_ADDED_LINKS_FILE_NAME), 'wb') as added_file, \
+         open(get_path(DIFF_REMOVED_LINKS_FILE_NAME), 'wb') as removed_file:
+        added, removed = diff_links(old_links, new_links, num_nodes, new2diff,
+                                    added_file, removed_file,
+                                    args.block_links,
+                                    progressfn=percent_progress)
+    # each link is counted at both of its nodes
+    num_added_links = int(added.sum()) // 2
+    num_removed_links = int(removed.sum()) // 2
+
+    changed = added + removed
+    top = numpy.argsort(-changed, kind='stable')[:DIFF_TOP_NODES]
+    top = [node_id for node_id in top if changed[node_id] > 0]
+    summary = {
+        'old': args.old,
+        'new': args.new,
+        'nodes': {'old': len(old_labels),
+                  'new': len(new_labels),
+                  'added': len(added_nodes),
+                  'removed': len(removed_nodes)},
+        'links': {'old': len(old_links[1]),
+                  'new': len(new_links[1]),
+                  'added': num_added_links,
+                  'removed': num_removed_links},
+        'top': [[id2label[node_id], int(added[node_id]), int(removed[node_id])]
+                for node_id in top],
+        'seconds': round(time.time() - start, 3),
+    }
+    with open(get_path(DIFF_SUMMARY_FILE_NAME), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print(tabulate([[kind,
+                     summary[kind]['old'],
+                     summary[kind]['new'],
+                     summary[kind]['added'],
+                     summary[kind]['removed']]
+                    for kind in ['nodes', 'links']],
+                   headers=['', 'old', 'new', 'added', 'removed']))
+    if len(summary['top']) > 0:
+        print()
+        print(tabulate(summary['top'],
+                       headers=['node', 'links added', 'links removed']))
+    print()
+    print('diff completed in %.1f seconds.' % summary['seconds'])
+    # ru_maxrss is in kilobytes on Linux
+    if resource is not None:
+        print('peak memory: %.1f MB' %
+              (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    print('bye.')
+
+if __name__ == '__main__':
+    main()
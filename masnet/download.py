@@ -4,11 +4,30 @@
 # pylint: disable=global-statement
 # pylint: disable=bare-except,broad-except
 import argparse
+from array import array
 import asyncio
+import codecs
+import collections
+import glob
+import hashlib
+import heapq
 import json
+import multiprocessing
+import os
+import queue
+import re
 import signal
+import socket
+import statistics
+import sys
+import threading
 import time
 import traceback
+import zlib
+try:
+    import resource
+except ImportError:
+    resource = None
 import aiodns
 import aiofile
 import aiohttp
@@ -16,7 +35,11 @@ from tabulate import tabulate
 from masnet import get_peers_file_path, get_error_file_path, load_exclusion
 from masnet import get_version, set_verbose, set_working_dir, debug, verbose
 from masnet import set_debug, is_excluded, get_path, is_debug, is_verbose
-from masnet import get_excluded_patterns
+from masnet import get_excluded_patterns, PeersStore, PEERS_FORMATS
+from masnet import DomainDictionary, pack_links, load_links
+from masnet import PEERS_PREVIOUS_INDEX_FILE_NAME
+from masnet.generate import GraphBuilder
+from masnet.metrics import Metrics
 
 
 RUN = True
@@ -25,214 +48,1778 @@ num_links = 0
 num_errors = 0
 num_skips = 0
 num_timeouts = 0
+# domains fetched but not changed since the previous crawl, with --recrawl
+num_unchanged = 0
 
+# -n auto, additive increase and multiplicative decrease of the number of
+# concurrent fetches, adjusted every AIMD_INTERVAL seconds
+AIMD_INTERVAL = 1
+AIMD_INCREASE = 10
+AIMD_DECREASE = 0.75
+# congested if the median latency is this many times the lowest seen
+AIMD_LATENCY_FACTOR = 2
+AIMD_MAX_TIMEOUT_RATE = 0.25
+AIMD_MAX_LOOP_LAG = 0.1
+# the errors of fetch counted as timeouts, asyncio's and the socket read and
+# connect timeouts of aiohttp
+TIMEOUT_ERRORS = frozenset(['TimeoutError', 'ServerTimeoutError',
+                            'ConnectionTimeoutError', 'SocketTimeoutError'])
 
-# pylint: disable=unused-argument
-def signal_handler(sig, frame):
-    global RUN
-    RUN = False
+# names resolved are cached for DNS_TTL seconds, names that do not exist for
+# DNS_NEGATIVE_TTL seconds, at most DNS_CACHE_SIZE names
+DNS_CACHE_SIZE = 1 << 18
+DNS_TTL = 3600
+DNS_NEGATIVE_TTL = 3600
+DNS_NUM_TASKS = 100
+DNS_NOT_FOUND = (aiodns.error.ARES_ENOTFOUND, aiodns.error.ARES_ENODATA)
 
+# set by download
+metrics = None
+# PeersStore with --peers-format segments
+peers_store = None
 
-async def save_error(domain, error):
-    async with aiofile.async_open(get_path('masnet.download.errors'),
-                                  'a') as afp:
-        await afp.write('%s %s\n' % (domain, error))
+# the benchmark points this to a local server
+PEERS_URL = 'https://%s/api/v1/instance/peers'
 
+# a fetch reading more than this many bytes fails with ResponseTooLarge
+MAX_RESPONSE_SIZE = 16 * 1024 * 1024
 
-async def save_skip(domain):
-    async with aiofile.async_open(get_path('masnet.download.skips'),
-                                  'a') as afp:
-        await afp.write('%s\n' % domain)
+# peers that are not host names are skipped, a name is at most 253 bytes
+# (so its length fits in DOMAIN_RECORD_HEADER) and a label 63 characters
+MAX_NAME_SIZE = 253
+HOST_NAME_PATTERN = re.compile(r'[\w-]{1,63}(?:\.[\w-]{1,63})*')
+# replaced in the invalid names saved to masnet.download.skips
+INVALID_NAME_CHARACTERS = re.compile(r'\s')
 
 
-async def save_time(domain, download_time):
-    async with aiofile.async_open(get_path('masnet.download.times'),
-                                  'a') as afp:
-        await afp.write('%s %d\n' % (domain, download_time))
+def is_host_name(name):
+    return (len(name) <= MAX_NAME_SIZE and
+            len(name.encode('utf-8', 'surrogatepass')) <= MAX_NAME_SIZE and
+            HOST_NAME_PATTERN.fullmatch(name) is not None)
 
+# while the queue is not empty or all tasks are busy, retries wait for
+# RETRY_POLL_INTERVAL seconds
+RETRY_POLL_INTERVAL = 0.5
 
-async def save_visit(domain):
-    async with aiofile.async_open(get_path('masnet.download.visits'),
-                                  'a') as afp:
-        await afp.write('%s\n' % domain)
+
+# with --workers, the domains are sharded by get_shard, and each shard is
+# downloaded by a worker process with its own event loop and connector
+# SHARD is the shard of the worker process, None if there are no workers
+SHARD = None
+NUM_SHARDS = 1
+# new domains found by this shard but owned by others, sent to the
+# coordinator with the status every SHARD_REPORT_INTERVAL seconds
+outgoing = []
+SHARD_REPORT_INTERVAL = 0.1
+
+# domains scheduled, of this shard with --workers
+num_scheduled = 0
+# domains taken from the queue by the workers and waiting for the
+# concurrency limiter of -n auto, they are still counted in the queue
+num_waiting = 0
+# number of names in masnet.download.domains
+num_domains_saved = 0
+# size of masnet.download.links, including the records not written yet
+links_size = 0
+# with --graph, the graph is built as the peers are saved, and it is saved
+# when the crawl is finished, so masnet.generate is not needed
+graph_builder = None
+
+# a "[domain, hash, etag, last modified]" JSON line for each domain visited,
+# the hash is of the content of its peers.json file
+# with --recrawl, conditional requests are sent with the validators of the
+# domains visited by the previous crawls, and the peers of a domain not
+# changed (304 or the same hash) are not written again
+VALIDATORS_FILE_NAME = 'masnet.download.validators'
+# size of masnet.download.validators, including the lines not written yet
+validators_size = 0
+# with --recrawl, domain -> (hash, etag, last modified)
+validators = None
+# with --recrawl and --peers-format segments, domain -> (segment, offset) of
+# the records of the previous crawls
+previous_peers = None
+
+
+# files of a worker process have the shard as suffix, and they are merged
+# by the coordinator at the end
+def get_download_path(file_name):
+    if SHARD is None:
+        return get_path(file_name)
+    return get_path('%s.%d' % (file_name, SHARD))
+
+
+# stable, unlike hash()
+def get_shard(domain, num_shards):
+    return zlib.crc32(domain.encode('utf-8', 'surrogatepass')) % num_shards
+
+
+# worker processes print nothing, the coordinator prints the status
+def info(s):
+    if SHARD is None:
+        print(s, flush=True)
+
+
+def format_status(counters):
+    elapsed = counters['elapsed']
+    hours = int(elapsed / 3600)
+    minutes = int((elapsed - hours * 3600) / 60)
+    seconds = elapsed - minutes * 60 - hours * 3600
+    return 'q:%06d r:%06d a:%06d c:%04d s:%06d ' \
+           'N:%06d u:%06d L:%09d ' \
+           'e:%08d s:%08d to:%04d ' \
+           't:%02d:%02d:%02d' % (counters['queue'], counters['retry_queue'],
+                                 counters['in_flight'], counters['concurrency'],
+                                 counters['scheduled'],
+                                 counters['nodes'], counters['unchanged'],
+                                 counters['links'],
+                                 counters['errors'], counters['skips'],
+                                 counters['timeouts'],
+                                 hours, minutes, seconds)
+
+
+def schedule(domain_id, domain, pending, resolver, q):
+    global num_scheduled
+    num_scheduled = num_scheduled + 1
+    pending.add(domain_id)
+    resolver.prefetch(domain)
+    q.put_nowait(domain_id)
+
+
+# pylint: disable=too-many-arguments
+async def save_checkpoint(start_domain, elapsed, domains, pending, breaker,
+                          retries):
+    global num_domains_saved
+    doc = {'start_domain': start_domain,
+           'elapsed': elapsed,
+           'num_nodes': num_nodes,
+           'num_links': num_links,
+           'num_errors': num_errors,
+           'num_skips': num_skips,
+           'num_timeouts': num_timeouts,
+           # scheduled domains are the first num_domains names in
+           # masnet.download.domains, and pending are their ids
+           'num_domains': len(domains),
+           'num_scheduled': num_scheduled,
+           'pending': list(pending),
+           'links_size': links_size,
+           'failures': dict(breaker.failures),
+           'attempts': dict(retries.attempts),
+           'peers_format': 'files' if peers_store is None else 'segments',
+           'num_unchanged': num_unchanged,
+           'validators_size': validators_size,
+           'recrawl': validators is not None}
+    # the log lines and the peers of the domains done in this snapshot are
+    # written before the checkpoint
+    await flush_logs()
+    if peers_store is not None:
+        peers_store.flush()
+    domains.save(get_download_path('masnet.download.domains'), num_domains_saved)
+    num_domains_saved = len(domains)
+    # written to a temporary file first and then renamed, so an interrupted
+    # write never leaves a truncated checkpoint behind
+    file_path = get_download_path('masnet.download.checkpoint')
+    with open('%s.tmp' % file_path, 'w') as f:
+        json.dump(doc, f)
+    os.replace('%s.tmp' % file_path, file_path)
+    debug('checkpoint saved, %d pending' % len(pending))
+
+
+def load_checkpoint():
+    global num_nodes, num_links, num_errors, num_skips, num_timeouts
+    global num_domains_saved, links_size, num_scheduled, num_unchanged
+    global validators_size
+    with open(get_download_path('masnet.download.checkpoint'), 'r') as f:
+        doc = json.load(f)
+    num_nodes = doc['num_nodes']
+    num_links = doc['num_links']
+    num_errors = doc['num_errors']
+    num_skips = doc['num_skips']
+    num_timeouts = doc['num_timeouts']
+    num_scheduled = doc['num_scheduled']
+    # the names and the links saved after the checkpoint are removed, the
+    # domains fetched after it are still pending
+    domains = DomainDictionary.load(get_download_path('masnet.download.domains'),
+                                    doc['num_domains'])
+    os.remove(get_download_path('masnet.download.domains'))
+    domains.save(get_download_path('masnet.download.domains'))
+    num_domains_saved = len(domains)
+    os.truncate(get_download_path('masnet.download.links'), doc['links_size'])
+    links_size = doc['links_size']
+    num_unchanged = doc.get('num_unchanged', 0)
+    validators_size = doc.get('validators_size', 0)
+    if os.path.exists(get_download_path(VALIDATORS_FILE_NAME)):
+        os.truncate(get_download_path(VALIDATORS_FILE_NAME), validators_size)
+    return doc, domains
+
+
+# lines for masnet.download.errors, .skips, .times and .visits are queued
+# and written in batches by a single log_writer task
+LOG_FLUSH_SIZE = 64 * 1024
+LOG_FLUSH_INTERVAL = 1
+log_queue = None
+
+
+def save_log(file_name, line):
+    log_queue.put_nowait((file_name, line))
+
+
+async def flush_logs():
+    # returns after everything queued before the call is written
+    done = asyncio.get_running_loop().create_future()
+    log_queue.put_nowait((None, done))
+    await done
+
+
+def stop_log_writer():
+    log_queue.put_nowait((None, None))
 
 
 # pylint: disable=too-many-branches
+async def log_writer():
+    files = {}
+    buffers = {}
+    buffered = 0
+    last_flush = time.time()
+    running = True
+    while running:
+        items = []
+        if buffered == 0:
+            items.append(await log_queue.get())
+        else:
+            remaining = LOG_FLUSH_INTERVAL - (time.time() - last_flush)
+            try:
+                items.append(await asyncio.wait_for(log_queue.get(),
+                                                    max(0, remaining)))
+            except asyncio.TimeoutError:
+                pass
+        while not log_queue.empty():
+            items.append(log_queue.get_nowait())
+        waiters = []
+        for file_name, line in items:
+            if file_name is not None:
+                buffers.setdefault(file_name, []).append(line)
+                buffered = buffered + len(line)
+            elif line is not None:
+                waiters.append(line)
+            else:
+                running = False
+        if (len(waiters) > 0 or
+                not running or
+                buffered >= LOG_FLUSH_SIZE or
+                (time.time() - last_flush) >= LOG_FLUSH_INTERVAL):
+            for file_name, lines in buffers.items():
+                if len(lines) == 0:
+                    continue
+                binary = isinstance(lines[0], bytes)
+                if file_name not in files:
+                    files[file_name] = await aiofile.async_open(get_download_path(file_name),
+                                                                'ab' if binary else 'a')
+                await files[file_name].write((b'' if binary else '').join(lines))
+                lines.clear()
+            buffered = 0
+            last_flush = time.time()
+            for waiter in waiters:
+                # the task waiting for the flush can be cancelled
+                if not waiter.done():
+                    waiter.set_result(None)
+    for afp in files.values():
+        await afp.close()
+
+
+def save_error(domain, error):
+    save_log('masnet.download.errors', '%s %s\n' % (domain, error))
+
+
+def save_skip(domain, reason=None):
+    if reason is None:
+        save_log('masnet.download.skips', '%s\n' % domain)
+    else:
+        save_log('masnet.download.skips', '%s %s\n' % (domain, reason))
+
+
+def save_time(domain, download_time):
+    save_log('masnet.download.times', '%s %d\n' % (domain, download_time))
+
+
+def save_visit(domain):
+    save_log('masnet.download.visits', '%s\n' % domain)
+
+
+def save_validator(domain, digest, etag, last_modified):
+    global validators_size
+    # ascii, so its length is its size
+    line = '%s\n' % json.dumps([domain, digest, etag, last_modified])
+    validators_size = validators_size + len(line)
+    save_log(VALIDATORS_FILE_NAME, line)
+
+
+# domain -> (hash, etag, last modified), of the domains accepted if it is
+# given, the last line of a domain is used
+def load_validators(file_path, accept=None):
+    loaded = {}
+    if not os.path.exists(file_path):
+        return loaded
+    with open(file_path, 'r') as f:
+        for line in f:
+            try:
+                domain, digest, etag, last_modified = json.loads(line)
+            except ValueError:
+                # a line cut by a crash
+                continue
+            if accept is None or accept(domain):
+                loaded[domain] = (digest, etag, last_modified)
+    return loaded
+
+
+# keeps only the last line of each domain, before a new --recrawl
+def compact_validators():
+    file_path = get_path(VALIDATORS_FILE_NAME)
+    loaded = load_validators(file_path)
+    with open('%s.tmp' % file_path, 'w') as f:
+        for domain, validator in loaded.items():
+            f.write('%s\n' % json.dumps([domain] + list(validator)))
+    os.replace('%s.tmp' % file_path, file_path)
+    return len(loaded)
+
+
+def save_links(domain_id, peer_ids):
+    global links_size
+    record = pack_links(domain_id, peer_ids)
+    links_size = links_size + len(record)
+    save_log('masnet.download.links', record)
+    if graph_builder is not None:
+        graph_builder.add(domain_id, peer_ids)
+
+
+# a set of domain ids, with a byte for each id
+class DomainSet:
+
+    def __init__(self):
+        self.flags = bytearray()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, domain_id):
+        return domain_id < len(self.flags) and self.flags[domain_id] == 1
+
+    def __iter__(self):
+        domain_id = self.flags.find(1)
+        while domain_id != -1:
+            yield domain_id
+            domain_id = self.flags.find(1, domain_id + 1)
+
+    def add(self, domain_id):
+        if domain_id >= len(self.flags):
+            # doubled, not to extend it for every new domain
+            self.flags.extend(bytes(max(domain_id + 1 - len(self.flags),
+                                        len(self.flags))))
+        if self.flags[domain_id] == 0:
+            self.flags[domain_id] = 1
+            self.count = self.count + 1
+
+    def discard(self, domain_id):
+        if domain_id in self:
+            self.flags[domain_id] = 0
+            self.count = self.count - 1
+
+
+# limits the number of concurrent fetches with AIMD
+# every interval the limit is decreased multiplicatively if the fetches look
+# congested (median latency well above the lowest seen, too many timeouts or
+# the event loop lagging), otherwise it is increased additively if all of it
+# was used
+# pylint: disable=too-many-instance-attributes
+class ConcurrencyLimiter:
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, initial, minimum, maximum,
+                 increase=AIMD_INCREASE,
+                 decrease=AIMD_DECREASE,
+                 latency_factor=AIMD_LATENCY_FACTOR,
+                 max_timeout_rate=AIMD_MAX_TIMEOUT_RATE,
+                 max_loop_lag=AIMD_MAX_LOOP_LAG):
+        self.limit = max(minimum, min(maximum, initial))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.max_timeout_rate = max_timeout_rate
+        self.max_loop_lag = max_loop_lag
+        self.in_flight = 0
+        self.waiters = []
+        self.base_latency = None
+        # measurements of the current interval
+        self.max_in_flight = 0
+        self.latencies = []
+        self.num_fetches = 0
+        self.num_timeouts = 0
+
+    async def acquire(self):
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.in_flight = self.in_flight + 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def release(self, latency, timed_out):
+        self.in_flight = self.in_flight - 1
+        self.num_fetches = self.num_fetches + 1
+        if timed_out:
+            self.num_timeouts = self.num_timeouts + 1
+        elif latency is not None:
+            self.latencies.append(latency)
+        self.wake()
+
+    def wake(self):
+        free = self.limit - self.in_flight
+        while free > 0 and len(self.waiters) > 0:
+            waiter = self.waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                free = free - 1
+
+    def adjust(self, loop_lag):
+        congested = loop_lag > self.max_loop_lag
+        if len(self.latencies) > 0:
+            latency = statistics.median(self.latencies)
+            # the lowest latency slowly drifts up, so a lucky interval
+            # does not keep the limit low forever
+            if self.base_latency is None:
+                self.base_latency = latency
+            else:
+                self.base_latency = min(latency, self.base_latency * 1.001)
+            if latency > self.latency_factor * self.base_latency:
+                congested = True
+        if self.num_fetches > 0:
+            if self.num_timeouts / self.num_fetches > self.max_timeout_rate:
+                congested = True
+        if congested:
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        elif self.max_in_flight >= self.limit:
+            self.limit = min(self.maximum, self.limit + self.increase)
+        debug('concurrency: %d lag: %.3f fetches: %d timeouts: %d' % (self.limit,
+                                                                      loop_lag,
+                                                                      self.num_fetches,
+                                                                      self.num_timeouts))
+        self.max_in_flight = self.in_flight
+        self.latencies = []
+        self.num_fetches = 0
+        self.num_timeouts = 0
+        self.wake()
+
+
+async def adjust_concurrency(limiter, interval=AIMD_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        before = loop.time()
+        await asyncio.sleep(interval)
+        # how late the event loop woke this task up
+        limiter.adjust(loop.time() - before - interval)
+
+
+# resolver for the connector with a bounded TTL cache, also caching the
+# names that do not exist
+# names can be resolved ahead of their fetch with prefetch, so workers find
+# them in the cache, prefetched names are resolved by DNS_NUM_TASKS tasks
+# pylint: disable=too-many-instance-attributes
+class CachingResolver(aiohttp.abc.AbstractResolver):
+
+    def __init__(self, nameservers,
+                 size=DNS_CACHE_SIZE,
+                 ttl=DNS_TTL,
+                 negative_ttl=DNS_NEGATIVE_TTL):
+        self.resolver = aiohttp.resolver.AsyncResolver(nameservers=nameservers)
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # (host, family) -> (expires, hosts or OSError)
+        self.cache = collections.OrderedDict()
+        # (host, family) -> future of the lookup in progress
+        self.lookups = {}
+        self.prefetch_q = asyncio.Queue()
+        self.tasks = []
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def start(self, num_tasks=DNS_NUM_TASKS):
+        for _ in range(0, num_tasks):
+            self.tasks.append(asyncio.create_task(self.prefetcher()))
+
+    def prefetch(self, host):
+        # names prefetched too far ahead would be evicted before use
+        if self.prefetch_q.qsize() < self.size:
+            self.prefetch_q.put_nowait(host)
+
+    async def prefetcher(self):
+        while True:
+            host = await self.prefetch_q.get()
+            try:
+                await self.resolve(host)
+            except OSError:
+                pass
+
+    async def lookup(self, key):
+        host, family = key
+        try:
+            result = await self.resolver.resolve(host, 0, family)
+            expires = time.time() + self.ttl
+        except OSError as e:
+            if not isinstance(e.__cause__, aiodns.error.DNSError):
+                raise
+            if e.__cause__.args[0] not in DNS_NOT_FOUND:
+                raise
+            result = e
+            expires = time.time() + self.negative_ttl
+        self.cache[key] = (expires, result)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return result
+
+    async def resolve(self, host, port=0, family=socket.AF_UNSPEC):
+        key = (host, family)
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] > time.time():
+            self.num_hits = self.num_hits + 1
+            self.cache.move_to_end(key)
+            result = entry[1]
+        else:
+            self.num_misses = self.num_misses + 1
+            lookup = self.lookups.get(key)
+            if lookup is None:
+                lookup = asyncio.ensure_future(self.lookup(key))
+                self.lookups[key] = lookup
+                lookup.add_done_callback(lambda _: self.lookups.pop(key, None))
+            result = await asyncio.shield(lookup)
+        if isinstance(result, OSError):
+            raise OSError(*result.args) from result.__cause__
+        return [dict(r, port=port) for r in result]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        # lookups not awaited anymore fail when the resolver is closed
+        lookups = list(self.lookups.values())
+        await self.resolver.close()
+        await asyncio.gather(*lookups, return_exceptions=True)
+
+
+# domains failed with a timeout or a connection error wait here, for
+# delay * 2^(attempts-1) seconds, to be fetched again, up to max_attempts
+# they are put back into the queue only when it is empty and not all tasks
+# are busy, so retries never delay the domains not tried yet
+# pylint: disable=too-many-instance-attributes
+class RetryQueue:
+
+    def __init__(self, max_attempts, delay):
+        self.max_attempts = max_attempts
+        self.delay = delay
+        # domain -> number of attempts, for domains failed at least once
+        self.attempts = {}
+        # (time to retry, domain)
+        self.heap = []
+        self.added = asyncio.Event()
+        self.emptied = asyncio.Event()
+        self.emptied.set()
+
+    def qsize(self):
+        return len(self.heap)
+
+    def retry(self, domain):
+        attempts = self.attempts.get(domain, 0) + 1
+        self.attempts[domain] = attempts
+        if attempts >= self.max_attempts:
+            return False
+        heapq.heappush(self.heap,
+                       (time.time() + self.delay * 2 ** (attempts - 1), domain))
+        self.added.set()
+        self.emptied.clear()
+        return True
+
+    def error(self, domain, error):
+        attempts = self.attempts.get(domain, 1)
+        if attempts > 1:
+            return '%s attempts:%d' % (error, attempts)
+        return error
+
+    def done(self, domain):
+        self.attempts.pop(domain, None)
+
+    async def join(self):
+        await self.emptied.wait()
+
+    async def feed(self, q, has_capacity):
+        while True:
+            if len(self.heap) == 0:
+                self.added.clear()
+                await self.added.wait()
+                continue
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                await asyncio.sleep(min(delay, RETRY_POLL_INTERVAL))
+                continue
+            if q.qsize() > 0 or not has_capacity():
+                await asyncio.sleep(RETRY_POLL_INTERVAL)
+                continue
+            _, domain = heapq.heappop(self.heap)
+            debug('retrying %s' % domain)
+            await q.put(domain)
+            if len(self.heap) == 0:
+                self.emptied.set()
+            # lets an idle task take it before the queue is checked again
+            await asyncio.sleep(0)
+
+
+# --prior, the domains of a previous crawl read from its output files,
+# domain -> download time in ms for the domains visited, or PRIOR_FAILED for
+# the domains failed and never visited
+PRIOR_FAILED = -1
+
+
+def load_prior(dir_path):
+    prior = {}
+    def read_log(file_name):
+        file_path = os.path.join(dir_path, file_name)
+        if not os.path.exists(file_path):
+            return
+        with open(file_path, 'r', errors='replace') as f:
+            for line in f:
+                yield line.rstrip('\n').split(' ')
+    for parts in read_log('masnet.download.visits'):
+        prior[parts[0]] = 0
+    # also written for the responses that are not a list of peers
+    for parts in read_log('masnet.download.times'):
+        if parts[0] in prior:
+            prior[parts[0]] = int(parts[1])
+    # a domain retried and then visited is not in errors
+    for parts in read_log('masnet.download.errors'):
+        if parts[0] not in prior:
+            prior[parts[0]] = PRIOR_FAILED
+    return prior
+
+
+# the queue of the domains to fetch, a FIFO queue without --prior
+# with --prior, the domains visited before are taken first, the fastest
+# first, then the domains not seen before in the order they are queued, and
+# the domains failed before are taken last
+class Frontier(asyncio.Queue):
+
+    def __init__(self, domains, prior=None):
+        self.domains = domains
+        self.prior = prior
+        self.num_live = 0
+        # set by _init
+        self.live = None
+        self.new = None
+        self.failed = None
+        super().__init__()
+
+    # pylint: disable=unused-argument
+    def _init(self, maxsize):
+        # (download time, number, domain id)
+        self.live = []
+        self.new = collections.deque()
+        self.failed = collections.deque()
+
+    def _put(self, item):
+        prior_time = None
+        if self.prior is not None:
+            prior_time = self.prior.get(self.domains.name(item))
+        if prior_time is None:
+            self.new.append(item)
+        elif prior_time == PRIOR_FAILED:
+            self.failed.append(item)
+        else:
+            # the number keeps the order of the domains with the same time
+            heapq.heappush(self.live, (prior_time, self.num_live, item))
+            self.num_live = self.num_live + 1
+
+    def _get(self):
+        if len(self.live) > 0:
+            return heapq.heappop(self.live)[2]
+        if len(self.new) > 0:
+            return self.new.popleft()
+        return self.failed.popleft()
+
+    def qsize(self):
+        return len(self.live) + len(self.new) + len(self.failed)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def failed_before(self, domain):
+        return self.prior is not None and self.prior.get(domain) == PRIOR_FAILED
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+# parses the peers response while it is being received
+# if it is an array, feed returns its elements parsed so far, otherwise the
+# response is kept to be parsed as a whole by value
+# pylint: disable=too-many-instance-attributes
+class PeersParser:
+
+    def __init__(self, encoding='utf-8'):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder(encoding)()
+        self.text = ''
+        self.pos = 0
+        # None until the first character, then if the response is an array
+        self.is_array = None
+        # the text of a response that is not an array, joined by value
+        self.parts = []
+        self.expect_value = True
+        self.first = True
+        self.closed = False
+
+    # pylint: disable=too-many-branches
+    def feed(self, data, final=False):
+        if self.is_array is False:
+            # not parsed until the end, and not copied for every data
+            self.parts.append(self.text_decoder.decode(data, final))
+            return []
+        text = self.text[self.pos:] + self.text_decoder.decode(data, final)
+        self.text = text
+        pos = 0
+        values = []
+        while self.is_array is not False:
+            pos = JSON_WHITESPACE.match(text, pos).end()
+            if pos == len(text):
+                break
+            if self.is_array is None:
+                self.is_array = text[pos] == '['
+                if not self.is_array:
+                    self.parts.append(text)
+                    self.text = ''
+                    pos = 0
+                    break
+                pos = pos + 1
+            elif self.closed:
+                raise json.JSONDecodeError('Extra data', text, pos)
+            elif not self.expect_value:
+                if text[pos] == ',':
+                    self.expect_value = True
+                elif text[pos] == ']':
+                    self.closed = True
+                else:
+                    raise json.JSONDecodeError('Expecting \',\' delimiter',
+                                               text, pos)
+                pos = pos + 1
+            elif self.first and text[pos] == ']':
+                self.closed = True
+                pos = pos + 1
+            else:
+                try:
+                    value, end = self.decoder.raw_decode(text, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                # a number or a literal can continue in the next data
+                if JSON_WHITESPACE.match(text, end).end() == len(text) and not final:
+                    break
+                values.append(value)
+                pos = end
+                self.expect_value = False
+                self.first = False
+        self.pos = pos
+        if final and self.is_array and not self.closed:
+            raise json.JSONDecodeError('Expecting value', text, len(text))
+        return values
+
+    # the whole response if it is not an array
+    def value(self):
+        return json.loads(''.join(self.parts))
+
+
+# the peers saved by the previous crawl, previous is the path of the
+# peers.json file, or (segment, offset) of the record
+def read_previous_peers(previous):
+    if isinstance(previous, tuple):
+        text = PeersStore.read_location(previous)
+    else:
+        with open(previous, 'r') as f:
+            text = f.read()
+    return json.loads(text)['peers']
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-branches
+# pylint: disable=too-many-locals
 # pylint: disable=too-many-statements
-async def fetch(session, domain, timeout, scheduled, q):
+async def fetch(session, resolver, retries, domain_id, domain, timeout, domains,
+                pending, q):
     global num_errors, num_nodes, num_skips, num_links, num_timeouts
-    url = 'https://%s/api/v1/instance/peers' % domain
+    global num_unchanged
+    url = PEERS_URL % domain
+    file_path = get_peers_file_path(domain)
+    # with --recrawl, the validator of a domain saved by a previous crawl is
+    # used only if its peers are still there
+    validator = None
+    # path of the peers.json file, or (segment, offset) of the record
+    previous = None
+    if validators is not None and domain in validators:
+        if peers_store is None:
+            if os.path.exists(file_path):
+                previous = file_path
+        else:
+            previous = previous_peers.get(domain)
+        if previous is not None:
+            validator = validators[domain]
+    headers = None
+    if validator is not None:
+        headers = {}
+        if validator[1] is not None:
+            headers['If-None-Match'] = validator[1]
+        if validator[2] is not None:
+            headers['If-Modified-Since'] = validator[2]
+    # ids of the peers scheduled, for masnet.download.links
+    peer_ids = array('I')
+    def add_peers(peers):
+        global num_skips, num_links
+        for peer in peers:
+            if peer is None:
+                continue
+            if len(peer.strip()) == 0:
+                continue
+            if is_excluded(peer):
+                save_skip(peer)
+                num_skips = num_skips + 1
+                continue
+            if not is_host_name(peer):
+                save_skip(INVALID_NAME_CHARACTERS.sub('?', peer[:MAX_NAME_SIZE]),
+                          'invalid')
+                num_skips = num_skips + 1
+                continue
+            num_links = num_links + 1
+            peer_id, new = domains.intern(peer)
+            peer_ids.append(peer_id)
+            if new:
+                if (SHARD is not None and
+                        get_shard(peer, NUM_SHARDS) != SHARD):
+                    outgoing.append(peer)
+                else:
+                    schedule(peer_id, peer, pending, resolver, q)
+    # name of the exception, if there is one, returned to the worker
+    error = None
     try:
+        # dead names found by the prefetch fail here, before using a
+        # connection
+        try:
+            await resolver.resolve(domain)
+        except OSError as e:
+            if isinstance(e.__cause__, aiodns.error.DNSError):
+                raise e.__cause__
+            raise
         start = time.time()
-        async with session.get(url, timeout=timeout) as resp:
-            if resp.status == 200:
-                resp_as_text = await resp.text()
-                await save_time(domain,
-                                int((time.time() - start) * 1000))
-                peers = json.loads(resp_as_text)
-                if peers is None:
-                    num_errors = num_errors + 1
-                    await save_error(domain, 'peers is None')
-                elif not isinstance(peers, list):
-                    num_errors = num_errors + 1
-                    await save_error(domain, 'peers is not list')
-                else:
-                    doc = {'domain': domain,
-                           'peers': peers}
-                    async with aiofile.async_open(get_path('%s.peers.json' % domain),
-                                                  'w') as afp:
-                        await afp.write(json.dumps(doc))
-                    num_nodes = num_nodes + 1
-                    await save_visit(domain)
-                    for peer in peers:
-                        if peer is None:
-                            continue
-                        if len(peer.strip()) == 0:
-                            continue
-                        if is_excluded(peer):
-                            await save_skip(peer)
-                            num_skips = num_skips + 1
-                            continue
-                        num_links = num_links + 1
-                        if peer not in scheduled:
-                            scheduled.add(peer)
-                            await q.put(peer)
+        async with session.get(url, timeout=timeout, headers=headers) as resp:
+            if resp.status == 304 and validator is not None:
+                # the peers saved before are kept, read and parsed in a
+                # thread, so the event loop is not blocked
+                peers = await asyncio.get_running_loop().run_in_executor(
+                    None, read_previous_peers, previous)
+                if peers_store is not None:
+                    peers_store.keep(domain, previous)
+                add_peers(peers)
+                save_time(domain,
+                          int((time.time() - start) * 1000))
+                num_nodes = num_nodes + 1
+                num_unchanged = num_unchanged + 1
+                save_visit(domain)
+                save_links(domain_id, peer_ids)
+            elif resp.status == 200:
+                if (resp.content_length is not None and
+                        resp.content_length > MAX_RESPONSE_SIZE):
+                    raise ResponseTooLarge()
+                parser = PeersParser(resp.charset or 'utf-8')
+                afp = None
+                # the peers.json content with --peers-format segments
+                chunks = None
+                num_written = 0
+                hasher = hashlib.blake2b(digest_size=16)
+                try:
+                    # peers are written as they are parsed, the same as
+                    # json.dumps({'domain': domain, 'peers': peers})
+                    async def write(text):
+                        hasher.update(text.encode('utf-8'))
+                        if chunks is not None:
+                            chunks.append(text)
+                        else:
+                            await afp.write(text)
+                    async def process(peers, final):
+                        nonlocal afp, chunks, num_written
+                        if afp is None and chunks is None:
+                            if not parser.is_array:
+                                return
+                            if peers_store is None:
+                                afp = await aiofile.async_open('%s.tmp' % file_path,
+                                                               'w')
+                            else:
+                                chunks = []
+                            await write('{"domain": %s, "peers": [' % json.dumps(domain))
+                        parts = []
+                        if num_written > 0 and len(peers) > 0:
+                            parts.append('')
+                        num_written = num_written + len(peers)
+                        for peer in peers:
+                            parts.append(json.dumps(peer))
+                        add_peers(peers)
+                        text = ', '.join(parts)
+                        if final:
+                            text = text + ']}'
+                        await write(text)
+                    size = 0
+                    async for data in resp.content.iter_any():
+                        size = size + len(data)
+                        metrics.bytes_received = metrics.bytes_received + len(data)
+                        if size > MAX_RESPONSE_SIZE:
+                            raise ResponseTooLarge()
+                        await process(parser.feed(data), False)
+                    await process(parser.feed(b'', True), True)
+                    save_time(domain,
+                              int((time.time() - start) * 1000))
+                    if afp is not None or chunks is not None:
+                        digest = hasher.hexdigest()
+                        unchanged = validator is not None and digest == validator[0]
+                        if afp is not None:
+                            await afp.close()
+                            afp = None
+                            if unchanged:
+                                # the peers.json file is not replaced
+                                os.remove('%s.tmp' % file_path)
+                            else:
+                                os.replace('%s.tmp' % file_path, file_path)
+                        elif unchanged:
+                            # not written again
+                            peers_store.keep(domain, previous)
+                        else:
+                            peers_store.append(domain, ''.join(chunks))
+                        if unchanged:
+                            num_unchanged = num_unchanged + 1
+                        etag = resp.headers.get('ETag')
+                        last_modified = resp.headers.get('Last-Modified')
+                        if validator != (digest, etag, last_modified):
+                            save_validator(domain, digest, etag, last_modified)
+                        num_nodes = num_nodes + 1
+                        save_visit(domain)
+                        save_links(domain_id, peer_ids)
+                    else:
+                        peers = parser.value()
+                        if peers is None:
+                            error = 'peers is None'
+                        else:
+                            error = 'peers is not list'
+                        num_errors = num_errors + 1
+                        save_error(domain, error)
+                finally:
+                    if afp is not None:
+                        await afp.close()
+                        os.remove('%s.tmp' % file_path)
             else:
+                error = 'HTTP: %d' % resp.status
                 num_errors = num_errors + 1
-                await save_error(domain, 'HTTP: %d' % resp.status)
-    except aiohttp.ClientError as e:
-        num_errors = num_errors + 1
+                save_error(domain, error)
+    # before aiohttp.ClientError, the socket read and connect timeouts of
+    # aiohttp (ServerTimeoutError and its subclasses) are both
+    except asyncio.exceptions.TimeoutError as e:
+        num_timeouts = num_timeouts + 1
         error = e.__class__.__name__
-        await save_error(domain, error)
-    except aiodns.error.DNSError as e:
+        if retries.retry(domain_id):
+            return error
         num_errors = num_errors + 1
+        save_error(domain, retries.error(domain_id, error))
+    except aiohttp.ClientError as e:
         error = e.__class__.__name__
-        await save_error(domain, error)
-    except asyncio.exceptions.TimeoutError as e:
+        if retries.retry(domain_id):
+            return error
         num_errors = num_errors + 1
-        num_timeouts = num_timeouts + 1
+        save_error(domain, retries.error(domain_id, error))
+    except aiodns.error.DNSError as e:
         error = e.__class__.__name__
-        await save_error(domain, error)
-    except asyncio.CancelledError as e:
+        # a name that does not exist is not retried, but a timeout is
+        if e.args[0] not in DNS_NOT_FOUND and retries.retry(domain_id):
+            return error
         num_errors = num_errors + 1
-        error = e.__class__.__name__
-        await save_error(domain, error)
+        save_error(domain, retries.error(domain_id, error))
+    except asyncio.CancelledError:
+        # not an error, the domain stays pending, so it is fetched again
+        # when the crawl is resumed, and the worker running this fetch stops
+        raise
     except json.decoder.JSONDecodeError as e:
         num_errors = num_errors + 1
         error = e.__class__.__name__
-        await save_error(domain, error)
+        save_error(domain, error)
     except UnicodeError as e:
         num_errors = num_errors + 1
         error = e.__class__.__name__
-        await save_error(domain, error)
+        save_error(domain, error)
     except Exception as e:
         num_errors = num_errors + 1
         error = e.__class__.__name__
-        await save_error(domain, error)
+        save_error(domain, error)
         if is_verbose():
             traceback.print_exc()
+    pending.discard(domain_id)
+    retries.done(domain_id)
+    return error
+
+
+# second level labels of the country code top level domains used as public
+# suffixes, like co.uk, com.br and ne.jp, the instances under them are not
+# related to each other
+PUBLIC_SECOND_LEVEL_LABELS = frozenset(['ac', 'co', 'com', 'edu', 'ed', 'gen',
+                                        'go', 'gob', 'gov', 'gr', 'in', 'info',
+                                        'int', 'lg', 'ltd', 'mil', 'ne', 'net',
+                                        'nic', 'nom', 'or', 'org', 'plc',
+                                        'sch'])
+
+
+# a public suffix with more than one label, like co.uk
+def is_public_suffix(domain):
+    parts = domain.split('.')
+    return (len(parts) == 2 and
+            len(parts[1]) == 2 and
+            parts[0] in PUBLIC_SECOND_LEVEL_LABELS)
+
+
+# a.b.com -> b.com, None for names with two labels, IP addresses and the
+# names directly under a public suffix (a.co.uk)
+def get_parent_domain(domain):
+    parts = domain.split('.')
+    if len(parts) <= 2 or parts[-1].isdigit():
+        return None
+    parent = '.'.join(parts[1:])
+    if is_public_suffix(parent):
+        return None
+    return parent
+
+
+# stops fetching the domains under a parent domain after max_failures
+# consecutive fetches under it failed, mostly swarms of random subdomains
+# a successful fetch under it (one already running) closes it again
+# every cooldown seconds after it is opened, a single domain under it is
+# fetched (half-open), it is closed if it is fetched successfully, otherwise
+# it waits for another cooldown
+class CircuitBreaker:
+
+    def __init__(self, max_failures, failures=None, cooldown=60):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        # parent domain -> consecutive failures
+        self.failures = {} if failures is None else failures
+        # parent domain -> time it is opened or the last probe failed
+        self.opened = {}
+        # parent domains with a probe being fetched
+        self.probing = set()
+
+    def is_open(self, domain):
+        if self.max_failures == 0:
+            return False
+        parent = get_parent_domain(domain)
+        if parent is None:
+            return False
+        if self.failures.get(parent, 0) < self.max_failures:
+            return False
+        # opened by the failures of the checkpoint when resuming
+        opened = self.opened.setdefault(parent, time.time())
+        if (parent not in self.probing and
+                (time.time() - opened) >= self.cooldown):
+            self.probing.add(parent)
+            return False
+        return True
+
+    def record(self, domain, failed):
+        parent = get_parent_domain(domain)
+        if parent is None:
+            return
+        self.probing.discard(parent)
+        if failed:
+            self.failures[parent] = self.failures.get(parent, 0) + 1
+            if self.failures[parent] >= self.max_failures:
+                self.opened[parent] = time.time()
+        else:
+            self.failures.pop(parent, None)
+            self.opened.pop(parent, None)
+
+
+# pylint: disable=too-many-arguments
+async def worker(session, resolver, retries, timeout, domains, pending,
+                 fetching, domain_counts, limiter, breaker, q,
+                 failed_timeout=None):
+    global num_skips, num_waiting
+    while True:
+        domain_id = await q.get()
+        domain = domains.name(domain_id)
+        try:
+            if breaker.is_open(domain):
+                save_skip(domain, 'failures:%s' % get_parent_domain(domain))
+                num_skips = num_skips + 1
+                pending.discard(domain_id)
+                continue
+            if limiter is not None:
+                num_waiting = num_waiting + 1
+                try:
+                    await limiter.acquire()
+                finally:
+                    num_waiting = num_waiting - 1
+            debug(domain)
+            if is_verbose():
+                count_key = get_parent_domain(domain)
+                if count_key is not None:
+                    domain_counts[count_key] = domain_counts.get(count_key,
+                                                                 0) + 1
+            fetching.add(domain)
+            start = time.time()
+            error = await fetch(session,
+                                resolver,
+                                retries,
+                                domain_id,
+                                domain,
+                                failed_timeout if (failed_timeout is not None and
+                                                   q.failed_before(domain)) else timeout,
+                                domains,
+                                pending,
+                                q)
+            metrics.observe_fetch(time.time() - start, error)
+            breaker.record(domain, error is not None)
+            if limiter is not None:
+                limiter.release(time.time() - start if error is None else None,
+                                error in TIMEOUT_ERRORS)
+        finally:
+            fetching.discard(domain)
+            q.task_done()
+
+
+# a cancel can be lost when it races with the timeout of an aiohttp request,
+# the request fails with a TimeoutError and the worker continues, so the tasks
+# not done are cancelled again
+async def cancel_tasks(tasks):
+    while True:
+        for task in tasks:
+            task.cancel()
+        _, tasks = await asyncio.wait(tasks, timeout=1)
+        if len(tasks) == 0:
+            return
 
 
 # pylint: disable=too-many-arguments
-# pylint: disable=too-many-branches
 # pylint: disable=too-many-locals
 # pylint: disable=too-many-statements
 async def download(start_domain,
                    timeout,
-                   num_tasks):
+                   num_tasks,
+                   resume=False,
+                   checkpoint_interval=60,
+                   max_tasks=1000,
+                   nameservers=('8.8.8.8', '8.8.4.4'),
+                   max_failures=20,
+                   breaker_cooldown=60,
+                   max_attempts=3,
+                   retry_delay=10,
+                   max_response_size=16*1024*1024,
+                   metrics_interval=10,
+                   metrics_port=None,
+                   peers_format='files',
+                   prior=None,
+                   failed_timeout=None,
+                   seed_prior=False,
+                   recrawl=False,
+                   graph=False,
+                   channels=None):
 
+    global log_queue, metrics, peers_store, MAX_RESPONSE_SIZE
+    global num_domains_saved, links_size, num_scheduled, num_waiting
+    global validators, previous_peers, validators_size
+    global RUN, num_nodes, num_links, num_errors, num_skips, num_timeouts
+    global num_unchanged, graph_builder
+    MAX_RESPONSE_SIZE = max_response_size
+    # set by load_checkpoint when resuming
+    RUN = True
+    num_nodes = 0
+    num_links = 0
+    num_errors = 0
+    num_skips = 0
+    num_timeouts = 0
+    num_unchanged = 0
+    num_domains_saved = 0
+    links_size = 0
+    num_scheduled = 0
+    num_waiting = 0
+    # with --workers, the coordinator saves the graph from the merged links
+    graph_builder = None
+    if graph and SHARD is None:
+        graph_builder = GraphBuilder()
+    # with --recrawl, masnet.download.validators is not truncated
+    validators_size = 0
+    if os.path.exists(get_download_path(VALIDATORS_FILE_NAME)):
+        validators_size = os.path.getsize(get_download_path(VALIDATORS_FILE_NAME))
     start = time.time()
-    barrier = asyncio.Semaphore(num_tasks)
-    scheduled = set()
-    q = asyncio.Queue()
-    resolver = aiohttp.resolver.AsyncResolver(nameservers=['8.8.8.8',
-                                                           '8.8.4.4'])
+    # all domains scheduled, the queue and the retry queue have their ids
+    domains = DomainDictionary()
+    # ids of the scheduled domains not fetched yet, queued or being fetched
+    pending = DomainSet()
+    # domains being fetched by the workers
+    fetching = set()
+    breaker = CircuitBreaker(max_failures, cooldown=breaker_cooldown)
+    retries = RetryQueue(max_attempts, retry_delay)
+    q = Frontier(domains, prior)
+    log_queue = asyncio.Queue()
+    writer = asyncio.create_task(log_writer())
+    # num_tasks is None for -n auto
+    limiter = None
+    if num_tasks is None:
+        limiter = ConcurrencyLimiter(min(100, max_tasks), 1, max_tasks)
+        num_tasks = max_tasks
+    metrics = Metrics({'queue': lambda: q.qsize() + num_waiting,
+                       'retry_queue': retries.qsize,
+                       'in_flight': lambda: len(fetching),
+                       'concurrency': lambda: num_tasks if limiter is None else limiter.limit,
+                       'scheduled': lambda: num_scheduled,
+                       'nodes': lambda: num_nodes,
+                       'links': lambda: num_links})
+    if SHARD is not None:
+        metrics.gauges['shard'] = lambda: SHARD
+    metrics_tasks = [asyncio.create_task(metrics.monitor_loop())]
+    if metrics_interval > 0:
+        async def save_metrics():
+            while True:
+                await asyncio.sleep(metrics_interval)
+                save_log('masnet.download.metrics', '%s\n' % metrics.snapshot())
+        metrics_tasks.append(asyncio.create_task(save_metrics()))
+    metrics_server = None
+    if metrics_port is not None:
+        # with --workers, each worker process serves its own metrics
+        if SHARD is not None:
+            metrics_port = metrics_port + SHARD
+        metrics_server = await metrics.serve(metrics_port)
+        info('serving metrics at http://127.0.0.1:%d/metrics' % metrics_port)
+    resolver = CachingResolver(list(nameservers))
+    resolver.start()
+    # the resolver has its own cache
     conn = aiohttp.TCPConnector(limit=2*num_tasks,
                                 force_close=True, # no need for keep-alive
                                 use_dns_cache=False,
                                 resolver=resolver)
+    # aiohttp does not accept a number as timeout
+    timeout = aiohttp.ClientTimeout(total=timeout)
+    if failed_timeout is not None:
+        failed_timeout = aiohttp.ClientTimeout(total=failed_timeout)
     async with aiohttp.ClientSession(connector=conn,
-                                     timeout=timeout) as session:
+                                     timeout=timeout,
+                                     trace_configs=[metrics.trace_config()]) as session:
         domain_counts = {}
-        scheduled.add(start_domain)
-        q.put_nowait(start_domain)
-        last = time.time()
-        signal.signal(signal.SIGINT, signal_handler)
-        cnt = 0
-        cnt_threshold = 5
-        top5 = []
+        if resume:
+            checkpoint, domains = load_checkpoint()
+            q.domains = domains
+            start_domain = checkpoint['start_domain']
+            start = start - checkpoint['elapsed']
+            for domain_id in checkpoint['pending']:
+                pending.add(domain_id)
+            breaker.failures.update(checkpoint['failures'])
+            # json keys are str
+            for domain_id, attempts in checkpoint['attempts'].items():
+                retries.attempts[int(domain_id)] = attempts
+            # the peers are written in the same format as before
+            peers_format = checkpoint.get('peers_format', 'files')
+            recrawl = checkpoint.get('recrawl', False)
+            if graph_builder is not None:
+                # the links saved before the checkpoint
+                graph_builder.load(get_download_path('masnet.download.links'))
+            for domain_id in pending:
+                resolver.prefetch(domains.name(domain_id))
+                q.put_nowait(domain_id)
+            if SHARD is not None:
+                # sent again, as they might not be received by the other
+                # workers before they saved their checkpoints
+                for domain in domains:
+                    if get_shard(domain, NUM_SHARDS) != SHARD:
+                        outgoing.append(domain)
+            info('resuming crawl from %s, %d domains pending' % (start_domain,
+                                                                 len(pending)))
+        elif SHARD is None:
+            domain_id, _ = domains.intern(start_domain)
+            schedule(domain_id, start_domain, pending, resolver, q)
+        if not resume and seed_prior:
+            # the domains visited before are scheduled without waiting to
+            # find them, unless they are excluded now
+            for domain, prior_time in prior.items():
+                if prior_time == PRIOR_FAILED or is_excluded(domain):
+                    continue
+                if SHARD is not None and get_shard(domain, NUM_SHARDS) != SHARD:
+                    continue
+                domain_id, new = domains.intern(domain)
+                if new:
+                    schedule(domain_id, domain, pending, resolver, q)
+
+        peers_store = None
+        if peers_format == 'segments':
+            # with --workers, removed by the coordinator
+            if not resume and SHARD is None:
+                if recrawl:
+                    PeersStore.retire()
+                else:
+                    PeersStore.remove()
+            peers_store = PeersStore(SHARD, NUM_SHARDS)
+            peers_store.open()
+
+        validators = None
+        previous_peers = None
+        if recrawl:
+            accept = None
+            if SHARD is not None:
+                accept = lambda domain: get_shard(domain, NUM_SHARDS) == SHARD
+            # with --workers, the lines of the previous crawls are in the
+            # merged file, and the lines of this crawl before resuming are
+            # in the file of the shard
+            validators = load_validators(get_path(VALIDATORS_FILE_NAME), accept)
+            if SHARD is not None:
+                validators.update(load_validators(get_download_path(VALIDATORS_FILE_NAME)))
+            if peers_store is not None:
+                previous_peers = PeersStore.load_index(PEERS_PREVIOUS_INDEX_FILE_NAME,
+                                                       accept)
+            info('recrawl: %d domains with validators' % len(validators))
+
+        def counters():
+            return {'queue': q.qsize() + num_waiting,
+                    'retry_queue': retries.qsize(),
+                    'in_flight': len(fetching),
+                    'concurrency': num_tasks if limiter is None else limiter.limit,
+                    'scheduled': num_scheduled,
+                    'nodes': num_nodes,
+                    'unchanged': num_unchanged,
+                    'links': num_links,
+                    'errors': num_errors,
+                    'skips': num_skips,
+                    'timeouts': num_timeouts,
+                    'elapsed': time.time() - start}
+
         def print_status():
-            elapsed = time.time() - start
-            hours = int(elapsed / 3600)
-            minutes = int((elapsed - hours * 3600) / 60)
-            seconds = elapsed - minutes * 60 - hours * 3600
-            print('q:%06d a:%06d s:%06d ' \
-                  'N:%06d L:%09d ' \
-                  'e:%08d s:%08d to:%04d ' \
-                  't:%02d:%02d:%02d' % (q.qsize(), len(asyncio.all_tasks()),
-                                        len(scheduled),
-                                        num_nodes, num_links,
-                                        num_errors, num_skips, num_timeouts,
-                                        hours, minutes, seconds), flush=True)
-            verbose(tabulate(top5))
-        global RUN
-        while RUN and (cnt < cnt_threshold):
-            if (time.time() - last) > 1:
-                print_status()
-                last = time.time()
-                if len(asyncio.all_tasks()) == 1:
-                    cnt = cnt + 1
+            print(format_status(counters()), flush=True)
+            if is_verbose():
+                top5 = list(sorted(domain_counts.items(),
+                                   key=lambda t: t[1], reverse=True))[:5]
+                verbose(tabulate(top5))
+
+        # batches of domains received from the coordinator
+        num_received = 0
+
+        # the coordinator stops the workers when all are idle, and all
+        # domains sent to them are received
+        def report():
+            _, outbox = channels
+            if len(outgoing) > 0:
+                outbox.put(('peers', SHARD, list(outgoing)))
+                outgoing.clear()
+            doc = counters()
+            doc['idle'] = len(pending) == 0
+            doc['received'] = num_received
+            outbox.put(('status', SHARD, doc))
+
+        async def status():
+            last_checkpoint = time.time()
+            while True:
+                if channels is None:
+                    await asyncio.sleep(1)
+                    print_status()
                 else:
-                    cnt = 0
-
-            if q.qsize() > 0:
-                if not barrier.locked():
-                    async with barrier:
-                        domain = await q.get()
-                        debug(domain)
-                        if is_verbose():
-                            parts = domain.split('.')
-                            if len(parts) > 2:
-                                count_key = '.'.join(parts[-(len(parts)-1):])
-                                domain_counts[count_key] = domain_counts.get(count_key,
-                                                                             0) + 1
-                                top5 = list(sorted(domain_counts.items(),
-                                                   key=lambda t: t[1], reverse=True))[:5]
-                        asyncio.create_task(fetch(session,
-                                                  domain,
-                                                  timeout,
-                                                  scheduled,
-                                                  q))
-            # this is needed to give time to async loop operation
-            await asyncio.sleep(0)
+                    await asyncio.sleep(SHARD_REPORT_INTERVAL)
+                    report()
+                if (time.time() - last_checkpoint) > checkpoint_interval:
+                    await save_checkpoint(start_domain, time.time() - start,
+                                          domains, pending, breaker, retries)
+                    last_checkpoint = time.time()
+
+        stopped = asyncio.Event()
+        def stop():
+            global RUN
+            RUN = False
+            stopped.set()
+        # a worker process ignores SIGINT, it is stopped by the coordinator
+        if SHARD is None:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGINT, stop)
+
+        finished = asyncio.Event()
+        receive_task = None
+        if channels is not None:
+            inbox, _ = channels
+            messages = asyncio.Queue()
+            loop = asyncio.get_running_loop()
+            # the inbox is a multiprocessing queue, read by a thread
+            def read_inbox():
+                while True:
+                    message = inbox.get()
+                    try:
+                        loop.call_soon_threadsafe(messages.put_nowait, message)
+                    except RuntimeError:
+                        # the loop is closed
+                        return
+                    if message[0] == 'stop':
+                        return
+            threading.Thread(target=read_inbox, daemon=True).start()
+            async def receive():
+                nonlocal num_received
+                while True:
+                    message = await messages.get()
+                    if message[0] == 'peers':
+                        for domain in message[1]:
+                            domain_id, new = domains.intern(domain)
+                            if new:
+                                schedule(domain_id, domain, pending, resolver, q)
+                        num_received = num_received + 1
+                    elif message[1]:
+                        finished.set()
+                    else:
+                        stop()
+            receive_task = asyncio.create_task(receive())
 
-        print_status()
+        workers = []
+        for _ in range(0, num_tasks):
+            workers.append(asyncio.create_task(worker(session,
+                                                      resolver,
+                                                      retries,
+                                                      timeout,
+                                                      domains,
+                                                      pending,
+                                                      fetching,
+                                                      domain_counts,
+                                                      limiter,
+                                                      breaker,
+                                                      q,
+                                                      failed_timeout)))
+        status_task = asyncio.create_task(status())
+        if limiter is not None:
+            workers.append(asyncio.create_task(adjust_concurrency(limiter)))
+        def has_capacity():
+            if limiter is None:
+                return len(fetching) < num_tasks
+            return len(fetching) < limiter.limit
+        workers.append(asyncio.create_task(retries.feed(q, has_capacity)))
+
+        # a failed domain is put into the retry queue before its fetch is
+        # done, so when the queue is joined and the retry queue is empty,
+        # every domain is fetched
+        async def join():
+            while True:
+                await q.join()
+                if retries.qsize() == 0:
+                    return
+                await retries.join()
+        if channels is None:
+            join_task = asyncio.create_task(join())
+        else:
+            join_task = asyncio.create_task(finished.wait())
+        stop_task = asyncio.create_task(stopped.wait())
+        await asyncio.wait([join_task, stop_task],
+                           return_when=asyncio.FIRST_COMPLETED)
+        join_task.cancel()
+        stop_task.cancel()
+        if receive_task is not None:
+            receive_task.cancel()
+
+        if channels is None:
+            print_status()
 
         if RUN:
-            print('traversal finished. data is complete.')
+            info('traversal finished. data is complete.')
         else:
-            print('traversal terminated early. data is incomplete !!!')
+            info('traversal terminated early. data is incomplete !!!')
 
-        current_task = asyncio.current_task()
+        info('cancelling tasks...')
+        await cancel_tasks([status_task] + workers)
 
-        print('cancelling tasks...')
-        running_tasks = filter(lambda x: x != current_task,
-                               asyncio.all_tasks())
-        for task in running_tasks:
-            try:
-                task.cancel()
-            except:
-                pass
+        # saved after the tasks are done, so every link saved is between
+        # saved domains, and the domains of the cancelled fetches stay pending
+        await save_checkpoint(start_domain, time.time() - start,
+                              domains, pending, breaker, retries)
+        if SHARD is None:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGINT)
 
-        print('waiting for tasks...')
-        running_tasks = set(filter(lambda x: x != current_task,
-                                   asyncio.all_tasks()))
-        for task in running_tasks:
-            try:
-                await task
-            except:
-                pass
-        print('bye.')
+    if peers_store is not None:
+        peers_store.close()
+        # with --workers, removed by the coordinator
+        if RUN and SHARD is None:
+            PeersStore.remove_previous()
+    await resolver.close()
+    if metrics_interval > 0:
+        save_log('masnet.download.metrics', '%s\n' % metrics.snapshot())
+    for task in metrics_tasks:
+        task.cancel()
+    await asyncio.gather(*metrics_tasks, return_exceptions=True)
+    if metrics_server is not None:
+        await metrics_server.cleanup()
+    debug('dns cache hits: %d misses: %d' % (resolver.num_hits,
+                                             resolver.num_misses))
+
+    info('writing logs...')
+    stop_log_writer()
+    await writer
+    if graph_builder is not None:
+        if RUN:
+            save_crawl_graph(graph_builder, domains)
+        graph_builder = None
+    peak_memory = None
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if channels is not None:
+        _, outbox = channels
+        doc = counters()
+        doc['complete'] = RUN
+        doc['peak_memory'] = peak_memory
+        outbox.put(('done', SHARD, doc))
+        return
+    if peak_memory is not None:
+        print('peak memory: %.1f MB' % peak_memory)
+    print('bye.')
+
+
+def save_crawl_graph(builder, domains):
+    print('saving the graph...', flush=True)
+    graph_nodes, graph_links = builder.save(domains)
+    print('graph saved: %d nodes, %d links.' % (graph_nodes, graph_links),
+          flush=True)
+
+
+# fixed name output files of masnet.download, also written by each worker
+# process with its shard as suffix
+LOG_FILE_NAMES = ['masnet.download.errors',
+                  'masnet.download.visits',
+                  'masnet.download.skips',
+                  'masnet.download.times',
+                  'masnet.download.metrics']
+STATE_FILE_NAMES = ['masnet.download.domains',
+                    'masnet.download.links']
+
+
+# runs in a worker process
+# pylint: disable=too-many-arguments
+def download_shard(shard, num_shards, inbox, outbox, config, kwargs):
+    global SHARD, NUM_SHARDS, PEERS_URL
+    SHARD = shard
+    NUM_SHARDS = num_shards
+    PEERS_URL = config['peers_url']
+    # stopped by the coordinator, download does not handle SIGINT in a
+    # worker process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_debug(config['debug'])
+    set_verbose(config['verbose'])
+    load_exclusion(config['exclude_file'])
+    set_working_dir(config['dir'])
+    asyncio.run(download(channels=(inbox, outbox), **kwargs))
+
+
+# the log files of the shards are appended to the log files, and the domains
+# and links of the shards are merged into masnet.download.domains and
+# masnet.download.links, with the ids of the domains in the order of shards
+def merge_shards(num_shards, peers_format):
+    for file_name in LOG_FILE_NAMES:
+        with open(get_path(file_name), 'a') as f:
+            for shard in range(0, num_shards):
+                shard_path = get_path('%s.%d' % (file_name, shard))
+                if os.path.exists(shard_path):
+                    with open(shard_path, 'r') as shard_file:
+                        f.write(shard_file.read())
+                    os.remove(shard_path)
+    if peers_format == 'segments':
+        PeersStore.merge(num_shards)
+    # the shard files are kept for --resume
+    with open(get_path(VALIDATORS_FILE_NAME), 'a') as f:
+        for shard in range(0, num_shards):
+            shard_path = get_path('%s.%d' % (VALIDATORS_FILE_NAME, shard))
+            if os.path.exists(shard_path):
+                with open(shard_path, 'r') as shard_file:
+                    f.write(shard_file.read())
+    domains = DomainDictionary()
+    with open(get_path('masnet.download.links'), 'wb') as f:
+        for shard in range(0, num_shards):
+            domains_path = get_path('masnet.download.domains.%d' % shard)
+            if not os.path.exists(domains_path):
+                continue
+            # shard domain id -> domain id
+            domain_ids = array('I')
+            for domain in DomainDictionary.read(domains_path):
+                domain_ids.append(domains.intern(domain)[0])
+            links = load_links(get_path('masnet.download.links.%d' % shard))
+            for domain_id, peer_ids in links.items():
+                f.write(pack_links(domain_ids[domain_id],
+                                   array('I', [domain_ids[peer_id] for peer_id in peer_ids])))
+    with open(get_path('masnet.download.domains'), 'wb'):
+        pass
+    domains.save(get_path('masnet.download.domains'))
+
+
+# runs num_workers worker processes, each downloading the domains of its
+# shard, and routes the domains found by them to the workers of their shards
+# pylint: disable=too-many-locals
+# pylint: disable=too-many-branches
+# pylint: disable=too-many-statements
+def download_workers(num_workers, config, kwargs):
+    global RUN, num_nodes, num_links, num_errors, num_skips, num_timeouts
+    global num_unchanged
+    start = time.time()
+    resume = kwargs['resume']
+    if not resume and kwargs['peers_format'] == 'segments':
+        if kwargs.get('recrawl'):
+            PeersStore.retire()
+        else:
+            PeersStore.remove()
+    # spawned, so it works the same on all platforms
+    context = multiprocessing.get_context('spawn')
+    outbox = context.Queue()
+    inboxes = []
+    processes = []
+    for shard in range(0, num_workers):
+        inboxes.append(context.Queue())
+        processes.append(context.Process(target=download_shard,
+                                         args=(shard, num_workers,
+                                               inboxes[shard], outbox,
+                                               config, kwargs),
+                                         daemon=True))
+        processes[shard].start()
+    # number of batches of domains sent to each worker
+    routed = [0] * num_workers
+    statuses = [None] * num_workers
+    results = [None] * num_workers
+    if not resume:
+        start_domain = kwargs['start_domain']
+        inboxes[get_shard(start_domain, num_workers)].put(('peers', [start_domain]))
+        routed[get_shard(start_domain, num_workers)] = 1
+    stopping = False
+    interrupted = False
+    # pylint: disable=unused-argument
+    def interrupt(signum, frame):
+        nonlocal interrupted
+        interrupted = True
+    signal.signal(signal.SIGINT, interrupt)
+    def stop_workers(complete):
+        nonlocal stopping
+        for inbox in inboxes:
+            inbox.put(('stop', complete))
+        stopping = True
+    def combine(docs):
+        combined = {}
+        for doc in docs:
+            if doc is None:
+                continue
+            for key, value in doc.items():
+                if key == 'elapsed':
+                    combined[key] = max(combined.get(key, 0), value)
+                elif isinstance(value, (int, float)):
+                    combined[key] = combined.get(key, 0) + value
+        if 'elapsed' not in combined:
+            return None
+        return combined
+    last_status = time.time()
+    while None in results:
+        try:
+            message = outbox.get(timeout=SHARD_REPORT_INTERVAL)
+        except queue.Empty:
+            message = None
+        if message is not None:
+            kind, shard, body = message
+            if kind == 'peers':
+                batches = {}
+                for domain in body:
+                    batches.setdefault(get_shard(domain, num_workers), []).append(domain)
+                for owner, batch in batches.items():
+                    inboxes[owner].put(('peers', batch))
+                    routed[owner] = routed[owner] + 1
+            elif kind == 'status':
+                statuses[shard] = body
+            else:
+                results[shard] = body
+        for shard, process in enumerate(processes):
+            if results[shard] is None and process.exitcode not in (None, 0):
+                print('worker %d failed with exit code %d' % (shard,
+                                                            process.exitcode))
+                results[shard] = {'complete': False}
+                if not stopping:
+                    stop_workers(False)
+        if not stopping:
+            if interrupted:
+                stop_workers(False)
+            elif all(statuses[shard] is not None and
+                     statuses[shard]['idle'] and
+                     statuses[shard]['received'] == routed[shard]
+                     for shard in range(0, num_workers)):
+                stop_workers(True)
+        if (time.time() - last_status) >= 1:
+            combined = combine(statuses)
+            if combined is not None:
+                print(format_status(combined), flush=True)
+                num_nodes = combined['nodes']
+            last_status = time.time()
+    for process in processes:
+        process.join()
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    combined = combine(results)
+    if combined is not None:
+        print(format_status(combined), flush=True)
+        num_nodes = combined['nodes']
+        num_links = combined['links']
+        num_errors = combined['errors']
+        num_skips = combined['skips']
+        num_timeouts = combined['timeouts']
+        num_unchanged = combined['unchanged']
+    RUN = all(result['complete'] for result in results)
+    if RUN:
+        print('traversal finished. data is complete.')
+    else:
+        print('traversal terminated early. data is incomplete !!!')
+    print('merging files of workers...')
+    merge_shards(num_workers, kwargs['peers_format'])
+    if RUN and kwargs['peers_format'] == 'segments':
+        PeersStore.remove_previous()
+    if RUN and kwargs.get('graph'):
+        builder = GraphBuilder()
+        builder.load(get_path('masnet.download.links'))
+        save_crawl_graph(builder,
+                         DomainDictionary.load(get_path('masnet.download.domains')))
+        del builder
+    debug('%d workers finished in %.1f seconds' % (num_workers,
+                                                   time.time() - start))
+    peak_memory = [result.get('peak_memory') for result in results]
+    if None not in peak_memory:
+        print('peak memory: %.1f MB (%s)' % (sum(peak_memory),
+                                             ', '.join('%.1f' % m for m in peak_memory)))
+    print('bye.')
+
+
+# before a new (not resumed) execution
+def reset_files(recrawl):
+    # truncate fixed name output files
+    for file_name in LOG_FILE_NAMES + STATE_FILE_NAMES:
+        with open(get_path(file_name), 'w'):
+            pass
+        # files of the worker processes of an earlier execution
+        for file_path in glob.glob(get_path('%s.*' % file_name)):
+            os.remove(file_path)
+    for file_path in glob.glob(get_path('masnet.download.checkpoint.*')):
+        os.remove(file_path)
+    # the lines of the workers are merged at the end
+    for file_path in glob.glob(get_path('%s.*' % VALIDATORS_FILE_NAME)):
+        os.remove(file_path)
+    if recrawl:
+        compact_validators()
+    else:
+        with open(get_path(VALIDATORS_FILE_NAME), 'w'):
+            pass
+
+
+# None means auto
+def num_tasks_type(value):
+    if value == 'auto':
+        return None
+    return int(value)
 
 
 # pylint: disable=too-many-statements
@@ -265,11 +1852,18 @@ def main():
                         required=False)
 
     parser.add_argument('-n', '--num-tasks',
-                        help='use specified number of Python asyncio tasks for download',
-                        type=int,
+                        help='use specified number of Python asyncio tasks for download, ' \
+                             'or auto to adjust it while downloading (default: 100)',
+                        type=num_tasks_type,
                         required=False,
                         default=100)
 
+    parser.add_argument('--max-tasks',
+                        help='maximum number of tasks with -n auto (default: 1000)',
+                        type=int,
+                        required=False,
+                        default=1000)
+
     parser.add_argument('-s', '--start-domain',
                         help='domains to start traversal from (default: mastodon.social)',
                         required=False,
@@ -282,6 +1876,133 @@ def main():
                         required=False,
                         default=60)
 
+    parser.add_argument('--nameservers',
+                        help='comma separated nameservers to use ' \
+                             '(default: 8.8.8.8,8.8.4.4)',
+                        required=False,
+                        default='8.8.8.8,8.8.4.4')
+
+    parser.add_argument('--max-failures',
+                        help='skip the subdomains of a domain after specified ' \
+                             'number of consecutive failures under it, ' \
+                             '0 to disable (default: 20)',
+                        type=int,
+                        required=False,
+                        default=20)
+
+    parser.add_argument('--breaker-cooldown',
+                        help='fetch a single subdomain of a domain skipped ' \
+                             'due to --max-failures every specified seconds, ' \
+                             'and stop skipping if it is fetched (default: 60)',
+                        type=int,
+                        required=False,
+                        default=60)
+
+    parser.add_argument('--max-attempts',
+                        help='fetch a domain failed with a timeout or a ' \
+                             'connection error up to specified number of ' \
+                             'times (default: 3)',
+                        type=int,
+                        required=False,
+                        default=3)
+
+    parser.add_argument('--retry-delay',
+                        help='wait specified number of seconds before the ' \
+                             'first retry, doubled for each retry (default: 10)',
+                        type=int,
+                        required=False,
+                        default=10)
+
+    parser.add_argument('--max-response-size',
+                        help='fail the domains returning peers larger than ' \
+                             'specified number of bytes (default: 16777216)',
+                        type=int,
+                        required=False,
+                        default=16*1024*1024)
+
+    parser.add_argument('--metrics-interval',
+                        help='save metrics to masnet.download.metrics every ' \
+                             'specified number of seconds, 0 to disable (default: 10)',
+                        type=int,
+                        required=False,
+                        default=10)
+
+    parser.add_argument('--metrics-port',
+                        help='serve metrics in Prometheus text format at ' \
+                             'http://127.0.0.1:<port>/metrics',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--peers-format',
+                        help='save the peers to a <domain>.peers.json file per ' \
+                             'domain or to masnet.peers.*.segment files ' \
+                             '(default: files)',
+                        choices=PEERS_FORMATS,
+                        required=False,
+                        default='files')
+
+    parser.add_argument('--workers',
+                        help='download with specified number of processes, ' \
+                             'each downloading the domains of a shard ' \
+                             '(default: a single process)',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--prior',
+                        help='fetch the domains visited by the crawl in the ' \
+                             'specified directory first, the fastest first, ' \
+                             'and the domains failed in it last',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--seed-prior',
+                        help='also schedule the domains visited by the ' \
+                             '--prior crawl at the start, instead of when ' \
+                             'they are found',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--failed-timeout',
+                        help='use specified number of seconds for timeout ' \
+                             'for the domains failed in the --prior crawl ' \
+                             '(default: same as --timeout)',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--recrawl',
+                        help='send conditional requests for the domains ' \
+                             'visited by the previous crawls in the directory, ' \
+                             'and keep their peers if they are not changed',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--graph',
+                        help='build the graph while downloading, and save ' \
+                             'mastodon.labels and mastodon.networkit.* ' \
+                             'when the traversal is finished',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('-r', '--resume',
+                        help='resume an interrupted traversal from ' \
+                             'masnet.download.checkpoint',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--checkpoint-interval',
+                        help='save a checkpoint every specified number of ' \
+                             'seconds (default: 60)',
+                        type=int,
+                        required=False,
+                        default=60)
+
     args = parser.parse_args()
     set_debug(args.debug)
     set_verbose(args.verbose)
@@ -289,20 +2010,64 @@ def main():
     load_exclusion(args.exclude_file)
     set_working_dir(args.dir)
 
-    # truncate fixed name output files
-    with open(get_path('masnet.download.errors'), 'w'):
-        pass
-    with open(get_path('masnet.download.visits'), 'w'):
-        pass
-    with open(get_path('masnet.download.skips'), 'w'):
-        pass
-    with open(get_path('masnet.download.times'), 'w'):
-        pass
+    # read before the output files are truncated, it can be the same
+    # directory
+    prior = None
+    if args.seed_prior and args.prior is None:
+        print('--seed-prior needs --prior')
+        sys.exit(-1)
+    if args.prior is not None:
+        prior = load_prior(args.prior)
+        num_failed = sum(1 for t in prior.values() if t == PRIOR_FAILED)
+        print('prior: %d domains visited, %d failed' % (len(prior) - num_failed,
+                                                         num_failed))
 
-    asyncio.run(download(args.start_domain,
-                         args.timeout,
-                         args.num_tasks))
+    if args.workers is None:
+        checkpoints = ['masnet.download.checkpoint']
+    else:
+        checkpoints = ['masnet.download.checkpoint.%d' % shard
+                       for shard in range(0, args.workers)]
+    if args.resume:
+        for checkpoint in checkpoints:
+            if not os.path.exists(get_path(checkpoint)):
+                print('%s not found, cannot resume' % checkpoint)
+                sys.exit(-1)
+        if (args.workers is not None and
+                os.path.exists(get_path('masnet.download.checkpoint.%d' % args.workers))):
+            print('resume with the same number of workers')
+            sys.exit(-1)
+    else:
+        reset_files(args.recrawl)
 
+    kwargs = {'start_domain': args.start_domain,
+              'timeout': args.timeout,
+              'num_tasks': args.num_tasks,
+              'resume': args.resume,
+              'checkpoint_interval': args.checkpoint_interval,
+              'max_tasks': args.max_tasks,
+              'nameservers': args.nameservers.split(','),
+              'max_failures': args.max_failures,
+              'breaker_cooldown': args.breaker_cooldown,
+              'max_attempts': args.max_attempts,
+              'retry_delay': args.retry_delay,
+              'max_response_size': args.max_response_size,
+              'metrics_interval': args.metrics_interval,
+              'metrics_port': args.metrics_port,
+              'peers_format': args.peers_format,
+              'prior': prior,
+              'failed_timeout': args.failed_timeout,
+              'seed_prior': args.seed_prior,
+              'recrawl': args.recrawl,
+              'graph': args.graph}
+    if args.workers is None:
+        asyncio.run(download(**kwargs))
+    else:
+        config = {'dir': get_path(None),
+                  'debug': is_debug(),
+                  'verbose': is_verbose(),
+                  'exclude_file': args.exclude_file,
+                  'peers_url': PEERS_URL}
+        download_workers(args.workers, config, kwargs)
 
 if __name__ == '__main__':
     main()
@@ -4,13 +4,458 @@
 # pylint: disable=global-statement
 # pylint: disable=bare-except,broad-except
 import argparse
+from array import array
+import functools
 import glob
+import hashlib
 import json
+import multiprocessing
+import os
 import time
+try:
+    import resource
+except ImportError:
+    resource = None
+import numpy
 from masnet import get_version, set_verbose, set_debug, set_working_dir
 from masnet import debug, get_path
-from masnet import save_graph, percent_progress
+from masnet import save_graphs, save_links_csr, percent_progress
 from masnet import save_labels, load_labels
+from masnet import PeersStore, PEERS_FORMATS, PEERS_SEGMENT_FILE_NAME
+from masnet import DomainDictionary, pack_links, load_links
+
+
+# number of peers.json files parsed by a task of -j
+PEERS_FILES_PER_TASK = 256
+
+# state of the last --incremental run
+MANIFEST_FILE_NAME = 'masnet.generate.manifest'
+NAMES_FILE_NAME = 'masnet.generate.names'
+NODE_PEERS_FILE_NAME = 'masnet.generate.peers'
+
+
+# the peers are read by tasks, each a list of peers.json files or the
+# records of a segment, in the order masnet.iter_peers reads them, so the
+# node ids are the same for any -j
+# only the files (the file names) or the records (the domains) in keys are
+# read if keys is given
+def get_peers_tasks(peers_format, keys=None):
+    tasks = []
+    if peers_format == 'segments':
+        # segment -> offsets of the records, the last record of each domain
+        offsets = {}
+        for domain, (segment, offset) in PeersStore().index.items():
+            if keys is None or domain in keys:
+                offsets.setdefault(segment, []).append(offset)
+        for segment in sorted(offsets):
+            tasks.append(('segment',
+                          get_path(PEERS_SEGMENT_FILE_NAME % segment),
+                          sorted(offsets[segment])))
+    else:
+        file_paths = glob.glob(get_path('*.peers.json'))
+        if keys is not None:
+            file_paths = [file_path for file_path in file_paths
+                          if os.path.basename(file_path) in keys]
+        for i in range(0, len(file_paths), PEERS_FILES_PER_TASK):
+            tasks.append(('files', file_paths[i:i+PEERS_FILES_PER_TASK]))
+    return tasks
+
+
+# yields the content of the peers.json files (bytes) or the records (str)
+def iter_task_texts(task):
+    if task[0] == 'segment':
+        with open(task[1], 'rb') as f:
+            for offset in task[2]:
+                if f.tell() != offset:
+                    f.seek(offset)
+                yield PeersStore.read_record(f)
+    else:
+        for file_path in task[1]:
+            with open(file_path, 'rb') as f:
+                yield f.read()
+
+
+# runs in the processes of -j, returns the domains of the task, the distinct
+# peer names, and for each domain the number of its peers followed by their
+# indices in the peer names, so little is sent back, and the digests of the
+# contents if digests is True
+def parse_peers_task(task, digests=False):
+    domains = []
+    # peer name -> index
+    names = {}
+    counts = array('I')
+    indices = array('I')
+    content_digests = [] if digests else None
+    for text in iter_task_texts(task):
+        if digests:
+            data = text if isinstance(text, bytes) else text.encode('utf-8')
+            content_digests.append(hashlib.blake2b(data,
+                                                   digest_size=16).hexdigest())
+        doc = json.loads(text)
+        # reading the domain from the file, so this is the actual domain
+        domains.append(doc['domain'])
+        count = 0
+        for peer_name in doc['peers']:
+            # there should be no need for None and len=0 checks
+            # but I saw such data can be returned from peers api call
+            # so clean it up
+            if peer_name is None:
+                continue
+            if len(peer_name.strip()) == 0:
+                continue
+            indices.append(names.setdefault(peer_name, len(names)))
+            count = count + 1
+        counts.append(count)
+    return domains, list(names), counts, indices, content_digests
+
+
+# yields the results of parse_peers_task for the tasks, with num_jobs
+# processes if it is more than 1
+def iter_parsed_tasks(tasks, num_jobs=1, digests=False):
+    parse = functools.partial(parse_peers_task, digests=digests)
+    if num_jobs > 1:
+        # spawned, so it works the same on all platforms
+        with multiprocessing.get_context('spawn').Pool(num_jobs) as pool:
+            yield from pool.imap(parse, tasks)
+    else:
+        yield from map(parse, tasks)
+
+
+# returns id2label (a list), and the links as the source and the target
+# node ids, in the order of the peers, without self-loops
+# statusfn is called with the number of nodes and links read so far
+def read_peers(peers_format, num_jobs=1, statusfn=None):
+    tasks = get_peers_tasks(peers_format)
+    id2label = []
+    # label -> node_id, the last one if a domain is read more than once
+    label2id = {}
+    # (node_id of the first domain, peer names, counts, indices) of each task
+    parsed = []
+    for domains, names, counts, indices, _ in iter_parsed_tasks(tasks,
+                                                               num_jobs):
+        parsed.append((len(id2label), names, counts, indices))
+        for domain in domains:
+            label2id[domain] = len(id2label)
+            id2label.append(domain)
+        if statusfn is not None:
+            statusfn(len(id2label), 0)
+    sources = array('i')
+    targets = array('i')
+    # popped, so the peers of a task are freed when they are done
+    parsed.reverse()
+    while len(parsed) > 0:
+        node_id, names, counts, indices = parsed.pop()
+        # filter if peer is not a known node
+        # Mastodon peers usually contain many strange domains:
+        # - private IP addresses
+        # - malicious domains
+        # - not working domains
+        # each name is looked up once for a task
+        peer_node_ids = array('i', [label2id.get(name, -1) for name in names])
+        del names
+        i = 0
+        for count in counts:
+            for index in indices[i:i+count]:
+                peer_node_id = peer_node_ids[index]
+                # do not allow self-loops
+                if peer_node_id != -1 and peer_node_id != node_id:
+                    sources.append(node_id)
+                    targets.append(peer_node_id)
+            i = i + count
+            node_id = node_id + 1
+        if statusfn is not None:
+            statusfn(len(id2label), len(sources))
+    return id2label, sources, targets
+
+
+# returns id2label (a list), and the links as the source and the target
+# node ids, like read_peers but from the domain ids and the links saved by
+# masnet.download, so no domain name is looked up
+def read_links(statusfn=None):
+    links = load_links(get_path('masnet.download.links'))
+    id2label = []
+    # domain id -> node_id, -1 if the domain is not a node
+    node_ids = array('i')
+    # the nodes are in the order the domains are scheduled
+    for domain_id, domain in enumerate(DomainDictionary.read(get_path('masnet.download.domains'))):
+        if domain_id in links:
+            node_ids.append(len(id2label))
+            id2label.append(domain)
+        else:
+            node_ids.append(-1)
+    sources = array('i')
+    targets = array('i')
+    for domain_id, peer_ids in links.items():
+        node_id = node_ids[domain_id]
+        for peer_id in peer_ids:
+            peer_node_id = node_ids[peer_id]
+            # do not allow self-loops
+            if peer_node_id != -1 and peer_node_id != node_id:
+                sources.append(node_id)
+                targets.append(peer_node_id)
+        if statusfn is not None:
+            statusfn(len(id2label), len(sources))
+    return id2label, sources, targets
+
+
+# --incremental keeps the state of the last run:
+# - masnet.generate.manifest: the peers format, the number of names saved
+#   and the nodes in the order of their ids, each as [key, domain, stamp,
+#   digest], key is the file name (or the domain for segments), stamp is
+#   [mtime_ns, size] of the file (or the location and the digest of the
+#   compressed record), digest is the digest of the content, and null for
+#   the id of a removed node
+# - masnet.generate.names: the domains and the peer names, interned
+# - masnet.generate.peers: the peers of each node as name ids
+# it is used only if the manifest exists and the peers format is the same
+def load_state(peers_format):
+    manifest_path = get_path(MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest['peers_format'] != peers_format:
+        return None
+    names = DomainDictionary.load(get_path(NAMES_FILE_NAME),
+                                  manifest['num_names'])
+    node_peers = load_links(get_path(NODE_PEERS_FILE_NAME))
+    return manifest['nodes'], names, node_peers
+
+
+def save_state(peers_format, nodes, names, num_names_saved, node_peers):
+    manifest_path = get_path(MANIFEST_FILE_NAME)
+    # the state is not used without the manifest, so a run interrupted
+    # while saving it starts over
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    if num_names_saved == 0 and os.path.exists(get_path(NAMES_FILE_NAME)):
+        os.remove(get_path(NAMES_FILE_NAME))
+    names.save(get_path(NAMES_FILE_NAME), num_names_saved)
+    with open(get_path(NODE_PEERS_FILE_NAME), 'wb') as f:
+        for node_id in range(0, len(nodes)):
+            f.write(pack_links(node_id, node_peers[node_id]))
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'peers_format': peers_format,
+                   'num_names': len(names),
+                   'nodes': nodes}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+# key -> stamp of the peers files (or the records) there are now
+def get_peers_stamps(peers_format):
+    stamps = {}
+    if peers_format == 'segments':
+        # segment -> [(offset, domain)]
+        records = {}
+        for domain, (segment, offset) in PeersStore().index.items():
+            records.setdefault(segment, []).append((offset, domain))
+        # the segments are written again from the start by a new
+        # masnet.download execution, so a record can have the location of
+        # a different record of the last run, the digest of the compressed
+        # record tells them apart without decompressing it
+        for segment in sorted(records):
+            with open(get_path(PEERS_SEGMENT_FILE_NAME % segment), 'rb') as f:
+                for offset, domain in sorted(records[segment]):
+                    if f.tell() != offset:
+                        f.seek(offset)
+                    digest = hashlib.blake2b(PeersStore.read_raw_record(f),
+                                             digest_size=16).hexdigest()
+                    stamps[domain] = [segment, offset, digest]
+    else:
+        for file_path in glob.glob(get_path('*.peers.json')):
+            stat = os.stat(file_path)
+            stamps[os.path.basename(file_path)] = [stat.st_mtime_ns,
+                                                   stat.st_size]
+    return stamps
+
+
+# like read_peers, but only the new or changed peers files (or records) are
+# parsed, the peers of the others are read from the state of the last run
+# a node keeps its id in the state, the ids of the removed nodes are given
+# to the new ones, and the ids left are kept empty, so no node is ever
+# renumbered in the state (only the ids left at the end are dropped)
+# the empty ids are not nodes of the graph, so the graph is the same as
+# read_peers creates, and a node has its id in the state less the number
+# of empty ids before it
+# statsfn is called with the numbers of the parsed, unchanged (parsed but
+# with the same content) and removed nodes, and the ids left
+def update_peers(peers_format, num_jobs=1, statusfn=None, statsfn=None):
+    stamps = get_peers_stamps(peers_format)
+    state = load_state(peers_format)
+    if state is None:
+        nodes, names, node_peers = [], DomainDictionary(), {}
+    else:
+        nodes, names, node_peers = state
+    num_names_saved = len(names)
+    # key -> node_id
+    node_ids = {node[0]: node_id for node_id, node in enumerate(nodes)
+                if node is not None}
+    keys = set(key for key, stamp in stamps.items()
+               if key not in node_ids or nodes[node_ids[key]][2] != stamp)
+    # the ids of the nodes removed now and before, the lowest id is given
+    # first
+    free_ids = [node_id for node_id, node in enumerate(nodes) if node is None]
+    num_removed = 0
+    for key, node_id in list(node_ids.items()):
+        if key not in stamps:
+            free_ids.append(node_id)
+            nodes[node_id] = None
+            node_peers[node_id] = array('I')
+            del node_ids[key]
+            num_removed = num_removed + 1
+    free_ids.sort(reverse=True)
+    tasks = get_peers_tasks(peers_format, keys)
+    # (segment file path, offset) -> domain
+    record_domains = {}
+    if peers_format == 'segments':
+        for domain in keys:
+            segment, offset, _ = stamps[domain]
+            record_domains[(get_path(PEERS_SEGMENT_FILE_NAME % segment),
+                            offset)] = domain
+    num_parsed = 0
+    num_unchanged = 0
+    for task, parsed in zip(tasks, iter_parsed_tasks(tasks, num_jobs, True)):
+        domains, peer_names, counts, indices, digests = parsed
+        if task[0] == 'segment':
+            task_keys = [record_domains[(task[1], offset)]
+                         for offset in task[2]]
+        else:
+            task_keys = [os.path.basename(file_path) for file_path in task[1]]
+        name_ids = array('I', [names.intern(name)[0] for name in peer_names])
+        del peer_names
+        i = 0
+        for key, domain, count, digest in zip(task_keys, domains,
+                                              counts, digests):
+            names.intern(domain)
+            node_id = node_ids.get(key)
+            if node_id is None:
+                if len(free_ids) > 0:
+                    node_id = free_ids.pop()
+                else:
+                    node_id = len(nodes)
+                    nodes.append(None)
+                node_ids[key] = node_id
+            elif nodes[node_id][3] == digest:
+                num_unchanged = num_unchanged + 1
+            nodes[node_id] = [key, domain, stamps[key], digest]
+            node_peers[node_id] = array('I', [name_ids[index]
+                                              for index in indices[i:i+count]])
+            i = i + count
+            num_parsed = num_parsed + 1
+        if statusfn is not None:
+            statusfn(num_parsed, 0)
+    # the ids left at the end are dropped, no other node is moved
+    while len(nodes) > 0 and nodes[-1] is None:
+        nodes.pop()
+        del node_peers[len(nodes)]
+    num_empty = sum(1 for node in nodes if node is None)
+    save_state(peers_format, nodes, names, num_names_saved, node_peers)
+    if statsfn is not None:
+        statsfn(num_parsed, num_unchanged, num_removed, num_empty)
+    # the ids in the state of the nodes of the graph
+    state_ids = [node_id for node_id, node in enumerate(nodes)
+                 if node is not None]
+    # filter if peer is not a known node, as read_peers does
+    # name id -> node_id, -1 if the name is not a node
+    name_node_ids = numpy.full(len(names), -1, dtype=numpy.int32)
+    for node_id, state_id in enumerate(state_ids):
+        name_node_ids[names.find(nodes[state_id][1])] = node_id
+    counts = numpy.array([len(node_peers[state_id])
+                          for state_id in state_ids],
+                         dtype=numpy.int64)
+    name_ids = numpy.concatenate([numpy.zeros(0, dtype=numpy.uint32)] +
+                                 [numpy.frombuffer(node_peers.pop(state_id),
+                                                   dtype=numpy.uint32)
+                                  for state_id in state_ids])
+    sources = numpy.repeat(numpy.arange(len(state_ids), dtype=numpy.int32),
+                           counts)
+    targets = name_node_ids[name_ids]
+    del name_ids
+    known = targets != -1
+    return ([nodes[state_id][1] for state_id in state_ids],
+            sources[known], targets[known])
+
+
+# returns the links in CSR form (offsets, targets) for save_graphs, the
+# targets of node i are targets[offsets[i]:offsets[i+1]]
+# each link is a single int64 key, source * num_nodes + target, so sorting
+# the keys sorts the links by source then target, and the duplicates are
+# next to each other
+def build_csr(num_nodes, sources, targets):
+    sources = numpy.frombuffer(sources, dtype=numpy.int32)
+    targets = numpy.frombuffer(targets, dtype=numpy.int32)
+    keys = sources.astype(numpy.int64)
+    keys *= num_nodes
+    keys += targets
+    # remove self-loops
+    keys = keys[sources != targets]
+    keys.sort()
+    # remove duplicates
+    if len(keys) > 1:
+        keys = keys[numpy.concatenate(([True], keys[1:] != keys[:-1]))]
+    targets = (keys % num_nodes).astype(numpy.int32)
+    keys //= num_nodes
+    offsets = numpy.zeros(num_nodes + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(keys, minlength=num_nodes),
+                 out=offsets[1:])
+    return offsets, targets
+
+# builds the graph while masnet.download crawls, with its --graph
+# a domain is a node from when its peers are saved, in that order, and its
+# peers are kept as domain ids, as they may still be fetched, until the
+# graph is saved, then the links to the peers that are not nodes are dropped
+class GraphBuilder:
+
+    def __init__(self):
+        # domain id of each node
+        self.domain_ids = array('I')
+        # the links, the sources as node ids and the targets as domain ids
+        self.sources = array('i')
+        self.targets = array('I')
+
+    def __len__(self):
+        return len(self.domain_ids)
+
+    def add(self, domain_id, peer_ids):
+        node_id = len(self.domain_ids)
+        self.domain_ids.append(domain_id)
+        self.sources.extend(array('i', [node_id]) * len(peer_ids))
+        self.targets.extend(peer_ids)
+
+    # adds the domains and the peers saved to masnet.download.links
+    def load(self, file_path):
+        for domain_id, peer_ids in load_links(file_path).items():
+            self.add(domain_id, peer_ids)
+
+    # returns id2label, and the links as the source and the target node ids
+    # like read_peers, domains is the DomainDictionary of the crawl
+    def get_links(self, domains):
+        # domain id -> node_id, -1 if the domain is not a node
+        node_ids = numpy.full(len(domains), -1, dtype=numpy.int32)
+        node_ids[numpy.frombuffer(self.domain_ids, dtype=numpy.uint32)] = \
+            numpy.arange(len(self.domain_ids), dtype=numpy.int32)
+        targets = node_ids[numpy.frombuffer(self.targets, dtype=numpy.uint32)]
+        known = targets != -1
+        sources = numpy.frombuffer(self.sources, dtype=numpy.int32)[known]
+        id2label = [domains.name(domain_id) for domain_id in self.domain_ids]
+        return id2label, sources, targets[known]
+
+    # saves mastodon.labels, mastodon.links and the graphs as masnet.generate
+    # does, returns the number of nodes and links
+    def save(self, domains):
+        id2label, sources, targets = self.get_links(domains)
+        num_nodes = len(id2label)
+        links = build_csr(num_nodes, sources, targets)
+        del sources
+        del targets
+        save_labels(id2label, get_path('mastodon.labels'))
+        del id2label
+        save_graphs(links,
+                    get_path('mastodon.networkit.directed'),
+                    get_path('mastodon.networkit.undirected'))
+        save_links_csr(links, get_path('mastodon.links'))
+        return num_nodes, len(links[1])
+
 
 # pylint: disable=too-many-statements
 # pylint: disable=too-many-locals
@@ -36,20 +481,44 @@ def main():
                         required=False,
                         default=False)
 
+    parser.add_argument('--peers-format',
+                        help='read the peers from <domain>.peers.json files ' \
+                             'or from masnet.peers.*.segment files ' \
+                             '(default: files)',
+                        choices=PEERS_FORMATS,
+                        required=False,
+                        default='files')
+
+    parser.add_argument('-j', '--jobs',
+                        help='read the peers with specified number of ' \
+                             'processes (default: 1)',
+                        type=int,
+                        required=False,
+                        default=1)
+
+    parser.add_argument('--links',
+                        help='create the graph from masnet.download.domains ' \
+                             'and masnet.download.links instead of the peers',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--incremental',
+                        help='parse only the peers files new or changed ' \
+                             'since the last --incremental execution, ' \
+                             'keeping the node ids',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
     args = parser.parse_args()
+    if args.links and args.incremental:
+        parser.error('--links cannot be used with --incremental')
     set_debug(args.debug)
     set_verbose(args.verbose)
     debug(str(args))
     set_working_dir(args.dir)
 
-    # node_id -> label (domain)
-    id2label = {}
-    # label -> node_id
-    label2id = {}
-    # node_id -> adjlist of this node
-    adjlist = {}
-    # node_id -> list of peers from json (domain names)
-    peers = {}
     num_nodes = 0
     num_links = 0
     start = time.time()
@@ -63,55 +532,45 @@ def main():
               'e:%02d:%02d:%02d ' % (num_nodes, num_links,
                                      hours, minutes, seconds), flush=True)
 
+    last_status = time.time() - 10
+    def read_status(nodes, links):
+        nonlocal last_status, num_nodes, num_links
+        num_nodes = nodes
+        num_links = links
+        if (time.time() - last_status) > 1:
+            print_status()
+            last_status = time.time()
 
     try:
-        # load domains from peers.json files
-        # this is the best way because otherwise exclusion and errors has to
-        # be re-checked, computationally expensive
-        # we already know these passed exclusion and has peers info
-        print('creating the graph from peers...')
-        last_status = time.time() - 10
-        for file_name in glob.glob(get_path('*.peers.json')):
-            if (time.time() - last_status) > 1:
-                print_status()
-                last_status = time.time()
-            with open(file_name, 'r') as f:
-                doc = json.load(f)
-                # reading the domain from the file, so this is the actual
-                # domain
-                domain = doc['domain']
-                node_id = num_nodes
-                num_nodes = num_nodes + 1
-                label2id[domain] = node_id
-                id2label[node_id] = domain
-                peers[node_id] = doc['peers']
-                # adjlist is a set, hence no multiple links
-                adjlist[node_id] = set()
-        for node_id, node_peers in peers.items():
-            if (time.time() - last_status) > 1:
-                print_status()
-                last_status = time.time()
-            for peer_name in node_peers:
-                # there should be no need for None and len=0 checks
-                # but I saw such data can be returned from peers api call
-                # so clean it up
-                if peer_name is None:
-                    continue
-                if len(peer_name.strip()) == 0:
-                    continue
-                # filter if peer is not a known node
-                # Mastodon peers usually contain many strange domains:
-                # - private IP addresses
-                # - malicious domains
-                # - not working domains
-                if peer_name in label2id:
-                    peer_node_id = label2id[peer_name]
-                    # do not allow self-loops
-                    if peer_node_id != node_id:
-                        adjlist[node_id].add(peer_node_id)
-                        num_links = num_links + 1
-
-        del peers
+        if args.links:
+            # the domain ids and the peers of each domain as domain ids are
+            # saved by masnet.download, so no domain name is looked up
+            print('creating the graph from links...')
+            id2label, sources, targets = read_links(read_status)
+        elif args.incremental:
+            print('updating the graph from the changed peers...')
+            def print_stats(parsed, unchanged, removed, empty):
+                print('%d peers files parsed (%d unchanged), %d removed, ' \
+                      '%d empty ids.' % (parsed, unchanged, removed, empty))
+            id2label, sources, targets = update_peers(args.peers_format,
+                                                      args.jobs,
+                                                      read_status,
+                                                      print_stats)
+        else:
+            # load domains from peers.json files
+            # this is the best way because otherwise exclusion and errors has to
+            # be re-checked, computationally expensive
+            # we already know these passed exclusion and has peers info
+            print('creating the graph from peers...')
+            id2label, sources, targets = read_peers(args.peers_format,
+                                                    args.jobs,
+                                                    read_status)
+        num_nodes = len(id2label)
+        # no multiple links
+        links = build_csr(num_nodes, sources, targets)
+        del sources
+        del targets
+        num_links = len(links[1])
 
         print_status()
         print('graph created.')
@@ -121,22 +580,26 @@ def main():
         print('labels saved.')
 
         del id2label
-        del label2id
 
         print('saving graphs...')
-        save_graph(adjlist,
-                   False,
-                   get_path('mastodon.networkit.undirected'),
-                   progressfn=percent_progress)
-        save_graph(adjlist,
-                   True,
-                   get_path('mastodon.networkit.directed'),
-                   progressfn=percent_progress)
+        save_graphs(links,
+                    get_path('mastodon.networkit.directed'),
+                    get_path('mastodon.networkit.undirected'),
+                    progressfn=percent_progress)
         print('graphs saved.')
 
+        # after the graphs, as it is not used if it is older than them
+        save_links_csr(links, get_path('mastodon.links'))
+        print('links saved.')
+
     except KeyboardInterrupt:
         pass
 
+    print_status()
+    # ru_maxrss is in kilobytes on Linux
+    if resource is not None:
+        print('peak memory: %.1f MB' %
+              (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
     print('bye.')
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-function-docstring
+# pylint: disable=invalid-name
+import asyncio
+import json
+import time
+import aiohttp
+from aiohttp import web
+
+# upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+LOOP_LAG_INTERVAL = 0.1
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i = i + 1
+        self.counts[i] = self.counts[i] + 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+    # upper bound of the bucket containing the quantile
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total = total + count
+            if total >= rank:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                return float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': round(self.sum, 3),
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99)}
+
+    def prometheus(self, name, help_text):
+        lines = ['# HELP %s %s' % (name, help_text),
+                 '# TYPE %s histogram' % name]
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total = total + count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, total))
+        lines.append('%s_bucket{le="+Inf"} %d' % (name, self.count))
+        lines.append('%s_sum %f' % (name, self.sum))
+        lines.append('%s_count %d' % (name, self.count))
+        return lines
+
+
+# instrumentation of masnet.download
+# gauges are functions returning the current value, like the queue depth
+# pylint: disable=too-many-instance-attributes
+class Metrics:
+
+    def __init__(self, gauges=None):
+        self.start = time.time()
+        self.connect = Histogram()
+        self.first_byte = Histogram()
+        self.total = Histogram()
+        self.num_fetches = 0
+        self.bytes_received = 0
+        # error (exception class name or HTTP status) -> count
+        self.errors = {}
+        self.gauges = {} if gauges is None else gauges
+        # the largest loop lag since the last snapshot, and the last one
+        self.loop_lag = 0
+        self.max_loop_lag = 0
+        self.last_snapshot = (time.time(), 0)
+
+    def observe_fetch(self, total, error):
+        self.num_fetches = self.num_fetches + 1
+        self.total.observe(total)
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    # records connect and first byte (response headers) times
+    def trace_config(self):
+        loop = asyncio.get_running_loop()
+        # pylint: disable=unused-argument
+        async def on_request_start(session, ctx, params):
+            ctx.start = loop.time()
+        async def on_connection_create_start(session, ctx, params):
+            ctx.connect_start = loop.time()
+        async def on_connection_create_end(session, ctx, params):
+            self.connect.observe(loop.time() - ctx.connect_start)
+        async def on_request_end(session, ctx, params):
+            self.first_byte.observe(loop.time() - ctx.start)
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(on_request_start)
+        config.on_connection_create_start.append(on_connection_create_start)
+        config.on_connection_create_end.append(on_connection_create_end)
+        config.on_request_end.append(on_request_end)
+        return config
+
+    async def monitor_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag = loop.time() - before - LOOP_LAG_INTERVAL
+            self.max_loop_lag = max(self.max_loop_lag, self.loop_lag)
+
+    def snapshot(self):
+        now = time.time()
+        last_time, last_fetches = self.last_snapshot
+        fetches_per_second = 0
+        if now > last_time:
+            fetches_per_second = (self.num_fetches - last_fetches) / (now - last_time)
+        self.last_snapshot = (now, self.num_fetches)
+        doc = {'time': round(now, 3),
+               'elapsed': round(now - self.start, 3),
+               'fetches': self.num_fetches,
+               'fetches_per_second': round(fetches_per_second, 3),
+               'bytes_received': self.bytes_received,
+               'errors': dict(self.errors),
+               'loop_lag': round(self.max_loop_lag, 4),
+               'connect': self.connect.snapshot(),
+               'first_byte': self.first_byte.snapshot(),
+               'total': self.total.snapshot()}
+        self.max_loop_lag = self.loop_lag
+        for name, gauge in self.gauges.items():
+            doc[name] = gauge()
+        return json.dumps(doc)
+
+    def prometheus(self):
+        lines = []
+        lines.extend(self.connect.prometheus('masnet_download_connect_seconds',
+                                             'Time to connect.'))
+        lines.extend(self.first_byte.prometheus('masnet_download_first_byte_seconds',
+                                                'Time to the response headers.'))
+        lines.extend(self.total.prometheus('masnet_download_fetch_seconds',
+                                           'Time to fetch the peers of a domain.'))
+        lines.append('# HELP masnet_download_fetches_total Fetches done.')
+        lines.append('# TYPE masnet_download_fetches_total counter')
+        lines.append('masnet_download_fetches_total %d' % self.num_fetches)
+        lines.append('# HELP masnet_download_received_bytes_total Bytes received.')
+        lines.append('# TYPE masnet_download_received_bytes_total counter')
+        lines.append('masnet_download_received_bytes_total %d' % self.bytes_received)
+        lines.append('# HELP masnet_download_errors_total Errors by class.')
+        lines.append('# TYPE masnet_download_errors_total counter')
+        for error, count in sorted(self.errors.items()):
+            lines.append('masnet_download_errors_total{error=%s} %d' % (json.dumps(error),
+                                                                        count))
+        lines.append('# HELP masnet_download_loop_lag_seconds Event loop lag.')
+        lines.append('# TYPE masnet_download_loop_lag_seconds gauge')
+        lines.append('masnet_download_loop_lag_seconds %f' % self.loop_lag)
+        for name, gauge in self.gauges.items():
+            lines.append('# TYPE masnet_download_%s gauge' % name)
+            lines.append('masnet_download_%s %s' % (name, gauge()))
+        return '\n'.join(lines) + '\n'
+
+    # serves /metrics in Prometheus text format on localhost
+    async def serve(self, port):
+        # pylint: disable=unused-argument
+        async def handler(request):
+            return web.Response(text=self.prometheus(),
+                                content_type='text/plain',
+                                charset='utf-8')
+        app = web.Application()
+        app.router.add_get('/metrics', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner